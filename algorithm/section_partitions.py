@@ -1,5 +1,7 @@
 # coding=utf-8
+from common.caches import TtlLruCache
 from common.configs import config
+from common.msg_bus import message_bus, Event
 
 __author__ = 'liuzhaoming'
 
@@ -9,6 +11,19 @@ class EqualSectionPartitions(object):
     根据区间中元素数目等分区间
     """
 
+    def __init__(self):
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化子区间缓存，子区间只和统计结果相关，缓存之后价格区间聚合可以放到原始查询中一次完成
+        :return:
+        """
+        cache_cfg = config.get_value('consts/global/algorithm/section_size_cache') or {}
+        self.child_size_cache_enable = cache_cfg.get('enable', True)
+        self.child_size_cache = TtlLruCache(cache_cfg.get('max_size') or 20000, cache_cfg.get('ttl') or 600)
+
     def get_child_section_size(self, avg, std_deviation, child_section_num=120):
         """
         根据平均值、标准差、区间数目获取区间大小
@@ -34,6 +49,27 @@ class EqualSectionPartitions(object):
         :param section_num:
         :return:
         """
+        child_section_num = self.get_child_section_num(section_num)
+        child_section_size = self.get_child_section_size(avg, std_deviation, child_section_num)
+        return self.get_child_section_range_list_by_size(child_section_num, child_section_size)
+
+    def get_child_section_num(self, section_num=0):
+        """
+        获取子区间数目
+        :param section_num:
+        :return:
+        """
+        section_rate = config.get_value('consts/global/algorithm/section_range_rate') or 20
+        section_num = section_num or config.get_value('consts/global/algorithm/price_section_num') or 6
+        return section_rate * section_num
+
+    def get_child_section_range_list_by_size(self, child_section_num, child_section_size):
+        """
+        根据子区间数目和大小获取数值范围区间列表，区间只由这两个值决定
+        :param child_section_num:
+        :param child_section_size:
+        :return:
+        """
 
         def get_single_section_range(index_pos, total_num, section_size):
             """
@@ -46,13 +82,39 @@ class EqualSectionPartitions(object):
             else:
                 return {'from': section_size * index_pos, 'to': section_size * (index_pos + 1)}
 
-        section_rate = config.get_value('consts/global/algorithm/section_range_rate') or 20
-        section_num = section_num or config.get_value('consts/global/algorithm/price_section_num') or 6
-        child_section_num = section_rate * section_num
-        child_section_size = self.get_child_section_size(avg, std_deviation, child_section_num)
         return [get_single_section_range(index, child_section_num, child_section_size) for index in
                 xrange(child_section_num)]
 
+    def get_cached_child_sizes(self, cache_prefix, section_fields):
+        """
+        获取缓存的字段子区间，缓存key为(索引, adminId, 类目)等查询前缀、字段和区间数目
+        :param cache_prefix:
+        :param section_fields: [(field_name, section_num), ...]
+        :return: {field_name: (child_section_num, child_section_size)}
+        """
+        if not self.child_size_cache_enable:
+            return {}
+        size_dict = {}
+        for field_name, section_num in section_fields:
+            child_size = self.child_size_cache.get((cache_prefix, field_name, section_num))
+            if child_size is not None:
+                size_dict[field_name] = child_size
+        return size_dict
+
+    def cache_child_sizes(self, cache_prefix, section_fields, size_dict):
+        """
+        缓存本次统计结果计算出的字段子区间
+        :param cache_prefix:
+        :param section_fields: [(field_name, section_num), ...]
+        :param size_dict: {field_name: (child_section_num, child_section_size)}
+        :return:
+        """
+        if not self.child_size_cache_enable:
+            return
+        for field_name, section_num in section_fields:
+            if field_name in size_dict:
+                self.child_size_cache.set((cache_prefix, field_name, section_num), size_dict[field_name])
+
     def merge_child_sections(self, child_sections, total_doc_count, section_num=0, optimize=True):
         """
         将子区间合并
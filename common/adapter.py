@@ -10,9 +10,13 @@ from elasticsearch import helpers
 import elasticsearch7
 
 from common.admin_config import admin_config
+from common.bulk_controllers import bulk_controller_manager
+from common.bulk_writers import bulk_writer_manager
+from common.caches import analyze_token_cache
 from common.es_routers import es_router
 from common.exceptions import EsBulkOperationError
-from common.utils import get_dict_value_by_path, bind_variable, bind_dict_variable, get_default_es_host, upper_admin_id
+from common.utils import get_dict_value_by_path, bind_variable, bind_dict_variable, get_default_es_host, upper_admin_id, \
+    split_analyze_tokens
 from common.loggers import app_log, debug_log
 from common.configs import config
 from common.connections import EsConnectionFactory, Es7ConnectionFactory
@@ -24,6 +28,8 @@ BATCH_REQUEST_TIMEOUT = config.get_value('consts/global/es_conn_param/batch_requ
 BATCH_TIMEOUT = config.get_value('consts/global/es_conn_param/batch_timeout') or 120000
 INDEX_REQUEST_TIMEOUT = config.get_value('consts/global/es_conn_param/index_request_timeout') or 120
 INDEX_TIMEOUT = config.get_value('consts/global/es_conn_param/index_timeout') or 120000
+# 每次读写都会读取的版本号，使用预先绑定路径的访问句柄
+version_accessor = config.get_accessor('version')
 
 
 class Es7IndexAdapter(object):
@@ -44,11 +50,10 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=input_param or doc_list[0])
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=input_param or doc_list[0])
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, version=version_accessor.get()))
         bulk_body = self.__build_batch_create_body(es_config, doc_list=doc_list, input_index=index)
         try:
-            es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
-                                                                   'timeout': '{}ms'.format(BATCH_TIMEOUT)})
+            es_bulk_result = self.__bulk(es_connection, index, bulk_body)
             return self.process_es_bulk_result(es_bulk_result)
         except elasticsearch7.ElasticsearchException as e:
             app_log.error('ES operation input param is {0}', e, list(bulk_body))
@@ -67,11 +72,10 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=input_param or doc_list[0])
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=input_param or doc_list[0])
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, version=version_accessor.get()))
         bulk_body = self.__build_batch_update_body(es_config, doc_list=doc_list)
         try:
-            es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
-                                                                   'timeout': '{}ms'.format(BATCH_TIMEOUT)})
+            es_bulk_result = self.__bulk(es_connection, index, bulk_body)
             return self.process_es_bulk_result(es_bulk_result)
         except elasticsearch7.ElasticsearchException as e:
             app_log.error('ES operation input param is {0}', e, list(bulk_body))
@@ -101,9 +105,8 @@ class Es7IndexAdapter(object):
 
         try:
             es_connection = Es7ConnectionFactory.get_es_connection(
-                es_config=dict(es_config, index=index, version=config.get_value('version')))
-            es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
-                                                                   'timeout': '{}ms'.format(BATCH_TIMEOUT)})
+                es_config=dict(es_config, index=index, version=version_accessor.get()))
+            es_bulk_result = self.__bulk(es_connection, index, bulk_body)
             return self.process_es_bulk_result(es_bulk_result)
         except elasticsearch7.ElasticsearchException as e:
             app_log.error('ES operation input param is {0}', e, list(bulk_body))
@@ -125,7 +128,7 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=input_param or request_param)
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=input_param or request_param)
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, version=version_accessor.get()))
         separator = es_config['id_process']['separator'] if 'id_process' in es_config and 'separator' in es_config[
             'id_process'] and es_config['id_process']['separator'] else ':'
         ids_str = bind_variable(es_config['id'], request_param)
@@ -135,8 +138,7 @@ class Es7IndexAdapter(object):
         doc_id_list = ids_str.strip().strip(';').split(separator)
         bulk_body = self.__build_batch_delete_body_by_ids(index, doc_id_list)
         try:
-            es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
-                                                                   'timeout': '{}ms'.format(BATCH_TIMEOUT)})
+            es_bulk_result = self.__bulk(es_connection, index, bulk_body)
             return self.process_es_bulk_result(es_bulk_result)
         except elasticsearch7.ElasticsearchException as e:
             app_log.error('ES operation input param is {0}', e, list(bulk_body))
@@ -149,11 +151,10 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=message_parse_result)
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=message_parse_result)
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, version=version_accessor.get()))
         bulk_body = self.__build_batch_delete_body_by_ids(index, doc_id_list)
         try:
-            es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
-                                                                   'timeout': '{}ms'.format(BATCH_TIMEOUT)})
+            es_bulk_result = self.__bulk(es_connection, index, bulk_body)
             return self.process_es_bulk_result(es_bulk_result)
         except elasticsearch7.ElasticsearchException as e:
             app_log.error('es operation input param is {0}', e, list(bulk_body))
@@ -168,7 +169,7 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=doc)
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, version=version_accessor.get()))
         try:
             es_connection.delete_by_query(index=index, body={'query': {'match_all': {}}},
                                           params={'request_timeout': INDEX_REQUEST_TIMEOUT,
@@ -186,7 +187,7 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=doc)
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, version=version_accessor.get()))
         try:
             es_connection.indices.delete_mapping(index=index,
                                                  params={'request_timeout': INDEX_REQUEST_TIMEOUT,
@@ -208,7 +209,7 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=doc)
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, version=config.get_value('version')),
+            es_config=dict(es_config, index=index, version=version_accessor.get()),
             create_index=False)
         try:
             body = body if body else {'query': {'match_all': {}}}
@@ -234,7 +235,7 @@ class Es7IndexAdapter(object):
         es_config = es_router.route(es_config, input_param=doc)
         index, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         es_connection = Es7ConnectionFactory.get_es_connection(
-            es_config=dict(es_config, version=config.get_value('version')),
+            es_config=dict(es_config, version=version_accessor.get()),
             create_index=False)
         try:
             body = {'query': {'terms': {
@@ -257,7 +258,7 @@ class Es7IndexAdapter(object):
         """
         index_template = get_dict_value_by_path('index', es_config)
         id_template = get_dict_value_by_path('id', es_config)
-        version = config.get_value('version')
+        version = version_accessor.get()
         params = dict(kwargs if kwargs else {}, **{'version': version})
         index = bind_variable(index_template, params)
         doc_id = doc_id if doc_id else bind_variable(id_template, params)
@@ -301,6 +302,29 @@ class Es7IndexAdapter(object):
         return [ele['token'] for ele in analyze_result['tokens'] if
                 re.search(keyword_filter_regex, str(ele['token'])) and len(ele['token']) > 1]
 
+    def batch_query_text_analyze_result(self, host, analyzer, text_list, index=None):
+        """
+        批量分词，一次_analyze请求分析多个文本，再根据offset将分词结果拆分到各个文本，不支持过滤
+        :param host:
+        :param analyzer:
+        :param text_list:
+        :param index:
+        :return: 和text_list对应的分词列表
+        """
+        if not text_list:
+            return []
+        es_connection = Es7ConnectionFactory.get_es_connection(host=host)
+        analyze_result = es_connection.indices.analyze(index=index, body={'analyzer': analyzer, 'text': text_list})
+        token_list_list = split_analyze_tokens(text_list, analyze_result['tokens'])
+        if token_list_list is not None:
+            return token_list_list
+
+        # 分词器修改了offset，无法拆分时退化为逐个文本分词
+        app_log.warning('Analyzer {0} offsets cannot be split, analyze texts one by one', analyzer)
+        return [[ele['token'] for ele in
+                 es_connection.indices.analyze(index=index, body={'analyzer': analyzer, 'text': text})['tokens']]
+                for text in text_list]
+
     def query_text_analyze_result_without_filter(self, es_connection, analyzer, text, index=None, host=None):
         """
         对文本进行分词,不支持过滤
@@ -311,8 +335,13 @@ class Es7IndexAdapter(object):
         """
         if not es_connection:
             es_connection = Es7ConnectionFactory.get_es_connection(host=host)
-        analyze_result = es_connection.indices.analyze(index=index, body={'analyzer': analyzer, 'text': text})
-        return list(set([ele['token'] for ele in analyze_result['tokens'] if len(ele['token']) > 0]))
+
+        def analyze():
+            analyze_result = es_connection.indices.analyze(index=index, body={'analyzer': analyzer, 'text': text})
+            return list(set([ele['token'] for ele in analyze_result['tokens'] if len(ele['token']) > 0]))
+
+        cache_host = ','.join(es_connection.host_list) if getattr(es_connection, 'host_list', None) else host
+        return analyze_token_cache.get_tokens(cache_host, index, analyzer, text, analyze)
 
     def multi_search(self, body, host, index=None, doc_type=None):
         """
@@ -451,7 +480,7 @@ class Es7IndexAdapter(object):
         :param admin_id:
         :return:
         """
-        variable_values = {'adminId': admin_id if admin_id else '[\\d\\D]+?', 'version': config.get_value('version')}
+        variable_values = {'adminId': admin_id if admin_id else '[\\d\\D]+?', 'version': version_accessor.get()}
         if admin_id == 'gonghuo':
             sup_shop_es_cfg = config.get_value('/es_index_setting/gonghuo_product')
             return bind_dict_variable(sup_shop_es_cfg, variable_values)
@@ -539,7 +568,7 @@ class Es7IndexAdapter(object):
         spu_setting_key = '/es_index_setting/spu_vip' if admin_config.is_vip(
             admin_id) else '/es_index_setting/spu_experience'
         spu_es_setting = config.get_value(spu_setting_key)
-        params = {'adminId': admin_id, 'version': config.get_value('version')}
+        params = {'adminId': admin_id, 'version': version_accessor.get()}
         return {'index': bind_variable(spu_es_setting.get('index'), params),
                 'type': bind_variable(spu_es_setting.get('type'), params),
                 'id': bind_variable(spu_es_setting.get('id'), params)}
@@ -553,7 +582,7 @@ class Es7IndexAdapter(object):
         sku_setting_key = '/es_index_setting/product_vip' if admin_config.is_vip(
             admin_id) else '/es_index_setting/product_experience'
         sku_es_setting = config.get_value(sku_setting_key)
-        params = {'adminId': admin_id, 'version': config.get_value('version')}
+        params = {'adminId': admin_id, 'version': version_accessor.get()}
         return {'index': bind_variable(sku_es_setting.get('index'), params),
                 'type': bind_variable(sku_es_setting.get('type'), params),
                 'id': bind_variable(sku_es_setting.get('id'), params)}
@@ -645,6 +674,28 @@ class Es7IndexAdapter(object):
     def __build_doc_delete_body_by_id(self, es_index, doc_id):
         return {"delete": {"_index": es_index, "_id": doc_id}}
 
+    def __bulk(self, es_connection, index, bulk_body):
+        """
+        执行bulk操作，开启自适应批量时按照控制器的批量大小切分请求并重试被拒绝的操作，
+        开启bulk合并写入时并发的bulk操作会合并为一次请求，返回结果只包含本次提交的操作
+        :param es_connection:
+        :param index:
+        :param bulk_body:
+        :return:
+        """
+        params = {'request_timeout': BATCH_REQUEST_TIMEOUT, 'timeout': '{}ms'.format(BATCH_TIMEOUT)}
+
+        def send(_bulk_body):
+            if bulk_writer_manager.is_active():
+                _bulk_body = list(_bulk_body)
+                if _bulk_body:
+                    return bulk_writer_manager.write(es_connection, index, _bulk_body, params)
+            return es_connection.bulk(_bulk_body, params=params)
+
+        if bulk_controller_manager.enable:
+            return bulk_controller_manager.bulk(es_connection, index, bulk_body, send)
+        return send(bulk_body)
+
     def process_es_bulk_result(self, bulk_result):
         """
         处理ES bulk操作结果
@@ -724,7 +775,7 @@ class EsIndexAdapter(object):
         es_config = es_router.route(es_config, input_param=input_param or doc_list[0])
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=input_param or doc_list[0])
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()))
         bulk_body = self.__build_batch_create_body(es_config, doc_list=doc_list, input_index=index, input_type=doc_type)
         try:
             es_start_time = time.time()
@@ -749,7 +800,7 @@ class EsIndexAdapter(object):
         es_config = es_router.route(es_config, input_param=input_param or doc_list[0])
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=input_param or doc_list[0])
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()))
         bulk_body = self.__build_batch_update_body(es_config, doc_list=doc_list)
         try:
             es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
@@ -783,7 +834,7 @@ class EsIndexAdapter(object):
 
         try:
             es_connection = EsConnectionFactory.get_es_connection(
-                es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')))
+                es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()))
             es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
                                                                    'timeout': BATCH_TIMEOUT})
             return self.process_es_bulk_result(es_bulk_result)
@@ -807,7 +858,7 @@ class EsIndexAdapter(object):
         es_config = es_router.route(es_config, input_param=input_param or request_param)
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=input_param or request_param)
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()))
         separator = es_config['id_process']['separator'] if 'id_process' in es_config and 'separator' in es_config[
             'id_process'] and es_config['id_process']['separator'] else ':'
         ids_str = bind_variable(es_config['id'], request_param)
@@ -831,7 +882,7 @@ class EsIndexAdapter(object):
         es_config = es_router.route(es_config, input_param=message_parse_result)
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=message_parse_result)
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()))
         bulk_body = self.__build_batch_delete_body_by_ids(index, doc_type, doc_id_list)
         try:
             es_bulk_result = es_connection.bulk(bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
@@ -850,7 +901,7 @@ class EsIndexAdapter(object):
         es_config = es_router.route(es_config, input_param=doc)
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()))
         try:
             es_connection.delete_by_query(index=index, doc_type=doc_type, body={'query': {'match_all': {}}},
                                           params={'request_timeout': INDEX_REQUEST_TIMEOUT, 'timeout': INDEX_TIMEOUT})
@@ -867,7 +918,7 @@ class EsIndexAdapter(object):
         es_config = es_router.route(es_config, input_param=doc)
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')))
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()))
         try:
             es_connection.indices.delete_mapping(index=index, doc_type=doc_type,
                                                  params={'request_timeout': INDEX_REQUEST_TIMEOUT,
@@ -890,7 +941,7 @@ class EsIndexAdapter(object):
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         doc_type = upper_admin_id(doc_type)
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')),
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()),
             create_index=False)
         try:
             body = body if body else {'query': {'match_all': {}}}
@@ -917,7 +968,7 @@ class EsIndexAdapter(object):
         index, doc_type, doc_id = self.get_es_doc_keys(es_config, kwargs=doc)
         doc_type = upper_admin_id(doc_type)
         es_connection = EsConnectionFactory.get_es_connection(
-            es_config=dict(es_config, index=index, type=doc_type, version=config.get_value('version')),
+            es_config=dict(es_config, index=index, type=doc_type, version=version_accessor.get()),
             create_index=False)
         try:
             body = {'query': {'terms': {
@@ -941,7 +992,7 @@ class EsIndexAdapter(object):
         index_template = get_dict_value_by_path('index', es_config)
         type_template = get_dict_value_by_path('type', es_config)
         id_template = get_dict_value_by_path('id', es_config)
-        version = config.get_value('version')
+        version = version_accessor.get()
         params = dict(kwargs if kwargs else {}, **{'version': version})
         index = bind_variable(index_template, params)
         doc_type = bind_variable(type_template, params)
@@ -986,6 +1037,20 @@ class EsIndexAdapter(object):
         return [ele['token'] for ele in analyze_result['tokens'] if
                 re.search(keyword_filter_regex, str(ele['token'])) and len(ele['token']) > 1]
 
+    def batch_query_text_analyze_result(self, host, analyzer, text_list, index=None):
+        """
+        批量分词，ES1.x的_analyze接口只支持单个文本，逐个文本分词，不支持过滤
+        :param host:
+        :param analyzer:
+        :param text_list:
+        :param index:
+        :return: 和text_list对应的分词列表
+        """
+        es_connection = EsConnectionFactory.get_es_connection(host=host)
+        return [[ele['token'] for ele in
+                 es_connection.indices.analyze(index=index, params={'analyzer': analyzer, 'text': text})['tokens']]
+                for text in text_list]
+
     def query_text_analyze_result_without_filter(self, es_connection, analyzer, text, index=None, host=None):
         """
         对文本进行分词,不支持过滤
@@ -1141,7 +1206,7 @@ class EsIndexAdapter(object):
         :param admin_id:
         :return:
         """
-        variable_values = {'adminId': admin_id if admin_id else '[\\d\\D]+?', 'version': config.get_value('version')}
+        variable_values = {'adminId': admin_id if admin_id else '[\\d\\D]+?', 'version': version_accessor.get()}
         if admin_id == 'gonghuo':
             sup_shop_es_cfg = config.get_value('/es_index_setting/gonghuo_product')
             return bind_dict_variable(sup_shop_es_cfg, variable_values)
@@ -1219,7 +1284,7 @@ class EsIndexAdapter(object):
         spu_setting_key = '/es_index_setting/spu_vip' if admin_config.is_vip(
             admin_id) else '/es_index_setting/spu_experience'
         spu_es_setting = config.get_value(spu_setting_key)
-        params = {'adminId': admin_id, 'version': config.get_value('version')}
+        params = {'adminId': admin_id, 'version': version_accessor.get()}
         return {'index': bind_variable(spu_es_setting.get('index'), params),
                 'type': bind_variable(spu_es_setting.get('type'), params),
                 'id': bind_variable(spu_es_setting.get('id'), params)}
@@ -1233,7 +1298,7 @@ class EsIndexAdapter(object):
         sku_setting_key = '/es_index_setting/product_vip' if admin_config.is_vip(
             admin_id) else '/es_index_setting/product_experience'
         sku_es_setting = config.get_value(sku_setting_key)
-        params = {'adminId': admin_id, 'version': config.get_value('version')}
+        params = {'adminId': admin_id, 'version': version_accessor.get()}
         return {'index': bind_variable(sku_es_setting.get('index'), params),
                 'type': bind_variable(sku_es_setting.get('type'), params),
                 'id': bind_variable(sku_es_setting.get('id'), params)}
@@ -30,6 +30,8 @@ class AdminConfig(object):
         self.__write_param_lock = False
         self.__vip_admin_id_dict = {}
         self.__admin_param_dict = {}
+        # vip用户发生变化时递增，用于使依赖vip路由结果的缓存失效
+        self.vip_version = 0
         self.refresh_admin_ids()
         message_bus.add_event_listener(Event.TYPE_VIP_ADMIN_ID_UPDATE, self.refresh_admin_ids)
         message_bus.add_event_listener(Event.TYPE_VIP_ADMIN_PARAMS_UPDATE, self.refresh_admin_params)
@@ -47,6 +49,7 @@ class AdminConfig(object):
             vip_admin_id_dict = {}
             map(lambda admin_id: vip_admin_id_dict.setdefault(admin_id, None), vip_admin_ids)
             self.__vip_admin_id_dict = vip_admin_id_dict
+            self.vip_version += 1
             self.__write_id_lock = False
 
     def refresh_admin_params(self):
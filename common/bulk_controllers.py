@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+ES bulk自适应批量控制，按照(host, index)根据请求耗时和拒绝情况以AIMD方式调整每次bulk请求的操作数目，
+只对被拒绝(429)的操作退避重试，返回结果和原请求的操作一一对应
+"""
+import random
+import threading
+import time
+
+from common.bulk_writers import BULK_ACTIONS_WITHOUT_SOURCE, is_bulk_item_fail
+from common.configs import config
+from common.loggers import app_log
+from common.msg_bus import message_bus, Event
+
+__author__ = 'liuzhaoming'
+
+REJECTED_STATUS = 429
+
+
+def split_bulk_ops(bulk_body):
+    """
+    将bulk请求体切分为操作列表
+    :param bulk_body: [action, source, action, ...]
+    :return: [(action, source), ...]，delete操作的source为None
+    """
+    ops = []
+    body_iter = iter(bulk_body)
+    for action in body_iter:
+        if isinstance(action, dict) and action.keys()[0] in BULK_ACTIONS_WITHOUT_SOURCE:
+            ops.append((action, None))
+        else:
+            ops.append((action, next(body_iter, None)))
+    return ops
+
+
+def join_bulk_ops(ops):
+    bulk_body = []
+    for action, source in ops:
+        bulk_body.append(action)
+        if source is not None:
+            bulk_body.append(source)
+    return bulk_body
+
+
+def is_bulk_item_rejected(op_result):
+    """
+    判断bulk中单个操作是否因为ES写入队列已满被拒绝，被拒绝的操作可以重试
+    :param op_result: {u'index': {u'status': 429, u'_id': u'1', u'error': {...}}}
+    :return:
+    """
+    if not op_result:
+        return False
+    for key in op_result:
+        return op_result[key].get('status') == REJECTED_STATUS
+
+
+def build_rejected_item(action, error):
+    """
+    整个bulk请求被拒绝时为每个操作构造拒绝结果
+    :param action:
+    :param error:
+    :return:
+    """
+    op_type = action.keys()[0] if isinstance(action, dict) and action else 'index'
+    action_meta = (action.get(op_type) or {}) if isinstance(action, dict) else {}
+    return {op_type: {'_index': action_meta.get('_index'), '_id': action_meta.get('_id'), 'status': REJECTED_STATUS,
+                      'error': str(error)}}
+
+
+class AdaptiveBulkController(object):
+    """
+    单个(host, index)的bulk批量控制器。
+    请求没有拒绝并且耗时低于目标值时，批量大小加性增加；出现拒绝或者耗时超过目标值时乘性减小
+    """
+
+    def __init__(self, initial_size=500, min_size=50, max_size=5000, additive_step=50, decrease_factor=0.5,
+                 target_latency=1.0, max_retries=3, retry_base=0.1, retry_max=5.0):
+        self.batch_size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.additive_step = additive_step
+        self.decrease_factor = decrease_factor
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.request_count = 0
+        self.item_count = 0
+        self.rejected_count = 0
+        self.retry_count = 0
+        self.fail_count = 0
+        self.increase_count = 0
+        self.decrease_count = 0
+        # 请求耗时和拒绝率的指数移动平均
+        self.avg_latency = 0.0
+        self.avg_rejected_rate = 0.0
+        self.__lock = threading.Lock()
+
+    def on_response(self, item_count, rejected_count, latency):
+        """
+        根据一次bulk请求的结果调整批量大小
+        :param item_count: 请求中的操作数目
+        :param rejected_count: 被拒绝的操作数目
+        :param latency: 请求耗时，单位秒
+        :return:
+        """
+        with self.__lock:
+            self.request_count += 1
+            self.item_count += item_count
+            self.rejected_count += rejected_count
+            self.avg_latency = self.avg_latency * 0.8 + latency * 0.2
+            self.avg_rejected_rate = self.avg_rejected_rate * 0.8 + float(rejected_count) / max(item_count, 1) * 0.2
+            if rejected_count or latency > self.target_latency:
+                self.batch_size = max(self.min_size, int(self.batch_size * self.decrease_factor))
+                self.decrease_count += 1
+            elif item_count >= self.batch_size:
+                # 只有批量用满时才说明还可以增大
+                self.batch_size = min(self.max_size, self.batch_size + self.additive_step)
+                self.increase_count += 1
+
+    def get_retry_delay(self, retry_times):
+        delay = min(self.retry_max, self.retry_base * (2 ** retry_times))
+        return delay * random.uniform(0.5, 1)
+
+    def bulk(self, bulk_body, send_fun):
+        """
+        按照当前批量大小切分后依次提交，被拒绝的操作退避后重试，重试次数用完后仍然被拒绝的操作保留429结果
+        :param bulk_body:
+        :param send_fun: 提交一次bulk请求的函数，参数为请求体，返回和es_connection.bulk相同格式的结果
+        :return: 和es_connection.bulk相同格式的结果，items和原请求的操作一一对应
+        """
+        ops = split_bulk_ops(bulk_body)
+        items = [None] * len(ops)
+        pending_positions = range(len(ops))
+        took = 0
+        for retry_times in xrange(self.max_retries + 1):
+            if retry_times:
+                time.sleep(self.get_retry_delay(retry_times - 1))
+                with self.__lock:
+                    self.retry_count += len(pending_positions)
+            rejected_positions = []
+            start = 0
+            while start < len(pending_positions):
+                chunk_positions = pending_positions[start:start + self.batch_size]
+                start += len(chunk_positions)
+                took += self.__send_chunk(ops, chunk_positions, items, rejected_positions, send_fun)
+            pending_positions = rejected_positions
+            if not pending_positions:
+                break
+
+        if pending_positions:
+            with self.__lock:
+                self.fail_count += len(pending_positions)
+            app_log.warning('ES bulk operations are still rejected after {0} retries, size={1}', self.max_retries,
+                            len(pending_positions))
+        return {'took': took, 'items': items, 'errors': any(map(is_bulk_item_fail, items))}
+
+    def __send_chunk(self, ops, chunk_positions, items, rejected_positions, send_fun):
+        start_time = time.time()
+        try:
+            bulk_result = send_fun(join_bulk_ops([ops[pos] for pos in chunk_positions]))
+            chunk_items = bulk_result.get('items') or []
+            took = bulk_result.get('took') or 0
+        except Exception as e:
+            if getattr(e, 'status_code', None) != REJECTED_STATUS:
+                raise
+            chunk_items = [build_rejected_item(ops[pos][0], e) for pos in chunk_positions]
+            took = 0
+
+        chunk_rejected_count = 0
+        for pos, item in zip(chunk_positions, chunk_items):
+            items[pos] = item
+            if is_bulk_item_rejected(item):
+                rejected_positions.append(pos)
+                chunk_rejected_count += 1
+        self.on_response(len(chunk_positions), chunk_rejected_count, time.time() - start_time)
+        return took
+
+    def stats(self):
+        """
+        获取批量控制统计信息
+        :return:
+        """
+        return {'batch_size': self.batch_size, 'request_count': self.request_count, 'item_count': self.item_count,
+                'rejected_count': self.rejected_count, 'retry_count': self.retry_count, 'fail_count': self.fail_count,
+                'increase_count': self.increase_count, 'decrease_count': self.decrease_count,
+                'avg_latency_ms': round(self.avg_latency * 1000, 2),
+                'avg_rejected_rate': round(self.avg_rejected_rate, 4)}
+
+
+class BulkControllerManager(object):
+    """
+    按照(host, index)管理bulk批量控制器
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化自适应批量配置，配置变化后重新创建控制器
+        :return:
+        """
+        adaptive_cfg = config.get_value('/consts/global/es_bulk_adaptive') or {}
+        self.enable = adaptive_cfg.get('enable', True)
+        self.controller_params = {'initial_size': adaptive_cfg.get('initial_size') or 500,
+                                  'min_size': adaptive_cfg.get('min_size') or 50,
+                                  'max_size': adaptive_cfg.get('max_size') or 5000,
+                                  'additive_step': adaptive_cfg.get('additive_step') or 50,
+                                  'decrease_factor': adaptive_cfg.get('decrease_factor') or 0.5,
+                                  'target_latency': (adaptive_cfg.get('target_latency_ms') or 1000) / 1000.0,
+                                  'max_retries': adaptive_cfg.get('max_retries', 3),
+                                  'retry_base': (adaptive_cfg.get('retry_base_ms') or 100) / 1000.0,
+                                  'retry_max': (adaptive_cfg.get('retry_max_ms') or 5000) / 1000.0}
+        self.controllers = {}
+
+    def bulk(self, es_connection, index, bulk_body, send_fun):
+        """
+        通过批量控制器提交bulk操作
+        :param es_connection:
+        :param index:
+        :param bulk_body:
+        :param send_fun:
+        :return:
+        """
+        key = (','.join(es_connection.host_list), index)
+        controller = self.controllers.get(key)
+        if controller is None:
+            with self.__lock:
+                controller = self.controllers.get(key)
+                if controller is None:
+                    controller = AdaptiveBulkController(**self.controller_params)
+                    self.controllers[key] = controller
+        return controller.bulk(bulk_body, send_fun)
+
+    def stats(self):
+        """
+        获取所有控制器的统计信息
+        :return:
+        """
+        return dict((u'{0}/{1}'.format(*key), controller.stats()) for key, controller in self.controllers.items())
+
+
+bulk_controller_manager = BulkControllerManager()
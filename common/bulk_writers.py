@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+ES bulk合并写入，多个并发的bulk请求按照(host, index)合并为一次bulk请求，再把每个操作的结果分发回原请求
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+from common.configs import config
+from common.loggers import app_log
+from common.msg_bus import message_bus, Event
+
+__author__ = 'liuzhaoming'
+
+BULK_ACTIONS_WITHOUT_SOURCE = ('delete',)
+
+
+def is_bulk_item_fail(op_result):
+    """
+    判断bulk中单个操作是否失败
+    :param op_result: {u'update': {u'status': 200, u'_id': u'1', u'_index': u'seach_test'}}
+    :return:
+    """
+    if not op_result:
+        return True
+    for key in op_result:
+        return not ('status' in op_result[key] and 200 <= op_result[key]['status'] < 300)
+
+
+def serialize_bulk_body(serializer, bulk_body):
+    """
+    将bulk请求体序列化为行列表，同时计算操作数目
+    :param serializer: ES transport的序列化器
+    :param bulk_body: [action, source, action, ...]
+    :return: (lines, item_count)
+    """
+    lines = []
+    item_count = 0
+    body_iter = iter(bulk_body)
+    for action in body_iter:
+        lines.append(serializer.dumps(action))
+        item_count += 1
+        if isinstance(action, dict) and action.keys()[0] in BULK_ACTIONS_WITHOUT_SOURCE:
+            continue
+        source = next(body_iter, None)
+        if source is not None:
+            lines.append(serializer.dumps(source))
+    return lines, item_count
+
+
+class BulkTicket(object):
+    """
+    一次bulk提交，flush后保存该次提交对应的操作结果或者异常
+    """
+
+    def __init__(self, start, item_count, deadline):
+        self.start = start
+        self.item_count = item_count
+        self.deadline = deadline
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+
+
+class CoalescingBulkWriter(object):
+    """
+    单个(host, index)的bulk合并写入器，达到文档数目、字节数或者等待时间上限时flush。
+    不使用后台线程，由触发条件的提交线程负责flush，其他提交线程等待结果
+    """
+
+    def __init__(self, es_connection, params, max_docs=500, max_bytes=5242880, max_latency=0.05):
+        self.es_connection = es_connection
+        self.params = params
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.flush_count = 0
+        self.flush_item_count = 0
+        self.flush_reasons = {'size': 0, 'latency': 0}
+        self.__lock = threading.Lock()
+        self.__reset()
+
+    def __reset(self):
+        self.__lines = []
+        self.__tickets = []
+        self.__item_count = 0
+        self.__byte_size = 0
+        self.__deadline = None
+
+    def write(self, bulk_body):
+        """
+        提交bulk操作，返回和es_connection.bulk相同格式的结果，只包含本次提交的操作
+        :param bulk_body:
+        :return:
+        """
+        lines, item_count = serialize_bulk_body(self.es_connection.transport.serializer, bulk_body)
+        with self.__lock:
+            if self.__deadline is None:
+                self.__deadline = time.time() + self.max_latency
+            ticket = BulkTicket(self.__item_count, item_count, self.__deadline)
+            self.__lines.extend(lines)
+            self.__tickets.append(ticket)
+            self.__item_count += item_count
+            self.__byte_size += sum(len(line) + 1 for line in lines)
+            is_full = self.__item_count >= self.max_docs or self.__byte_size >= self.max_bytes
+            batch = self.__take_batch() if is_full else None
+
+        if batch:
+            self.__flush(batch, 'size')
+        elif not ticket.event.wait(max(ticket.deadline - time.time(), 0)):
+            with self.__lock:
+                batch = self.__take_batch() if ticket in self.__tickets else None
+            if batch:
+                self.__flush(batch, 'latency')
+            # 其他线程正在flush时等待其完成
+            ticket.event.wait()
+
+        if ticket.error is not None:
+            raise ticket.error
+        return ticket.result
+
+    def __take_batch(self):
+        batch = (self.__lines, self.__tickets)
+        self.__reset()
+        return batch
+
+    def __flush(self, batch, reason):
+        lines, tickets = batch
+        try:
+            bulk_result = self.es_connection.bulk('\n'.join(lines) + '\n', params=self.params)
+            items = bulk_result.get('items') or []
+            for ticket in tickets:
+                ticket_items = items[ticket.start: ticket.start + ticket.item_count]
+                ticket.result = {'took': bulk_result.get('took'), 'items': ticket_items,
+                                 'errors': any(map(is_bulk_item_fail, ticket_items))}
+        except Exception as e:
+            app_log.error('Coalescing bulk flush has error, tickets={0}, items={1}', e, len(tickets),
+                          sum(ticket.item_count for ticket in tickets))
+            for ticket in tickets:
+                ticket.error = e
+        finally:
+            self.flush_count += 1
+            self.flush_item_count += sum(ticket.item_count for ticket in tickets)
+            self.flush_reasons[reason] += 1
+            for ticket in tickets:
+                ticket.event.set()
+
+    def stats(self):
+        """
+        获取合并写入统计信息
+        :return:
+        """
+        return {'flush_count': self.flush_count, 'flush_item_count': self.flush_item_count,
+                'avg_flush_items': round(float(self.flush_item_count) / self.flush_count, 2) if self.flush_count else 0,
+                'flush_reasons': dict(self.flush_reasons)}
+
+
+class BulkWriterManager(object):
+    """
+    按照(host, index)管理bulk合并写入器
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化合并写入配置，配置变化后重新创建写入器
+        :return:
+        """
+        coalesce_cfg = config.get_value('/consts/global/es_bulk_coalesce') or {}
+        self.enable = coalesce_cfg.get('enable', False)
+        self.max_docs = coalesce_cfg.get('max_docs') or 500
+        self.max_bytes = coalesce_cfg.get('max_bytes') or 5242880
+        self.max_latency = (coalesce_cfg.get('max_latency_ms') or 50) / 1000.0
+        self.writers = {}
+
+    def is_active(self):
+        """
+        当前线程是否使用合并写入，全局开启或者在batch_scope中时使用
+        :return:
+        """
+        return self.enable or getattr(self.__local, 'in_batch', False)
+
+    @contextmanager
+    def batch_scope(self):
+        """
+        在当前线程中开启合并写入，用于批量消息处理中并发的分组共享bulk请求，不影响其它线程
+        :return:
+        """
+        in_batch = getattr(self.__local, 'in_batch', False)
+        self.__local.in_batch = True
+        try:
+            yield
+        finally:
+            self.__local.in_batch = in_batch
+
+    def write(self, es_connection, index, bulk_body, params):
+        """
+        通过合并写入器提交bulk操作
+        :param es_connection:
+        :param index:
+        :param bulk_body:
+        :param params: bulk请求参数，同一个写入器使用第一次提交的参数
+        :return:
+        """
+        key = (','.join(es_connection.host_list), index)
+        writer = self.writers.get(key)
+        if writer is None:
+            with self.__lock:
+                writer = self.writers.get(key)
+                if writer is None:
+                    writer = CoalescingBulkWriter(es_connection, params, self.max_docs, self.max_bytes,
+                                                  self.max_latency)
+                    self.writers[key] = writer
+        return writer.write(bulk_body)
+
+    def stats(self):
+        """
+        获取所有写入器的统计信息
+        :return:
+        """
+        return dict((u'{0}/{1}'.format(*key), writer.stats()) for key, writer in self.writers.items())
+
+
+bulk_writer_manager = BulkWriterManager()
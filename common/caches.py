@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+进程内缓存，支持容量上限和过期时间，可选REDIS作为多进程共享的二级缓存
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import ujson as json
+
+from common.configs import config
+from common.connections import RedisConnectionFactory
+from common.loggers import app_log
+from common.msg_bus import message_bus, Event
+from search_platform.settings import SERVICE_BASE_CONFIG
+
+__author__ = 'liuzhaoming'
+
+_MISSING = object()
+
+
+class TtlLruCache(object):
+    """
+    带过期时间的LRU缓存，线程安全
+    """
+
+    def __init__(self, max_size=1000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        获取缓存值，过期或者不存在时返回default
+        :param key:
+        :param default:
+        :return:
+        """
+        with self.__lock:
+            item = self.__data.pop(key, _MISSING)
+            if item is _MISSING or (self.ttl and item[1] < time.time()):
+                self.misses += 1
+                return default
+            # 重新插入，保证最近访问的元素在末尾
+            self.__data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        设置缓存值，超过容量时淘汰最久未访问的元素
+        :param key:
+        :param value:
+        :param ttl: 单独指定过期时间，单位秒
+        :return:
+        """
+        if self.max_size <= 0:
+            return
+        expire_time = time.time() + (ttl or self.ttl)
+        with self.__lock:
+            self.__data.pop(key, None)
+            self.__data[key] = (value, expire_time)
+            while len(self.__data) > self.max_size:
+                self.__data.popitem(last=False)
+
+    def delete(self, key):
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def stats(self):
+        """
+        获取缓存统计信息
+        :return:
+        """
+        total = self.hits + self.misses
+        return {'size': len(self.__data), 'max_size': self.max_size, 'ttl': self.ttl, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': round(float(self.hits) / total, 4) if total else 0}
+
+
+class AnalyzeTokenCache(object):
+    """
+    分词结果缓存，key为(host, index, analyzer, text)，分词词典更新时失效
+    """
+    REDIS_KEY_PREFIX = 'sp_analyze_token_'
+
+    def __init__(self):
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+        message_bus.add_event_listener(Event.TYPE_ANALYZE_CACHE_CLEAR, self.clear_local)
+
+    def init_config(self):
+        """
+        初始化缓存配置
+        :return:
+        """
+        cache_cfg = config.get_value('/consts/global/analyze_cache') or {}
+        self.enable = cache_cfg.get('enable', True)
+        self.local_cache = TtlLruCache(cache_cfg.get('max_size') or 5000, cache_cfg.get('ttl') or 600)
+        self.redis_conn = None
+        if cache_cfg.get('redis_enable'):
+            redis_host = cache_cfg.get('redis_host') or SERVICE_BASE_CONFIG.get('redis')
+            self.redis_conn = RedisConnectionFactory.get_redis_connection(redis_host)
+        self.redis_hits = 0
+
+    def get_tokens(self, host, index, analyzer, text, analyze_fun):
+        """
+        获取分词结果，缓存中没有时调用analyze_fun并写入缓存
+        :param host:
+        :param index:
+        :param analyzer:
+        :param text:
+        :param analyze_fun: 无参函数，返回分词结果列表
+        :return:
+        """
+        if not self.enable:
+            return analyze_fun()
+        key = (host, index, analyzer, text)
+        tokens = self.get_cached(key)
+        if tokens is None:
+            tokens = analyze_fun()
+            self.set_cached(key, tokens)
+        return list(tokens)
+
+    def get_cached(self, key):
+        """
+        获取缓存的分词结果，依次查询本地缓存和REDIS，没有时返回None
+        :param key: 分词结果key，不同格式的分词结果需要使用不同的key前缀
+        :return:
+        """
+        if not self.enable:
+            return None
+        tokens = self.local_cache.get(key)
+        if tokens is not None:
+            return list(tokens)
+
+        redis_key = self.__get_redis_key(key) if self.redis_conn else None
+        if redis_key:
+            try:
+                redis_value = self.redis_conn.get(redis_key)
+                if redis_value is not None:
+                    tokens = json.loads(redis_value)
+                    self.redis_hits += 1
+                    self.local_cache.set(key, tuple(tokens))
+                    return list(tokens)
+            except Exception as e:
+                app_log.error('Get analyze tokens from redis has error, key={0}', e, redis_key)
+        return None
+
+    def set_cached(self, key, tokens):
+        """
+        写入分词结果，分词词典更新时和其它分词结果一起失效
+        :param key:
+        :param tokens:
+        :return:
+        """
+        if not self.enable:
+            return
+        if self.redis_conn:
+            redis_key = self.__get_redis_key(key)
+            try:
+                self.redis_conn.setex(redis_key, json.dumps(tokens), self.local_cache.ttl)
+            except Exception as e:
+                app_log.error('Set analyze tokens to redis has error, key={0}', e, redis_key)
+        self.local_cache.set(key, tuple(tokens))
+
+    def invalidate(self):
+        """
+        分词词典变化时清空缓存，并通知所有进程清空本地缓存
+        :return:
+        """
+        if self.redis_conn:
+            try:
+                redis_keys = list(self.redis_conn.scan_iter(match=self.REDIS_KEY_PREFIX + '*', count=1000))
+                if redis_keys:
+                    self.redis_conn.delete(*redis_keys)
+            except Exception as e:
+                app_log.error('Clear analyze tokens from redis has error', e)
+        self.clear_local()
+        message_bus.publish(Event.TYPE_ANALYZE_CACHE_CLEAR, source='', body='')
+
+    def clear_local(self):
+        """
+        清空本进程缓存
+        :return:
+        """
+        self.local_cache.clear()
+
+    def stats(self):
+        """
+        获取缓存命中统计
+        :return:
+        """
+        cache_stats = self.local_cache.stats()
+        cache_stats['redis_hits'] = self.redis_hits
+        cache_stats['enable'] = self.enable
+        cache_stats['redis_enable'] = self.redis_conn is not None
+        return cache_stats
+
+    def __get_redis_key(self, key):
+        key_str = u'|||'.join(map(lambda item: item if isinstance(item, unicode) else unicode(str(item), 'utf-8'),
+                                  key))
+        return self.REDIS_KEY_PREFIX + hashlib.md5(key_str.encode('utf-8')).hexdigest()
+
+
+analyze_token_cache = AnalyzeTokenCache()
+
+
+class QueryResultCache(object):
+    """
+    查询结果缓存，key为(adminId, index, doc_type, 处理器查询配置摘要, 规范化后的查询参数)。
+    每个adminId有一个保存在REDIS中的版本号，写操作递增版本号使该用户的所有缓存失效，
+    本地缓存版本号并按照gen_check_interval定期从REDIS刷新。
+    ES写入的数据在下次refresh之后才能查询到，写入后refresh_delay秒再递增一次版本号，
+    丢弃refresh之前查询并缓存的旧结果
+    """
+    REDIS_GEN_KEY_PREFIX = 'sp_query_result_gen_'
+    REDIS_KEY_PREFIX = 'sp_query_result_'
+
+    def __init__(self):
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化缓存配置
+        :return:
+        """
+        cache_cfg = config.get_value('/consts/query/result_cache') or {}
+        self.enable = cache_cfg.get('enable', False)
+        self.default_ttl = cache_cfg.get('ttl') or 5
+        self.backend = cache_cfg.get('backend') or 'local'
+        self.gen_check_interval = cache_cfg.get('gen_check_interval') or 1
+        self.refresh_delay = cache_cfg.get('refresh_delay', 1)
+        self.local_cache = TtlLruCache(cache_cfg.get('max_size') or 10000, self.default_ttl)
+        # adminId -> (版本号, 上次从REDIS刷新的时间)
+        self.admin_gen_dict = {}
+        self.redis_conn = None
+        if self.enable:
+            redis_host = cache_cfg.get('redis_host') or SERVICE_BASE_CONFIG.get('redis')
+            self.redis_conn = RedisConnectionFactory.get_redis_connection(redis_host)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # adminId -> 最后一次写操作的时间，等待ES refresh之后再次递增版本号
+        self.pending_invalidate_dict = {}
+        self.pending_lock = threading.Lock()
+
+    def get_ttl(self, es_config, args=None):
+        """
+        获取缓存时间，处理器destination中配置的result_cache_ttl优先，为0表示不缓存；自定义查询体(ex_body_type)的查询不缓存
+        :param es_config:
+        :param args:
+        :return:
+        """
+        if not self.enable or (args and args.get('ex_body_type')):
+            return 0
+        ttl = es_config.get('result_cache_ttl')
+        return self.default_ttl if ttl is None else ttl
+
+    @staticmethod
+    def get_config_digest(query_config):
+        """
+        计算处理器查询配置的摘要，配置中包含索引设置，应该在配置变化时计算一次并随配置缓存，不要每次请求计算
+        :param query_config:
+        :return:
+        """
+        return hashlib.md5(json.dumps(query_config, sort_keys=True)).hexdigest()
+
+    def get_or_query(self, admin_id, index, args, ttl, query_fun, doc_type=None, config_digest=None):
+        """
+        获取缓存的查询结果，缓存中没有时调用query_fun并写入缓存
+        :param admin_id:
+        :param index:
+        :param args:
+        :param ttl:
+        :param query_fun: 无参函数，返回查询结果
+        :param doc_type:
+        :param config_digest: 处理器查询配置的摘要，相同参数在不同处理器中的查询结果不同
+        :return:
+        """
+        if not admin_id or not ttl or ttl <= 0:
+            return query_fun()
+        admin_id = admin_id.lower()
+        cache_key = self.__get_cache_key(admin_id, index, doc_type, config_digest, args)
+        str_result = self.__get(cache_key)
+        if str_result is not None:
+            self.hits += 1
+            return json.loads(str_result)
+
+        self.misses += 1
+        result = query_fun()
+        try:
+            self.__set(cache_key, json.dumps(result), ttl)
+        except Exception as e:
+            app_log.error('Set query result cache has error, key={0}', e, cache_key)
+        return result
+
+    def invalidate(self, admin_id):
+        """
+        用户数据变化时递增版本号，使该用户所有缓存失效，ES refresh之后再递增一次
+        :param admin_id:
+        :return:
+        """
+        if not self.enable or not admin_id:
+            return
+        admin_id = admin_id.lower()
+        self.invalidations += 1
+        self.__incr_admin_gen(admin_id)
+        if self.refresh_delay <= 0:
+            return
+        with self.pending_lock:
+            # 同一用户连续写入时只保留一个定时器，定时器到期时根据最后一次写入时间决定是否继续等待
+            has_pending = admin_id in self.pending_invalidate_dict
+            self.pending_invalidate_dict[admin_id] = time.time()
+        if not has_pending:
+            self.__start_delay_invalidate(admin_id, self.refresh_delay)
+
+    def stats(self):
+        """
+        获取缓存命中统计
+        :return:
+        """
+        total = self.hits + self.misses
+        return {'enable': self.enable, 'backend': self.backend, 'default_ttl': self.default_ttl, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': round(float(self.hits) / total, 4) if total else 0,
+                'invalidations': self.invalidations, 'local_size': len(self.local_cache)}
+
+    def __incr_admin_gen(self, admin_id):
+        try:
+            gen = self.redis_conn.incr(self.REDIS_GEN_KEY_PREFIX + admin_id)
+        except Exception as e:
+            app_log.error('Invalidate query result cache has error, admin_id={0}', e, admin_id)
+            gen = self.admin_gen_dict.get(admin_id, (0, 0))[0] + 1
+        self.admin_gen_dict[admin_id] = (gen, time.time())
+
+    def __start_delay_invalidate(self, admin_id, delay):
+        timer = threading.Timer(delay, self.__delay_invalidate, (admin_id,))
+        timer.setDaemon(True)
+        timer.start()
+
+    def __delay_invalidate(self, admin_id):
+        """
+        ES refresh之后再次递增版本号
+        :param admin_id:
+        :return:
+        """
+        with self.pending_lock:
+            # 配置更新重新初始化后记录已经清空，直接递增版本号
+            remain_delay = self.pending_invalidate_dict.get(admin_id, 0) + self.refresh_delay - time.time()
+            if remain_delay <= 0:
+                self.pending_invalidate_dict.pop(admin_id, None)
+        if remain_delay > 0:
+            self.__start_delay_invalidate(admin_id, remain_delay)
+        else:
+            self.__incr_admin_gen(admin_id)
+
+    def __get_admin_gen(self, admin_id):
+        gen, check_time = self.admin_gen_dict.get(admin_id, (None, 0))
+        cur_time = time.time()
+        if gen is None or cur_time - check_time >= self.gen_check_interval:
+            try:
+                gen = int(self.redis_conn.get(self.REDIS_GEN_KEY_PREFIX + admin_id) or 0)
+            except Exception as e:
+                app_log.error('Get query result cache gen has error, admin_id={0}', e, admin_id)
+                gen = gen or 0
+            self.admin_gen_dict[admin_id] = (gen, cur_time)
+        return gen
+
+    def __get_cache_key(self, admin_id, index, doc_type, config_digest, args):
+        if hasattr(args, 'getlist'):
+            items = sorted((key, tuple(args.getlist(key))) for key in args.iterkeys())
+        else:
+            items = sorted((args or {}).iteritems())
+        args_digest = hashlib.md5(json.dumps([index, doc_type, config_digest, items], sort_keys=True)).hexdigest()
+        return '{0}{1}_{2}_{3}'.format(self.REDIS_KEY_PREFIX, admin_id, self.__get_admin_gen(admin_id), args_digest)
+
+    def __get(self, cache_key):
+        if self.backend != 'redis':
+            return self.local_cache.get(cache_key)
+        try:
+            return self.redis_conn.get(cache_key)
+        except Exception as e:
+            app_log.error('Get query result cache has error, key={0}', e, cache_key)
+            return None
+
+    def __set(self, cache_key, str_result, ttl):
+        if self.backend != 'redis':
+            self.local_cache.set(cache_key, str_result, ttl)
+        else:
+            self.redis_conn.setex(cache_key, str_result, ttl)
+
+
+query_result_cache = QueryResultCache()
@@ -17,6 +17,8 @@ from common.loggers import LOGGER_LEVELS, app_log
 
 __author__ = 'liuzhaoming'
 
+_MISSING = object()
+
 
 def get_config(key=None):
     """
@@ -112,6 +114,7 @@ class ConfigHolder(object):
             for logger_type in data:
                 if logger_type in logger_config and data[logger_type].upper() in LOGGER_LEVELS:
                     logger_config[logger_type]['level'] = data[logger_type].upper()
+            config.invalidate()
 
 
     def synchronize_config(self, source='es', destination='cache', is_sys_start=False):
@@ -233,15 +236,43 @@ class ConfigHolder(object):
             return True
 
 
+class ConfigAccessor(object):
+    """
+    预先绑定路径的配置访问句柄，配置版本不变时直接返回上次的结果，适合热点代码持有
+    """
+
+    def __init__(self, config_data, path, admin_id=None):
+        self.config = config_data
+        self.path = path
+        self.admin_id = admin_id
+        self.__version = None
+        self.__value = None
+
+    def get(self, default=None):
+        if self.__version != self.config.version:
+            # 先读取版本再取值，取值过程中配置发生变化时下次会重新获取
+            version = self.config.version
+            self.__value = self.config.get_value(self.path, self.admin_id)
+            self.__version = version
+        return default if self.__value is None else self.__value
+
+
 class Config(object):
     """
     配置文件，采用单例方式
     """
     __cache = {}
     __backup_cache = {}
+    # 路径解析结果缓存的最大数目，超过后清空
+    VALUE_CACHE_MAX_SIZE = 100000
 
     def __init__(self, config_file_path=BASE_DIR + SERVICE_BASE_CONFIG['meta_file']):
         self.__config_file_path = config_file_path
+        # 编译后的路径，path -> key元组，和配置数据无关，不需要失效
+        self.__compiled_paths = {}
+        self.version = 0
+        # 配置数据和路径解析结果缓存作为一个元组整体替换，保证读取时两者一致
+        self.__state = (self.__cache, {})
         # self.__add_file_monitor()
 
     def get_config_file_path(self):
@@ -255,7 +286,7 @@ class Config(object):
 
     def set_config(self, config_data):
         self.__backup_cache = config_data
-        self.__cache, self.__backup_cache = self.__backup_cache, self.__cache
+        self.__swap_cache(self.__backup_cache, self.__cache)
 
     def refresh(self):
         """
@@ -265,7 +296,7 @@ class Config(object):
         try:
             f = open(self.__config_file_path, 'r')
             self.__backup_cache = load(f, 'utf8')
-            self.__cache, self.__backup_cache = self.__backup_cache, self.__cache
+            self.__swap_cache(self.__backup_cache, self.__cache)
             app_log.info('__cache=' + str(self.__cache))
             app_log.info('__backup_cache=' + str(self.__backup_cache))
             f.close()
@@ -277,36 +308,72 @@ class Config(object):
         缓存中的数据回滚到上一个版本,回滚只支持一次
         :return:
         """
-        self.__cache = self.__backup_cache or self.__cache
+        self.__swap_cache(self.__backup_cache or self.__cache, self.__backup_cache)
+
+    def invalidate(self):
+        """
+        配置数据被原地修改后清空路径解析结果缓存
+        :return:
+        """
+        self.__state = (self.__cache, {})
+        self.version += 1
 
     def get_value(self, path, admin_id=None):
         if not path:
             return None
-        default_key_list = filter(lambda key: key, '/'.join(('default', path)).split('/'))
-        admin_key_list = filter(lambda key: key, '/'.join((str(admin_id), path)).split('/'))
-        admin_value = self.__get_value_from_dict(self.__cache, admin_key_list)
-        return admin_value if admin_value is not None else self.__get_value_from_dict(self.__cache,
-                                                                                      default_key_list)
+        cache, value_cache = self.__state
+        cache_key = (path, admin_id)
+        value = value_cache.get(cache_key, _MISSING)
+        if value is _MISSING:
+            key_tuple = self.__compile_path(path)
+            value = self.__get_value_from_dict(cache, (str(admin_id),) + key_tuple)
+            if value is None:
+                value = self.__get_value_from_dict(cache, ('default',) + key_tuple)
+            if len(value_cache) >= self.VALUE_CACHE_MAX_SIZE:
+                value_cache.clear()
+            value_cache[cache_key] = value
+        return value
+
+    def get_accessor(self, path, admin_id=None):
+        """
+        获取预先绑定路径的配置访问句柄
+        :param path:
+        :param admin_id:
+        :return:
+        """
+        return ConfigAccessor(self, path, admin_id)
 
     def update_value(self, path, value):
         if not path:
             return None
         set_dict_value_by_path('/default/' + path, self.__cache, value)
+        self.invalidate()
+
+    def __swap_cache(self, cache, backup_cache):
+        self.__cache, self.__backup_cache = cache, backup_cache
+        self.invalidate()
+
+    def __compile_path(self, path):
+        key_tuple = self.__compiled_paths.get(path)
+        if key_tuple is None:
+            key_tuple = tuple(key for key in path.split('/') if key)
+            if len(self.__compiled_paths) >= self.VALUE_CACHE_MAX_SIZE:
+                self.__compiled_paths.clear()
+            self.__compiled_paths[path] = key_tuple
+        return key_tuple
+
     def __get_value_from_dict(self, data_dict, key_list):
         """
-        递归从字典中获取值
+        从字典中逐级获取值
         :param data_dict:
         :param key_list:
         :return:
         """
-        if not key_list or not data_dict:
-            return None
-        elif len(key_list) == 1:
-            return data_dict[key_list[0]] if key_list[0] in data_dict else None
-        else:
-            return self.__get_value_from_dict(data_dict[key_list[0]], key_list[1:]) \
-                if key_list[0] in data_dict else None
-
+        for key in key_list:
+            if not data_dict or key not in data_dict:
+                return None
+            data_dict = data_dict[key]
+        return data_dict if key_list else None
 
     def __add_file_monitor(self):
         """
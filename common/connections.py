@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import errno
+import random
+import socket
 import threading
+import time
+
 from kazoo.client import KazooClient
 from pykafka import KafkaClient
 import redis
+import urllib3
 from elasticsearch import Elasticsearch, Transport, ElasticsearchException, TransportError
 # elasticsearch7.5.2版本的依赖通过直接引入库源码的方式实现
 import elasticsearch7
@@ -334,6 +340,121 @@ class KafkaClientPool(object):
 
 
 KafkaClientFactory = KafkaClientPool()
+
+
+class HttpConnectionPool(object):
+    """
+    HTTP长连接池，每个host一个urllib3连接池，复用keep-alive连接并限制每个host的并发连接数
+    """
+    # 可以重试的HTTP状态码，一般是上游服务暂时不可用
+    RETRY_STATUSES = (502, 503, 504)
+    # 幂等的HTTP方法，请求已经发送后出错也可以重试
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    # 请求发送之前的错误，所有方法都可以重试，NewConnectionError在urllib3 1.10中不存在
+    CONNECT_ERRORS = tuple(filter(None, (getattr(urllib3.exceptions, name, None) for name in (
+        'ConnectTimeoutError', 'NewConnectionError', 'EmptyPoolError'))))
+    # urllib3 1.10建立连接失败时抛出包装socket.error的ProtocolError，根据错误码判断请求是否已经发送
+    CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+    def __init__(self):
+        self.http_pool_dict = {}
+        self.mutex = threading.Lock()
+        self.retry_count = 0
+        self.fail_count = 0
+
+    def get_http_pool(self, host, maxsize=10, block=True):
+        """
+        获取host对应的连接池，连接池参数以第一次创建时为准
+        :param host: 192.168.1.1:8080
+        :param maxsize: 每个host的最大连接数
+        :param block: 连接数达到上限时是否等待，不等待时会创建不放回连接池的临时连接
+        :return:
+        """
+        http_pool = self.http_pool_dict.get(host)
+        if http_pool is None:
+            with self.mutex:
+                http_pool = self.http_pool_dict.get(host)
+                if http_pool is None:
+                    http_pool = urllib3.connection_from_url('http://' + host, maxsize=maxsize, block=block)
+                    self.http_pool_dict[host] = http_pool
+        return http_pool
+
+    def request(self, host, method, url, body=None, headers=None, connect_timeout=3, read_timeout=60, retries=2,
+                retry_backoff=0.1, gzip=True, maxsize=10, pool_timeout=10):
+        """
+        发送HTTP请求，连接错误和502/503/504时按照指数退避加随机抖动重试；
+        POST等非幂等请求在读取超时、连接中断时可能已经被服务端执行，只有幂等方法才重试这些错误
+        :param host:
+        :param method:
+        :param url:
+        :param body:
+        :param headers:
+        :param connect_timeout: 建立连接超时时间，单位秒
+        :param read_timeout: 读取响应超时时间，单位秒
+        :param retries: 失败后重试次数
+        :param retry_backoff: 第一次重试前等待的时间，单位秒
+        :param gzip: 是否接受gzip压缩的响应
+        :param maxsize: 每个host的最大连接数
+        :param pool_timeout: 连接数达到上限时等待空闲连接的时间，单位秒
+        :return: 响应内容
+        """
+        http_pool = self.get_http_pool(host, maxsize)
+        headers = dict(headers or {})
+        if gzip:
+            headers['Accept-Encoding'] = 'gzip'
+        timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        attempt = 0
+        while True:
+            try:
+                response = http_pool.urlopen(method, url, body=body, headers=headers, timeout=timeout, retries=False,
+                                             pool_timeout=pool_timeout)
+                if response.status not in self.RETRY_STATUSES:
+                    return response.data
+                error = urllib3.exceptions.HTTPError('HTTP status {0}'.format(response.status))
+            except (urllib3.exceptions.HTTPError, IOError) as e:
+                error = e
+                if method.upper() not in self.IDEMPOTENT_METHODS and not self.is_connect_error(e):
+                    self.fail_count += 1
+                    raise
+            if attempt >= retries:
+                self.fail_count += 1
+                raise error
+            attempt += 1
+            self.retry_count += 1
+            app_log.warning('Http request fail, retry {0} times, host={1}, url={2}, error={3}', attempt, host, url,
+                            error)
+            time.sleep(retry_backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def is_connect_error(self, error):
+        """
+        是否是请求发送之前的连接错误
+        :param error:
+        :return:
+        """
+        if isinstance(error, urllib3.exceptions.MaxRetryError):
+            error = error.reason
+        if isinstance(error, self.CONNECT_ERRORS):
+            return True
+        if isinstance(error, urllib3.exceptions.ProtocolError) and len(error.args) > 1:
+            socket_error = error.args[1]
+            return isinstance(socket_error, socket.gaierror) or (
+                isinstance(socket_error, socket.error) and socket_error.errno in self.CONNECT_ERRNOS)
+        return False
+
+    def stats(self):
+        """
+        获取连接池统计信息
+        :return:
+        """
+        pool_stats = {}
+        for host, http_pool in self.http_pool_dict.items():
+            pool_stats[host] = {'num_connections': http_pool.num_connections, 'num_requests': http_pool.num_requests,
+                                'idle_connections': http_pool.pool.qsize() if http_pool.pool else 0,
+                                'maxsize': http_pool.pool.maxsize if http_pool.pool else 0}
+        return {'pools': pool_stats, 'retry_count': self.retry_count, 'fail_count': self.fail_count}
+
+
+HttpConnectionFactory = HttpConnectionPool()
 if __name__ == '__main__':
     es_config = {'host': 'http://172.19.65.66:9200,http://172.19.65.79:9200', 'index': 'test-aaa', 'type': 'test-type',
                  'mapping': {"properties": {"category": {"index": "not_analyzed", "type": "string"}}}}
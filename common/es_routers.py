@@ -14,6 +14,10 @@ from common.utils import get_dict_value_by_path, bind_variable, merge
 
 __author__ = 'liuzhaoming'
 
+# 每次路由都会读取的配置，使用预先绑定路径的访问句柄
+_custom_variables_accessor = config.get_accessor('consts/custom_variables')
+_version_accessor = config.get_accessor('version')
+
 
 class DestinationRouter(object):
     def route(self, destination_cfg, input_param=None):
@@ -55,7 +59,7 @@ class RandomDestinationRouter(DestinationRouter):
             app_log.error('destination_cfg is invalid {0}', destination_cfg)
             return None
 
-        index = random.randint(0, len(destination_cfg['router']['target']))
+        index = random.randint(0, len(destination_cfg['router']['target']) - 1)
         return destination_cfg['router']['target'][index]
 
     def get_host(self, destination_cfg, input_param=None):
@@ -65,7 +69,7 @@ class RandomDestinationRouter(DestinationRouter):
             return ''
 
         host_str = destination_target['host']
-        variable_values = config.get_value('consts/custom_variables')
+        variable_values = _custom_variables_accessor.get()
         if host_str and variable_values:
             return host_str.format(**variable_values)
         return host_str
@@ -78,7 +82,7 @@ class RandomDestinationRouter(DestinationRouter):
         index_template = get_dict_value_by_path('index', destination_target)
         type_template = get_dict_value_by_path('type', destination_target)
         id_template = get_dict_value_by_path('id', destination_target)
-        version = config.get_value('version')
+        version = _version_accessor.get()
         params = dict(input_param if input_param else {}, **{'version': version})
         index = bind_variable(index_template, params)
         doc_type = bind_variable(type_template, params)
@@ -186,6 +190,14 @@ class RouterProxy(DestinationRouter):
         router = self.__get_router(destination_cfg)
         return router.get_es_doc_keys(destination_cfg, input_param)
 
+    def is_deterministic(self, destination_cfg):
+        """
+        路由结果是否只和配置、vip用户和输入参数相关，随机路由每次调用结果不同，结果不能缓存
+        :param destination_cfg:
+        :return:
+        """
+        return self.__get_router(destination_cfg) is not random_router
+
     def merge_es_config(self, destination_config):
         """
         合并引用和实际的配置，以实际的为准
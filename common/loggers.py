@@ -1,6 +1,12 @@
 # coding=utf-8
+import atexit
 import logging
+import random
 import sys
+import threading
+import time
+import Queue
+from repr import Repr
 
 import ujson as json
 from itertools import chain
@@ -13,6 +19,11 @@ __author__ = 'liuzhaoming'
 # 日志等级
 LOGGER_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
 _error_logger = logging.getLogger('error')
+# 截断日志内容时只描述容器的部分元素
+_payload_repr = Repr()
+_payload_repr.maxlevel = 4
+_payload_repr.maxdict = _payload_repr.maxlist = _payload_repr.maxtuple = _payload_repr.maxset = 20
+_payload_repr.maxstring = _payload_repr.maxother = 200
 
 
 def get_caller_info(level=2):
@@ -30,43 +41,251 @@ def get_caller_info(level=2):
     return '{0}[line:{1}]'.format(file_name, line_number)
 
 
-class AppLog(object):
+class QueueLogHandler(logging.Handler):
+    """
+    将日志记录放入队列，由后台线程调用原有的handler写入，队列满时丢弃日志，不阻塞业务线程；
+    ERROR及以上级别的日志不进入队列，在业务线程中直接写入，不会被丢弃
+    """
+
+    def __init__(self, writer, handlers):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.handlers = handlers
+
+    def emit(self, record):
+        try:
+            # 在业务线程中完成消息格式化，避免后台线程访问可能已经变化的参数
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            if record.levelno >= logging.ERROR:
+                self.writer.write(self.handlers, record)
+            else:
+                self.writer.put(self.handlers, record)
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncLogWriter(object):
+    """
+    异步日志写入器，替换指定日志记录器的handler，文件和REDIS等IO在后台线程中执行。
+    写入线程是守护线程，进程退出时最多等待flush_timeout秒写完队列中的日志
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.dropped = 0
+        self.flush_timeout = 2
+        self.__lock = threading.Lock()
+        self.__queue = None
+
+    def start(self):
+        """
+        根据consts/logger/async_writer配置安装异步handler，重复调用只会安装一次
+        :return:
+        """
+        from common.configs import config
+
+        writer_cfg = config.get_value('consts/logger/async_writer') or {}
+        if not writer_cfg.get('enable', True):
+            return
+        self.install(writer_cfg.get('loggers') or ('app', 'error', 'interface', 'listener', 'debug', 'query'),
+                     writer_cfg.get('queue_size') or 10000, writer_cfg.get('flush_timeout', 2))
+
+    def install(self, logger_names, queue_size, flush_timeout=2):
+        """
+        为日志记录器安装异步handler，第一次安装时注册进程退出时的日志刷新
+        :param logger_names:
+        :param queue_size:
+        :param flush_timeout: 进程退出时等待日志写入的最长时间，单位秒
+        :return:
+        """
+        with self.__lock:
+            self.flush_timeout = flush_timeout
+            if self.__queue is None:
+                self.__queue = Queue.Queue(queue_size)
+                atexit.register(self.flush)
+                for logger_name in logger_names:
+                    logger = logging.getLogger(logger_name)
+                    if logger.handlers and not any(isinstance(handler, QueueLogHandler) for handler in
+                                                   logger.handlers):
+                        logger.handlers = [QueueLogHandler(self, logger.handlers)]
+            self.__ensure_thread()
+
+    def put(self, handlers, record):
+        if self.pid != os.getpid():
+            # fork之后子进程中没有写入线程，需要重新启动
+            with self.__lock:
+                self.__ensure_thread()
+        try:
+            self.__queue.put_nowait((handlers, record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        """
+        等待队列中的日志写入完成
+        :param timeout: 最长等待时间，单位秒，默认为flush_timeout
+        :return: 是否全部写入
+        """
+        log_queue = self.__queue
+        if log_queue is None or self.pid != os.getpid():
+            return True
+        end_time = time.time() + (self.flush_timeout if timeout is None else timeout)
+        while log_queue.unfinished_tasks:
+            if time.time() >= end_time:
+                return False
+            time.sleep(0.01)
+        return True
+
+    @staticmethod
+    def write(handlers, record):
+        for handler in handlers:
+            try:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            except Exception:
+                handler.handleError(record)
+
+    def stats(self):
+        return {'queue_size': self.__queue.qsize() if self.__queue else 0, 'dropped': self.dropped}
+
+    def __ensure_thread(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.__queue = Queue.Queue(self.__queue.maxsize)
+        thread = threading.Thread(target=self.__write_loop, args=(self.__queue,), name='async_log_writer')
+        thread.daemon = True
+        thread.start()
+
+    def __write_loop(self, log_queue):
+        while True:
+            handlers, record = log_queue.get()
+            try:
+                self.write(handlers, record)
+            finally:
+                log_queue.task_done()
+
+
+class BaseLog(object):
+    """
+    日志基类，从consts/logger/<config_name>中读取日志级别、最大长度和采样率，
+    级别检查通过之后才会格式化消息和获取调用者信息
+    """
+    logger = None
+    config_name = None
+
+    def __init__(self):
+        self.__has_init = False
+        self.int_log_level = logging.NOTSET
+        self.max_length = 0
+        self.sample_rate = 1
+
+    def init_config(self):
+        # 消除循环依赖，配置模块初始化过程中也会打印日志，此时使用默认配置，下次打印日志时再初始化
+        try:
+            from common.configs import config
+            from common.msg_bus import message_bus, Event
+        except ImportError:
+            return
+        # 注册监听器时也会打印日志，先设置初始化标志，避免重复进入初始化
+        self.__has_init = True
+        self.update_log_level()
+        message_bus.add_event_listener(Event.TYPE_UPDATE_LOG_LEVEL, self.update_log_level)
+        async_log_writer.start()
+
+    def update_log_level(self):
+        from common.configs import config
+
+        logger_cfg = config.get_value('consts/logger/{0}'.format(self.config_name)) or {}
+        self.log_level = logger_cfg.get('level')
+        self.int_log_level = logging._levelNames[self.log_level] if self.log_level else logging.NOTSET
+        self.max_length = logger_cfg.get('max_length') or 0
+        self.sample_rate = logger_cfg.get('sample_rate', 1)
+
+    def ensure_config(self):
+        if not self.__has_init:
+            self.init_config()
+
+    def is_enabled_for(self, level, sample=False):
+        """
+        判断是否需要打印该级别的日志
+        :param level:
+        :param sample: 是否按照采样率采样，ERROR及以上级别的日志不采样
+        :return:
+        """
+        self.ensure_config()
+        if level < self.int_log_level or not self.logger.isEnabledFor(level):
+            return False
+        return not sample or level >= logging.ERROR or self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def format_message(self, message, args, caller_level=3):
+        """
+        格式化消息，大的参数和消息按照max_length截断
+        :param message:
+        :param args:
+        :param caller_level: 调用者相对本函数的栈深度
+        :return:
+        """
+        if args:
+            if self.max_length:
+                args = map(self.limit_payload, args)
+            message = message.format(*args)
+        elif not isinstance(message, basestring):
+            message = str(message)
+        return ' '.join((get_caller_info(caller_level), self.limit_payload(message)))
+
+    def limit_payload(self, payload):
+        """
+        限制日志内容长度，容器类型只描述部分元素，避免完整序列化大的DSL和查询结果
+        :param payload:
+        :return:
+        """
+        if not self.max_length:
+            return payload
+        if isinstance(payload, (dict, list, tuple, set)):
+            payload = _payload_repr.repr(payload)
+        elif not isinstance(payload, basestring):
+            return payload
+        if len(payload) > self.max_length:
+            return u'{0}...({1} chars omitted)'.format(payload[:self.max_length], len(payload) - self.max_length)
+        return payload
+
+
+class AppLog(BaseLog):
     def __init__(self, logger_name='app'):
+        super(AppLog, self).__init__()
         self.logger = logging.getLogger(logger_name)
+        self.config_name = logger_name
 
     def info(self, message, *args):
+        if not message or not self.is_enabled_for(logging.INFO, True):
+            return
         try:
-            if not message:
-                return
-            if args:
-                message = message.format(*args)
-            message = ' '.join((get_caller_info(), message))
+            message = self.format_message(message, args)
         except Exception as e:
             self.logger.exception(e)
-        finally:
-            self.logger.info(message)
+        self.logger.info(message)
 
     def warning(self, message, *args):
+        if not message or not self.is_enabled_for(logging.WARNING, True):
+            return
         try:
-            if not message:
-                return
-            if args:
-                message = message.format(*args)
-            message = ' '.join((get_caller_info(), str(message)))
+            message = self.format_message(message, args)
         except Exception as e:
             self.logger.exception(e)
-        finally:
-            self.logger.warning(message)
+        self.logger.warning(message)
 
     def error(self, message, error=None, *args):
+        if not message or not _error_logger.isEnabledFor(logging.ERROR):
+            return
         try:
-            if not message:
-                return
             if error and not isinstance(error, Exception):
                 args = chain([error], args)
-            if args:
-                message = message.format(*args)
-            message = ' '.join((get_caller_info(), message))
+            message = self.format_message(message, tuple(args))
         except Exception as e:
             self.logger.exception(e)
         finally:
@@ -85,61 +304,60 @@ class AppLog(object):
             self.logger.exception(e)
 
 
-class InterfaceLog(object):
+class InterfaceLog(BaseLog):
     """
     打印接口交互日志
     """
     logger = logging.getLogger('interface')
+    config_name = 'interface'
+    # 接口日志中可能很大的字段
+    PAYLOAD_FIELDS = ('param_values', 'result_value')
 
-    def __init__(self):
-        self.__has_init = False
-
-    def init_config(self):
-        # 消除循环依赖
-        from msg_bus import message_bus, Event
-
-        self.update_log_level()
-        message_bus.add_event_listener(Event.TYPE_UPDATE_LOG_LEVEL, self.update_log_level)
-        self.__has_init = True
-
-    def update_log_level(self):
-        from common.configs import config
-
-        self.log_level = config.get_value('consts/logger/interface/level')
-        self.int_log_level = logging._levelNames[self.log_level]
+    def is_enabled(self):
+        """
+        是否需要打印接口日志，包含采样判断，调用方据此跳过日志记录的构建
+        :return:
+        """
+        return self.is_enabled_for(logging.INFO, True)
 
     def print_log(self, message, *args):
+        if not message or not self.is_enabled_for(logging.INFO):
+            return
         try:
-            if not self.__has_init:
-                self.init_config()
-            if not self.logger.isEnabledFor(self.int_log_level) or not message:
-                return
             if isinstance(message, dict):
-                message['message'] = ' '.join((get_caller_info(), message.get('message') or ''))
-                message = json.dumps(message)
+                message = self.__dumps_record(message)
             elif args:
-                message = message.format(*args)
-                message = ' '.join((get_caller_info(), message))
+                message = self.format_message(message, args)
         except Exception as e:
             self.logger.exception(e)
-        finally:
-            self.logger.info(message)
+        self.logger.info(message)
+
     def print_error(self, message, error, *args):
+        if not self.is_enabled_for(logging.ERROR):
+            return
         if isinstance(message, dict):
-            message['message'] = ' '.join((get_caller_info(), message.get('message') or ''))
             message['exceptionMsg'] = str(error)
-            message = json.dumps(message)
+            message = self.__dumps_record(message)
         elif args:
-            message = message.format(*args)
-            message = ' '.join((get_caller_info(), message))
+            message = self.format_message(message, args)
         self.logger.error(message)
 
+    def __dumps_record(self, record):
+        record['message'] = ' '.join((get_caller_info(3), record.get('message') or ''))
+        if self.max_length:
+            for field in self.PAYLOAD_FIELDS:
+                if record.get(field) is not None:
+                    record[field] = self.limit_payload(record[field] if isinstance(
+                        record[field], (basestring, dict, list, tuple, set)) else str(record[field]))
+        return json.dumps(record)
 
-class DebugLog(object):
+
+class DebugLog(BaseLog):
     """
     打印接口交互日志
     """
     logger = logging.getLogger('debug')
+    config_name = 'debug'
 
     # python 连接mq的lib有多个，后续可能不使用pyactivemq
     try:
@@ -147,23 +365,6 @@ class DebugLog(object):
     except ImportError as e:
         _error_logger.exception(e)
 
-    def __init__(self):
-        self.__has_init = False
-
-    def init_config(self):
-        from msg_bus import message_bus, Event
-        # 消除循环依赖
-        self.update_log_level()
-        message_bus.add_event_listener(Event.TYPE_UPDATE_LOG_LEVEL, self.update_log_level)
-        self.__has_init = True
-
-    def update_log_level(self):
-        from common.configs import config
-
-        self.log_level = config.get_value('consts/logger/debug/level')
-        self.int_log_level = logging._levelNames[self.log_level]
-
-
     def debug(self, msgs):
         """
         日志打印，打印函数的入参和出参
@@ -174,8 +375,6 @@ class DebugLog(object):
 
         def decorator(function):
             def new_func(*args, **kwargs):
-                if not self.__has_init:
-                    self.init_config()
                 # self.__log(self.int_log_level, msgs, 'begin with the params:', *args, **kwargs)
                 result = function(*args, **kwargs)
                 # self.__log(self.int_log_level, msgs, 'finish with the result:', result)
@@ -193,15 +392,11 @@ class DebugLog(object):
         :return:
         """
         try:
-            if not self.__has_init:
-                self.init_config()
-            if not self.logger.isEnabledFor(self.int_log_level) or not message:
+            self.ensure_config()
+            # 配置的级别为python日志记录器需要开启的级别，默认DEBUG，即debug记录器开启DEBUG级别时才打印
+            if not message or not self.is_enabled_for(self.int_log_level, True):
                 return
-            if args:
-                message = message.format(*args)
-            message = ' '.join((get_caller_info(3), message))
-
-            self.logger.info(message)
+            self.logger.info(self.format_message(message, args, 4))
         except Exception as e:
             self.logger.exception(e)
 
@@ -243,6 +438,7 @@ class DebugLog(object):
         return '[{0} : {1}]'.format(str(obj), obj.__dict__ if hasattr(obj, '__dict__') else '')
 
 
+async_log_writer = AsyncLogWriter()
 app_log = AppLog()
 debug_log = DebugLog()
 interface_log = InterfaceLog()
@@ -27,6 +27,7 @@ class Event(object):
     TYPE_VIP_ADMIN_PARAMS_UPDATE = 'admin_params_update'
     TYPE_REST_CLUSTER_UPDATE_CONFIG = 'rest_cluster_update_config'
     TYPE_REST_KAFKA_CONSUMER_START_STOP = 'rest_kafka_consumer_start_stop'
+    TYPE_ANALYZE_CACHE_CLEAR = 'analyze_cache_clear'
 
     def __init__(self, type, source=None, destination='all', data=None):
         self._type = type
@@ -0,0 +1,176 @@
+# coding=utf-8
+"""
+MQ消息合并，在一个时间窗口内同一个文档的多条消息只执行最后一条
+"""
+import threading
+import time
+
+from common.configs import config
+from common.loggers import app_log
+from common.msg_bus import message_bus, Event
+
+__author__ = 'liuzhaoming'
+
+
+class MsgCoalescer(object):
+    """
+    消息合并器，按照(river_key, 文档key)合并窗口内的消息。
+    文档key由监听器根据数据流sla/coalesce配置解析后保存在消息的coalesce_key中，
+    删除消息保存coalesce_delete标志，删除消息不会被合并，删除前后的消息分别合并，保证和删除消息的先后顺序。
+    没有文档key的消息只有数据流配置sla/coalesce/identical为true时才合并内容完全相同的消息，默认不合并
+    """
+
+    def __init__(self, redis_conn):
+        self._redis_conn = redis_conn
+        self.__lock = threading.Lock()
+        self.__buffers = {}
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化消息合并配置
+        :return:
+        """
+        coalesce_cfg = config.get_value('/consts/global/admin_id_cfg/msg_coalesce') or {}
+        self.enable = coalesce_cfg.get('enable', True)
+        self.window = (coalesce_cfg.get('window_ms') or 0) / 1000.0
+        self.max_msgs = coalesce_cfg.get('max_msgs') or 1000
+        self.stats_key = coalesce_cfg.get('stats_key') or 'sp_msg_coalesce_stats'
+
+    def coalesce(self, admin_msg_list, tier=None, linger=0):
+        """
+        合并消息，tier不为空时消息先放入该级别的窗口缓冲区，窗口到期或者消息数目达到上限后才返回
+        :param admin_msg_list: [(admin_id, lease_id, msgs), ...]
+        :param tier: 用户级别，每个级别一个缓冲区
+        :param linger: 批量分发的等待时间，单位秒，关闭消息合并时也会等待，窗口取两者中较大的值
+        :return: [(admin_id, [lease_id, ...], msgs), ...]，同一个用户的多个租约合并为一组
+        """
+        window = max(self.window if self.enable else 0, linger or 0)
+        if tier is None or window <= 0:
+            return self.__merge(admin_msg_list)
+
+        cur_time = time.time()
+        with self.__lock:
+            buf = self.__buffers.get(tier)
+            if buf is None:
+                buf = self.__buffers[tier] = {'start_time': cur_time, 'admin_msg_list': [], 'msg_count': 0}
+            if admin_msg_list:
+                if not buf['admin_msg_list']:
+                    buf['start_time'] = cur_time
+                buf['admin_msg_list'].extend(admin_msg_list)
+                buf['msg_count'] += sum(len(msgs) for _, _, msgs in admin_msg_list)
+            if not buf['admin_msg_list'] or (
+                            cur_time - buf['start_time'] < window and buf['msg_count'] < self.max_msgs):
+                return []
+            ready_admin_msg_list = buf['admin_msg_list']
+            buf['admin_msg_list'], buf['msg_count'] = [], 0
+        return self.__merge(ready_admin_msg_list)
+
+    def has_pending(self, tier):
+        """
+        该级别的缓冲区中是否有等待窗口到期的消息
+        :param tier:
+        :return:
+        """
+        buf = self.__buffers.get(tier)
+        return bool(buf and buf['admin_msg_list'])
+
+    def coalesce_msgs(self, msgs):
+        """
+        合并同一个用户的消息列表，保留每个文档最后一条消息的位置
+        :param msgs:
+        :return: (合并后的消息列表, 被合并的消息列表)
+        """
+        latest_pos_dict = {}
+        drop_pos_set = set()
+        for pos, msg in enumerate(msgs):
+            key = self.__get_msg_key(msg)
+            if key is None:
+                continue
+            if msg.get('coalesce_delete'):
+                # 删除消息作为分界，之前的消息不能和之后的消息合并
+                latest_pos_dict.pop(key, None)
+                continue
+            if key in latest_pos_dict:
+                drop_pos_set.add(latest_pos_dict[key])
+            latest_pos_dict[key] = pos
+        if not drop_pos_set:
+            return msgs, []
+        return [msg for pos, msg in enumerate(msgs) if pos not in drop_pos_set], \
+               [msgs[pos] for pos in sorted(drop_pos_set)]
+
+    def __get_msg_key(self, msg):
+        if msg.get('coalesce_key') is not None:
+            return msg.get('river_key'), 'key', msg['coalesce_key']
+        if msg.get('coalesce_identical') and 'text' in msg:
+            return msg.get('river_key'), 'text', msg['text']
+        return None
+
+    def __merge(self, admin_msg_list):
+        """
+        按照用户合并多个租约的消息并执行消息合并
+        :param admin_msg_list:
+        :return:
+        """
+        admin_group_dict = {}
+        admin_group_list = []
+        for admin_id, lease_id, msgs in admin_msg_list:
+            if admin_id not in admin_group_dict:
+                admin_group_dict[admin_id] = (admin_id, [], [])
+                admin_group_list.append(admin_group_dict[admin_id])
+            admin_group_dict[admin_id][1].append(lease_id)
+            admin_group_dict[admin_id][2].extend(msgs)
+
+        result_list = []
+        received_dict = {}
+        coalesced_dict = {}
+        for admin_id, lease_ids, msgs in admin_group_list:
+            coalesced_msgs, dropped_msgs = self.coalesce_msgs(msgs) if self.enable else (msgs, [])
+            result_list.append((admin_id, lease_ids, coalesced_msgs))
+            for msg in msgs:
+                river_key = msg.get('river_key') or 'default'
+                received_dict[river_key] = received_dict.get(river_key, 0) + 1
+            for msg in dropped_msgs:
+                river_key = msg.get('river_key') or 'default'
+                coalesced_dict[river_key] = coalesced_dict.get(river_key, 0) + 1
+        self.__record_stats(received_dict, coalesced_dict)
+        return result_list
+
+    def __record_stats(self, received_dict, coalesced_dict):
+        """
+        合并统计信息保存在REDIS中，消息处理进程和管理进程不是同一个进程
+        :param received_dict:
+        :param coalesced_dict:
+        :return:
+        """
+        if not received_dict:
+            return
+        try:
+            pipe = self._redis_conn.pipeline(transaction=False)
+            for river_key, count in received_dict.iteritems():
+                pipe.hincrby(self.stats_key + ':received', river_key, count)
+            for river_key, count in coalesced_dict.iteritems():
+                pipe.hincrby(self.stats_key + ':coalesced', river_key, count)
+            pipe.execute()
+        except Exception as e:
+            app_log.error('record msg coalesce stats error, received={0}, coalesced={1}', e, received_dict,
+                          coalesced_dict)
+
+    def stats(self):
+        """
+        获取各数据流消息合并统计信息
+        :return:
+        """
+        received_dict = self._redis_conn.hgetall(self.stats_key + ':received') or {}
+        coalesced_dict = self._redis_conn.hgetall(self.stats_key + ':coalesced') or {}
+        stats = {}
+        for river_key, received in received_dict.iteritems():
+            received = int(received)
+            coalesced = int(coalesced_dict.get(river_key) or 0)
+            stats[river_key] = {'received': received, 'coalesced': coalesced, 'dispatched': received - coalesced,
+                                'coalesced_ratio': round(float(coalesced) / received, 4) if received else 0}
+        return stats
+
+    def reset_stats(self):
+        return self._redis_conn.delete(self.stats_key + ':received', self.stats_key + ':coalesced')
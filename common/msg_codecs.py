@@ -0,0 +1,137 @@
+# coding=utf-8
+"""
+SLA消息队列编解码，支持msgpack序列化，超过阈值后使用zlib压缩。
+二进制格式第一个字节为版本号，JSON格式没有版本号，首字节为'{'，新旧两种格式都可以解码。
+旧版本进程只能解码JSON，默认仍然写入JSON；所有进程都升级到支持解码msgpack的版本后，再将msg_codec/type修改为msgpack
+"""
+import zlib
+import ujson as json
+
+from common.configs import config
+from common.loggers import app_log
+from common.msg_bus import message_bus, Event
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__author__ = 'liuzhaoming'
+
+
+class JsonMsgCodec(object):
+    """
+    JSON格式，原有的队列格式，不带版本号
+    """
+    name = 'json'
+    version = None
+
+    def encode(self, msg):
+        return json.dumps(msg)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackMsgCodec(object):
+    """
+    msgpack格式，字符串按照UTF-8解码为unicode，和JSON格式解码结果一致
+    """
+    name = 'msgpack'
+    version = '\x01'
+
+    def encode(self, msg):
+        return msgpack.packb(msg)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+class ZlibMsgCodec(object):
+    """
+    对其它格式的编码结果进行zlib压缩
+    """
+    version = '\x02'
+
+    def __init__(self, inner_codec, level=1):
+        self.inner_codec = inner_codec
+        self.name = inner_codec.name + '+zlib'
+        self.level = level
+
+    def encode(self, msg):
+        return zlib.compress(self.inner_codec.encode(msg), self.level)
+
+    def decode(self, data):
+        return self.inner_codec.decode(zlib.decompress(data))
+
+
+class MsgCodec(object):
+    """
+    消息队列编解码器，编码格式由配置决定，解码时根据版本号选择格式
+    """
+
+    def __init__(self):
+        self.__codec_dict = {'json': JsonMsgCodec(), 'msgpack': MsgpackMsgCodec()}
+        self.__zlib_codec = ZlibMsgCodec(self.__codec_dict['msgpack'])
+        self.__version_dict = {}
+        self.register_codec(self.__codec_dict['msgpack'])
+        self.register_codec(self.__zlib_codec)
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化编码配置
+        :return:
+        """
+        codec_cfg = config.get_value('/consts/global/admin_id_cfg/msg_codec') or {}
+        self.use_codec(codec_cfg.get('type') or 'json')
+        # 编码结果超过该字节数时压缩，为0时不压缩
+        self.compress_threshold = codec_cfg.get('compress_threshold', 1024)
+        self.__zlib_codec.level = codec_cfg.get('compress_level') or 1
+
+    def use_codec(self, codec_type):
+        """
+        设置编码格式，解码总是支持所有格式
+        :param codec_type: json或者msgpack
+        :return:
+        """
+        if codec_type == 'msgpack' and msgpack is None:
+            app_log.warning('msgpack is not installed, SLA queue msgs are encoded as json')
+            codec_type = 'json'
+        self.codec = self.__codec_dict.get(codec_type) or self.__codec_dict['json']
+
+    def register_codec(self, codec):
+        """
+        注册解码格式，版本号不能和已有格式重复，也不能是'{'
+        :param codec:
+        :return:
+        """
+        self.__version_dict[codec.version] = codec
+
+    def encode(self, msg):
+        """
+        消息编码
+        :param msg:
+        :return:
+        """
+        data = self.codec.encode(msg)
+        if self.codec.version is None:
+            return data
+        if self.compress_threshold and len(data) >= self.compress_threshold:
+            return self.__zlib_codec.version + zlib.compress(data, self.__zlib_codec.level)
+        return self.codec.version + data
+
+    def decode(self, data):
+        """
+        消息解码，没有版本号的数据按照JSON格式解码
+        :param data:
+        :return:
+        """
+        codec = self.__version_dict.get(data[:1])
+        if codec is None:
+            return json.loads(data)
+        return codec.decode(data[1:])
+
+
+msg_codec = MsgCodec()
@@ -0,0 +1,215 @@
+# coding=utf-8
+"""
+基于REDIS有序集合的延迟重做队列，消息按照下次重做时间排序，只读取到期的消息
+"""
+import time
+
+__author__ = 'liuzhaoming'
+
+# 更新用户在级别索引中的分数为队列中最早的到期时间，队列为空时删除
+_UPDATE_ADMIN_INDEX_FUNCTION = """
+local function update_admin_index(queue_key, admin_key, admin_id)
+    local head = redis.call('ZRANGE', queue_key, 0, 0, 'WITHSCORES')
+    if #head == 0 then
+        redis.call('ZREM', admin_key, admin_id)
+    else
+        redis.call('ZADD', admin_key, head[2], admin_id)
+    end
+end
+"""
+
+# 删除已经处理的消息并添加新的延迟消息
+# KEYS[1] 用户延迟队列 KEYS[2] 级别的用户索引有序集合
+# ARGV[1] adminId ARGV[2] 删除的消息数目n ARGV[3...n+2] 删除的消息 之后为(到期时间, 消息)对
+_SCHEDULE_SCRIPT = _UPDATE_ADMIN_INDEX_FUNCTION + """
+local remove_count = tonumber(ARGV[2])
+for index = 3, remove_count + 2 do
+    redis.call('ZREM', KEYS[1], ARGV[index])
+end
+for index = remove_count + 3, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[index], ARGV[index + 1])
+end
+update_admin_index(KEYS[1], KEYS[2], ARGV[1])
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# 领取到期消息，领取的消息到期时间改为租约到期时间，进程异常退出时租约到期后可以被再次领取
+# KEYS[1] 级别的用户索引有序集合
+# ARGV[1] 当前时间 ARGV[2] 租约到期时间 ARGV[3] 最多领取用户数目 ARGV[4] 每个用户最多领取消息数目
+# ARGV[5] 用户队列key前缀 ARGV[6] 用户队列key后缀
+_CLAIM_SCRIPT = _UPDATE_ADMIN_INDEX_FUNCTION + """
+local result = {}
+local admin_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for index = 1, #admin_ids do
+    local queue_key = ARGV[5] .. admin_ids[index] .. ARGV[6]
+    local msgs = redis.call('ZRANGEBYSCORE', queue_key, '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[4]))
+    for msg_index = 1, #msgs do
+        redis.call('ZADD', queue_key, ARGV[2], msgs[msg_index])
+    end
+    update_admin_index(queue_key, KEYS[1], admin_ids[index])
+    if #msgs > 0 then
+        table.insert(result, admin_ids[index])
+        table.insert(result, msgs)
+    end
+end
+return result
+"""
+
+
+class RedisDelayQueue(object):
+    """
+    用户延迟消息队列，每个用户一个REDIS有序集合，分数为下次处理时间。
+    每个级别有一个用户索引有序集合，分数为用户队列中最早的到期时间，领取时只访问有到期消息的用户。
+    领取的消息在确认前保留在队列中，到期时间延后为租约到期时间
+    """
+
+    def __init__(self, redis_conn, queue_key, admin_key, lease_timeout=300):
+        """
+        :param redis_conn:
+        :param queue_key: 用户延迟队列key模板，如sp_msg_delay_queue_{0}
+        :param admin_key: 级别的用户索引key模板，如sp_msg_delay_admin_{0}，{0}为vip或者experience
+        :param lease_timeout: 领取消息的租约时间，单位秒
+        """
+        self.redis_conn = redis_conn
+        self.queue_key = queue_key
+        self.queue_key_prefix, _, self.queue_key_suffix = queue_key.partition('{0}')
+        self.admin_key = admin_key
+        self.lease_timeout = lease_timeout
+        self._schedule_script = redis_conn.register_script(_SCHEDULE_SCRIPT)
+        self._claim_script = redis_conn.register_script(_CLAIM_SCRIPT)
+
+    def get_queue_key(self, admin_id):
+        return self.queue_key.format(admin_id)
+
+    def get_admin_key(self, tier):
+        return self.admin_key.format(tier)
+
+    def schedule(self, admin_id, tier, due_msg_list, remove_msgs=()):
+        """
+        添加延迟消息，同时删除已经处理的消息，两者在一次脚本调用中完成
+        :param admin_id:
+        :param tier: 用户级别
+        :param due_msg_list: [(due_time, str_msg), ...]
+        :param remove_msgs: 需要删除的消息，必须和领取时返回的字符串完全相同
+        :return: 用户队列中剩余的消息数目
+        """
+        args = [admin_id, len(remove_msgs)] + list(remove_msgs)
+        for due_time, str_msg in due_msg_list:
+            args.extend((due_time, str_msg))
+        return self._schedule_script(keys=[self.get_queue_key(admin_id), self.get_admin_key(tier)], args=args)
+
+    def ack(self, admin_id, tier, str_msgs):
+        """
+        确认消息已经处理，从队列中删除
+        :param admin_id:
+        :param tier:
+        :param str_msgs:
+        :return:
+        """
+        if not str_msgs:
+            return
+        return self.schedule(admin_id, tier, [], str_msgs)
+
+    def claim(self, tier, size, max_admins=100, cur_time=None):
+        """
+        原子领取该级别所有用户的到期消息，耗时只和到期的用户和消息数目有关
+        :param tier:
+        :param size: 每个用户最多领取消息数目
+        :param max_admins: 最多领取用户数目
+        :param cur_time:
+        :return: [(admin_id, [str_msg, ...]), ...]
+        """
+        cur_time = cur_time or time.time()
+        result = self._claim_script(keys=[self.get_admin_key(tier)],
+                                    args=[cur_time, cur_time + self.lease_timeout, max_admins, size,
+                                          self.queue_key_prefix, self.queue_key_suffix])
+        return zip(result[::2], result[1::2])
+
+    def next_due_time(self, tier):
+        """
+        该级别最早的到期时间，没有消息时返回None
+        :param tier:
+        :return:
+        """
+        head = self.redis_conn.zrange(self.get_admin_key(tier), 0, 0, withscores=True)
+        return head[0][1] if head else None
+
+    def size(self, admin_id):
+        return self.redis_conn.zcard(self.get_queue_key(admin_id))
+
+    def range(self, admin_id, start=0, size=0):
+        """
+        按照到期时间顺序查询用户队列中的消息
+        :param admin_id:
+        :param start:
+        :param size: 为0时查询全部
+        :return: [(str_msg, due_time), ...]
+        """
+        return self.redis_conn.zrange(self.get_queue_key(admin_id), start, start + size - 1 if size else -1,
+                                      withscores=True)
+
+    def delete(self, admin_id):
+        """
+        删除用户队列，用户索引中的记录在下次领取时清除
+        :param admin_id:
+        :return:
+        """
+        return self.redis_conn.delete(self.get_queue_key(admin_id))
+
+
+class InMemoryDelayQueue(object):
+    """
+    进程内延迟消息队列，和RedisDelayQueue接口相同，用于分片和消息重做测试
+    """
+
+    def __init__(self, lease_timeout=300):
+        self.lease_timeout = lease_timeout
+        # {admin_id: {str_msg: due_time}}
+        self.queue_dict = {}
+        self.tier_dict = {}
+
+    def schedule(self, admin_id, tier, due_msg_list, remove_msgs=()):
+        queue = self.queue_dict.setdefault(admin_id, {})
+        for str_msg in remove_msgs:
+            queue.pop(str_msg, None)
+        for due_time, str_msg in due_msg_list:
+            queue[str_msg] = due_time
+        self.tier_dict[admin_id] = tier
+        return len(queue)
+
+    def ack(self, admin_id, tier, str_msgs):
+        if not str_msgs:
+            return
+        return self.schedule(admin_id, tier, [], str_msgs)
+
+    def claim(self, tier, size, max_admins=100, cur_time=None):
+        cur_time = cur_time or time.time()
+        due_admin_list = sorted((min(queue.itervalues()), admin_id) for admin_id, queue in self.queue_dict.iteritems()
+                                if queue and self.tier_dict.get(admin_id) == tier)
+        result_list = []
+        for due_time, admin_id in due_admin_list[:max_admins]:
+            if due_time > cur_time:
+                break
+            queue = self.queue_dict[admin_id]
+            str_msgs = [str_msg for msg_due_time, str_msg in
+                        sorted((msg_due_time, str_msg) for str_msg, msg_due_time in queue.iteritems() if
+                               msg_due_time <= cur_time)[:size]]
+            for str_msg in str_msgs:
+                queue[str_msg] = cur_time + self.lease_timeout
+            result_list.append((admin_id, str_msgs))
+        return result_list
+
+    def next_due_time(self, tier):
+        due_time_list = [min(queue.itervalues()) for admin_id, queue in self.queue_dict.iteritems() if
+                         queue and self.tier_dict.get(admin_id) == tier]
+        return min(due_time_list) if due_time_list else None
+
+    def size(self, admin_id):
+        return len(self.queue_dict.get(admin_id, {}))
+
+    def range(self, admin_id, start=0, size=0):
+        msg_list = sorted(self.queue_dict.get(admin_id, {}).iteritems(), key=lambda item: (item[1], item[0]))
+        return msg_list[start:start + size] if size else msg_list[start:]
+
+    def delete(self, admin_id):
+        return 1 if self.queue_dict.pop(admin_id, None) else 0
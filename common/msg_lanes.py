@@ -0,0 +1,255 @@
+# coding=utf-8
+"""
+消息执行通道，消息按照(adminId, river_key, 文档key)哈希到固定数目的有序通道，同一个文档的消息总是在同一个通道中按顺序执行，
+不同通道并行执行。每个通道是一个REDIS list，同时最多只有一个持有通道令牌的任务处理该通道
+"""
+import time
+import uuid
+import zlib
+
+from common.configs import config
+from common.connections import RedisConnectionFactory
+from common.loggers import app_log
+from common.msg_bus import message_bus, Event
+from common.msg_codecs import msg_codec
+from common.msg_shards import ConsistentHashRing
+from search_platform.settings import SERVICE_BASE_CONFIG
+
+__author__ = 'liuzhaoming'
+
+# 确认上一批消息并读取下一批消息，通道为空时释放令牌
+# KEYS[1] 通道消息list KEYS[2] 通道令牌key
+# ARGV[1] 令牌 ARGV[2] 上一批消息数目 ARGV[3] 本批消息数目 ARGV[4] 令牌超时时间
+_NEXT_BATCH_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return false
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('LTRIM', KEYS[1], tonumber(ARGV[2]), -1)
+end
+local msgs = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+if #msgs == 0 then
+    redis.call('DEL', KEYS[2])
+else
+    redis.call('EXPIRE', KEYS[2], tonumber(ARGV[4]))
+end
+return msgs
+"""
+
+# 令牌仍然有效时延长令牌超时时间
+# KEYS[1] 通道令牌key ARGV[1] 令牌 ARGV[2] 令牌超时时间
+_REFRESH_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+return 1
+"""
+
+
+def get_lane_key(message):
+    """
+    消息的通道key，同一个用户同一个数据流的同一个文档的消息在同一个通道中；
+    没有文档key的消息之间没有顺序要求，每条消息单独计算通道，和每条消息一个任务时的并发度相同
+    :param message:
+    :return:
+    """
+    coalesce_key = message.get('coalesce_key')
+    if not coalesce_key:
+        return uuid.uuid4().hex
+    lane_key = u'{0}|{1}|{2}'.format(message.get('adminId'), message.get('river_key'), coalesce_key)
+    return lane_key.encode('utf-8')
+
+
+class MsgLanes(object):
+    """
+    有序执行通道。生产者写入消息时在同一个事务中尝试获取通道令牌，获取成功时由调用方启动处理任务；
+    处理任务按批读取消息，处理完成后再删除，通道为空时原子释放令牌，保证释放后写入的消息一定会启动新的任务。
+    处理每条消息前延长令牌超时时间，令牌失效时处理任务立即退出，避免revive启动的新任务和旧任务同时处理同一个通道。
+    通道按照通道key一致性哈希分布到多个REDIS。修改lane_count会改变文档所在通道，需要在通道为空时修改
+    """
+
+    def __init__(self, shard_conn_dict, replicas=160):
+        """
+        :param shard_conn_dict: {分片名称: redis连接}
+        :param replicas:
+        """
+        self._shard_conn_dict = shard_conn_dict
+        self._ring = ConsistentHashRing(sorted(shard_conn_dict), replicas)
+        first_conn = shard_conn_dict[sorted(shard_conn_dict)[0]]
+        self._next_batch_script = first_conn.register_script(_NEXT_BATCH_SCRIPT)
+        self._refresh_script = first_conn.register_script(_REFRESH_SCRIPT)
+        self._last_revive_time = 0
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化执行通道配置
+        :return:
+        """
+        lane_cfg = config.get_value('/consts/global/admin_id_cfg/msg_lanes') or {}
+        self.enable = lane_cfg.get('enable', False)
+        self.lane_count = lane_cfg.get('lane_count') or 64
+        self.batch_size = lane_cfg.get('batch_size') or 50
+        self.owner_ttl = lane_cfg.get('owner_ttl') or 300
+        self.revive_interval = lane_cfg.get('revive_interval') or 30
+        self.lane_key = lane_cfg.get('lane_key') or 'sp_msg_lane_{0}'
+        self.owner_key = lane_cfg.get('owner_key') or 'sp_msg_lane_owner_{0}'
+
+    def get_lane(self, message):
+        return (zlib.crc32(get_lane_key(message)) & 0xffffffff) % self.lane_count
+
+    def get_lane_conn(self, lane):
+        return self._shard_conn_dict[self._ring.get_node(self.lane_key.format(lane))]
+
+    def group_lanes(self, lanes):
+        """
+        按照所在REDIS分组
+        :param lanes:
+        :return: [(redis_conn, [lane, ...]), ...]
+        """
+        shard_lanes_dict = {}
+        for lane in lanes:
+            shard_lanes_dict.setdefault(self._ring.get_node(self.lane_key.format(lane)), []).append(lane)
+        return [(self._shard_conn_dict[shard], shard_lanes) for shard, shard_lanes in shard_lanes_dict.iteritems()]
+
+    def push(self, messages):
+        """
+        消息写入所在通道的队尾，同时尝试获取通道令牌
+        :param messages:
+        :return: [(lane, owner_token), ...]，获取到令牌的通道，需要启动处理任务
+        """
+        lane_msgs_dict = {}
+        cur_time = time.time()
+        for message in messages:
+            message['lane_time'] = cur_time
+            lane_msgs_dict.setdefault(self.get_lane(message), []).append(msg_codec.encode(message))
+
+        lane_token_list = []
+        for redis_conn, lanes in self.group_lanes(lane_msgs_dict):
+            shard_lane_token_list = [(lane, uuid.uuid4().hex) for lane in lanes]
+            pipe = redis_conn.pipeline(transaction=True)
+            for lane, owner_token in shard_lane_token_list:
+                pipe.rpush(self.lane_key.format(lane), *lane_msgs_dict[lane])
+                pipe.set(self.owner_key.format(lane), owner_token, ex=self.owner_ttl, nx=True)
+            result_list = pipe.execute()
+            lane_token_list.extend(
+                lane_token for lane_token, acquired in zip(shard_lane_token_list, result_list[1::2]) if acquired)
+        return lane_token_list
+
+    def next_batch(self, lane, owner_token, processed_count=0):
+        """
+        删除已经处理的上一批消息并读取下一批消息
+        :param lane:
+        :param owner_token:
+        :param processed_count: 上一批消息数目
+        :return: (本批消息数目, 消息列表)，通道为空或者令牌已经失效时返回(0, [])
+        """
+        str_msgs = self._next_batch_script(keys=[self.lane_key.format(lane), self.owner_key.format(lane)],
+                                           args=[owner_token, processed_count, self.batch_size, self.owner_ttl],
+                                           client=self.get_lane_conn(lane))
+        if not str_msgs:
+            if str_msgs is None:
+                app_log.warning('Msg lane {0} owner token {1} is expired', lane, owner_token)
+            return 0, []
+        msgs = []
+        for str_msg in str_msgs:
+            try:
+                msgs.append(msg_codec.decode(str_msg))
+            except Exception as e:
+                app_log.error('Msg lane {0} has invalid message {1}', e, lane, str_msg)
+        return len(str_msgs), msgs
+
+    def refresh(self, lane, owner_token):
+        """
+        延长令牌超时时间，处理每条消息前调用
+        :param lane:
+        :param owner_token:
+        :return: 令牌是否仍然有效
+        """
+        if self._refresh_script(keys=[self.owner_key.format(lane)], args=[owner_token, self.owner_ttl],
+                                client=self.get_lane_conn(lane)):
+            return True
+        app_log.warning('Msg lane {0} owner token {1} is expired', lane, owner_token)
+        return False
+
+    def revive(self, force=False):
+        """
+        为有消息但是没有令牌的通道重新获取令牌，处理任务异常退出或者任务发送失败时通道中的消息由此恢复处理，
+        按照revive_interval限制执行频率
+        :param force:
+        :return: [(lane, owner_token), ...]
+        """
+        cur_time = time.time()
+        if not force and cur_time - self._last_revive_time < self.revive_interval:
+            return []
+        self._last_revive_time = cur_time
+        lane_token_list = []
+        for redis_conn, lanes in self.group_lanes(xrange(self.lane_count)):
+            try:
+                pipe = redis_conn.pipeline(transaction=False)
+                for lane in lanes:
+                    pipe.llen(self.lane_key.format(lane))
+                    pipe.exists(self.owner_key.format(lane))
+                result_list = pipe.execute()
+                idle_lane_token_list = [(lane, uuid.uuid4().hex) for lane, depth, has_owner in
+                                        zip(lanes, result_list[::2], result_list[1::2]) if depth and not has_owner]
+                if not idle_lane_token_list:
+                    continue
+                for lane, owner_token in idle_lane_token_list:
+                    pipe.set(self.owner_key.format(lane), owner_token, ex=self.owner_ttl, nx=True)
+                lane_token_list.extend(
+                    lane_token for lane_token, acquired in zip(idle_lane_token_list, pipe.execute()) if acquired)
+            except Exception as e:
+                app_log.error('Revive msg lanes error', e)
+        if lane_token_list:
+            app_log.warning('Revive msg lanes {0}', [lane for lane, _ in lane_token_list])
+        return lane_token_list
+
+    def stats(self):
+        """
+        通道统计信息，depth为通道中等待处理的消息数目，lag_seconds为通道头部消息写入后等待的时间
+        :return:
+        """
+        lane_result_dict = {}
+        for redis_conn, lanes in self.group_lanes(xrange(self.lane_count)):
+            pipe = redis_conn.pipeline(transaction=False)
+            for lane in lanes:
+                pipe.llen(self.lane_key.format(lane))
+                pipe.lindex(self.lane_key.format(lane), 0)
+                pipe.exists(self.owner_key.format(lane))
+            result_list = pipe.execute()
+            for pos, lane in enumerate(lanes):
+                lane_result_dict[lane] = result_list[pos * 3:pos * 3 + 3]
+        cur_time = time.time()
+        lane_stats_list = []
+        for lane in xrange(self.lane_count):
+            depth, head_msg, has_owner = lane_result_dict[lane]
+            if not depth and not has_owner:
+                continue
+            lag = None
+            try:
+                lag = round(cur_time - msg_codec.decode(head_msg)['lane_time'], 3) if head_msg else 0
+            except Exception:
+                pass
+            lane_stats_list.append({'lane': lane, 'depth': depth, 'lag_seconds': lag, 'busy': bool(has_owner)})
+        lag_list = filter(lambda lag: lag is not None, [lane_stats['lag_seconds'] for lane_stats in lane_stats_list])
+        return {'lane_count': self.lane_count, 'busy_lanes': sum(lane_stats['busy'] for lane_stats in lane_stats_list),
+                'total_depth': sum(lane_stats['depth'] for lane_stats in lane_stats_list),
+                'max_depth': max([lane_stats['depth'] for lane_stats in lane_stats_list] or [0]),
+                'max_lag_seconds': max(lag_list or [0]), 'lanes': lane_stats_list}
+
+
+def _get_lane_shard_conn_dict():
+    """
+    通道和用户队列使用相同的REDIS分片，没有配置msg_queue_shards时使用msg_queue
+    :return:
+    """
+    shard_hosts = filter(None, map(lambda host: host.strip(), (
+        SERVICE_BASE_CONFIG.get('msg_queue_shards') or SERVICE_BASE_CONFIG.get('msg_queue')).split(',')))
+    return dict((host, RedisConnectionFactory.get_redis_connection(host)) for host in shard_hosts)
+
+
+msg_lanes = MsgLanes(_get_lane_shard_conn_dict(),
+                     config.get_value('/consts/global/admin_id_cfg/msg_shard_replicas') or 160)
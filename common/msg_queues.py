@@ -0,0 +1,274 @@
+# coding=utf-8
+"""
+基于REDIS的用户消息队列，支持批量带租约出队、批量确认和重新入队
+"""
+import time
+import uuid
+
+from common.loggers import app_log
+
+__author__ = 'liuzhaoming'
+
+# 带租约批量出队：从用户队列头部取出N条消息，记录租约，队列为空时从用户集合中删除adminId
+# KEYS[1] 用户消息队列 KEYS[2] 有消息的adminId集合 KEYS[3] 租约有序集合 KEYS[4] 租约消息hash
+# ARGV[1] 出队数目 ARGV[2] adminId ARGV[3] 租约ID ARGV[4] 租约到期时间
+_POP_WITH_LEASE_SCRIPT = """
+local size = tonumber(ARGV[1])
+local msgs = {}
+if size > 0 then
+    msgs = redis.call('LRANGE', KEYS[1], 0, size - 1)
+    if #msgs > 0 then
+        redis.call('LTRIM', KEYS[1], #msgs, -1)
+        redis.call('HSET', KEYS[4], ARGV[3], cjson.encode({admin_id = ARGV[2], msgs = msgs}))
+        redis.call('ZADD', KEYS[3], ARGV[4], ARGV[3])
+    end
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+end
+return msgs
+"""
+
+# 将租约中的消息按照原有顺序放回用户队列头部。
+# 注意：用户队列key由租约中的adminId在脚本内拼接(ARGV[1] .. admin_id .. ARGV[2])，没有通过KEYS声明，
+# 不符合REDIS脚本只访问KEYS的约定，不能用于REDIS Cluster；只能用于单实例REDIS，
+# 多个REDIS时由msg_shards按照adminId分片，每个分片是独立的RedisMsgQueue，租约和用户队列总是在同一个实例中
+_REQUEUE_LEASE_FUNCTION = """
+local function requeue_lease(lease_id)
+    local data = redis.call('HGET', KEYS[2], lease_id)
+    redis.call('ZREM', KEYS[1], lease_id)
+    if not data then
+        return 0
+    end
+    local lease = cjson.decode(data)
+    local queue_key = ARGV[1] .. lease['admin_id'] .. ARGV[2]
+    for index = #lease['msgs'], 1, -1 do
+        redis.call('LPUSH', queue_key, lease['msgs'][index])
+    end
+    redis.call('SADD', KEYS[3], lease['admin_id'])
+    redis.call('HDEL', KEYS[2], lease_id)
+    return 1
+end
+"""
+
+# 重新入队指定租约
+# KEYS[1] 租约有序集合 KEYS[2] 租约消息hash KEYS[3] 有消息的adminId集合
+# ARGV[1] 用户队列key前缀 ARGV[2] 用户队列key后缀 ARGV[3...] 租约ID
+_REQUEUE_SCRIPT = _REQUEUE_LEASE_FUNCTION + """
+local count = 0
+for index = 3, #ARGV do
+    count = count + requeue_lease(ARGV[index])
+end
+return count
+"""
+
+# 回收已经过期的租约，KEYS同上
+# ARGV[1] 用户队列key前缀 ARGV[2] 用户队列key后缀 ARGV[3] 当前时间 ARGV[4] 每次最多回收数目
+_RECLAIM_SCRIPT = _REQUEUE_LEASE_FUNCTION + """
+local count = 0
+local lease_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[3], 'LIMIT', 0, tonumber(ARGV[4]))
+for index = 1, #lease_ids do
+    count = count + requeue_lease(lease_ids[index])
+end
+return count
+"""
+
+
+class RedisMsgQueue(object):
+    """
+    用户消息队列，每个用户一个REDIS list，有消息的adminId保存在一个set中。
+    出队时消息转移到租约中，处理成功后ack删除租约，处理失败或者租约过期时消息放回队列头部。
+    重新入队和回收租约的脚本在REDIS内部拼接用户队列key，只支持单实例REDIS，不支持REDIS Cluster
+    """
+
+    def __init__(self, redis_conn, queue_key, admin_set_key, lease_key, lease_timeout=300, reclaim_interval=30,
+                 reclaim_size=100):
+        """
+        :param redis_conn:
+        :param queue_key: 用户消息队列key模板，如sp_msg_queue_{0}
+        :param admin_set_key: 有消息的adminId集合key
+        :param lease_key: 租约key前缀，租约有序集合和租约消息hash都使用该前缀
+        :param lease_timeout: 租约超时时间，单位秒
+        :param reclaim_interval: 检查过期租约的时间间隔，单位秒
+        :param reclaim_size: 每次最多回收的过期租约数目
+        """
+        self.redis_conn = redis_conn
+        self.queue_key = queue_key
+        self.queue_key_prefix, _, self.queue_key_suffix = queue_key.partition('{0}')
+        self.admin_set_key = admin_set_key
+        self.lease_zset_key = lease_key + '_zset'
+        self.lease_hash_key = lease_key + '_hash'
+        self.lease_timeout = lease_timeout
+        self.reclaim_interval = reclaim_interval
+        self.reclaim_size = reclaim_size
+        self._last_reclaim_time = 0
+        self._pop_script = redis_conn.register_script(_POP_WITH_LEASE_SCRIPT)
+        self._requeue_script = redis_conn.register_script(_REQUEUE_SCRIPT)
+        self._reclaim_script = redis_conn.register_script(_RECLAIM_SCRIPT)
+
+    def get_queue_key(self, admin_id):
+        return self.queue_key.format(admin_id)
+
+    def push(self, admin_msgs_list):
+        """
+        批量入队，所有用户的消息在一个事务中发送
+        :param admin_msgs_list: [(admin_id, [str_msg, ...]), ...]
+        :return:
+        """
+        admin_id_set = set()
+        pipe = self.redis_conn.pipeline(transaction=True)
+        for admin_id, str_msgs in admin_msgs_list:
+            if not str_msgs:
+                continue
+            pipe.rpush(self.get_queue_key(admin_id), *str_msgs)
+            admin_id_set.add(admin_id)
+        if not admin_id_set:
+            return
+        pipe.sadd(self.admin_set_key, *admin_id_set)
+        pipe.execute()
+
+    def sizes(self, admin_ids):
+        """
+        批量查询用户队列长度，不包含租约中的消息
+        :param admin_ids:
+        :return: 和admin_ids对应的队列长度列表
+        """
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for admin_id in admin_ids:
+            pipe.llen(self.get_queue_key(admin_id))
+        return pipe.execute()
+
+    def query_admin_ids(self, discovery='set'):
+        """
+        查询有消息的adminId，默认读取adminId集合；discovery为scan时通过SCAN遍历用户队列key，用于集合数据丢失时的兜底
+        :param discovery:
+        :return:
+        """
+        if discovery == 'scan':
+            prefix_len = len(self.queue_key_prefix)
+            suffix_len = len(self.queue_key_suffix)
+            admin_ids = set()
+            for queue_key in self.redis_conn.scan_iter(match=self.queue_key_prefix + '*' + self.queue_key_suffix,
+                                                       count=1000):
+                admin_ids.add(queue_key[prefix_len:len(queue_key) - suffix_len])
+            return list(admin_ids)
+        return list(self.redis_conn.smembers(self.admin_set_key))
+
+    def pop(self, admin_size_list):
+        """
+        多个用户批量带租约出队，只需要一次网络往返
+        :param admin_size_list: [(admin_id, size), ...]
+        :return: [(admin_id, lease_id, [str_msg, ...]), ...]，没有消息的用户lease_id为None
+        """
+        admin_size_list = filter(lambda item: item[1] > 0, admin_size_list)
+        if not admin_size_list:
+            return []
+        expire_time = time.time() + self.lease_timeout
+        lease_id_list = [uuid.uuid4().hex for _ in admin_size_list]
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for (admin_id, size), lease_id in zip(admin_size_list, lease_id_list):
+            self._pop_script(keys=[self.get_queue_key(admin_id), self.admin_set_key, self.lease_zset_key,
+                                   self.lease_hash_key], args=[size, admin_id, lease_id, expire_time], client=pipe)
+        result_list = pipe.execute()
+        return [(admin_id, lease_id if str_msgs else None, str_msgs or []) for (admin_id, _), lease_id, str_msgs in
+                zip(admin_size_list, lease_id_list, result_list)]
+
+    def ack(self, *lease_ids):
+        """
+        确认消息已经处理，删除租约
+        :param lease_ids:
+        :return:
+        """
+        lease_ids = filter(None, lease_ids)
+        if not lease_ids:
+            return
+        pipe = self.redis_conn.pipeline(transaction=True)
+        pipe.hdel(self.lease_hash_key, *lease_ids)
+        pipe.zrem(self.lease_zset_key, *lease_ids)
+        pipe.execute()
+
+    def requeue(self, *lease_ids):
+        """
+        消息处理失败，将租约中的消息放回用户队列头部
+        :param lease_ids:
+        :return: 放回的租约数目
+        """
+        lease_ids = filter(None, lease_ids)
+        if not lease_ids:
+            return 0
+        return self._requeue_script(keys=[self.lease_zset_key, self.lease_hash_key, self.admin_set_key],
+                                    args=[self.queue_key_prefix, self.queue_key_suffix] + list(lease_ids))
+
+    def reclaim_expired_leases(self, force=False):
+        """
+        回收过期租约，进程异常退出时未确认的消息会重新放回队列，按照reclaim_interval限制执行频率
+        :param force:
+        :return: 回收的租约数目
+        """
+        cur_time = time.time()
+        if not force and cur_time - self._last_reclaim_time < self.reclaim_interval:
+            return 0
+        self._last_reclaim_time = cur_time
+        try:
+            count = self._reclaim_script(keys=[self.lease_zset_key, self.lease_hash_key, self.admin_set_key],
+                                         args=[self.queue_key_prefix, self.queue_key_suffix, cur_time,
+                                               self.reclaim_size])
+            if count:
+                app_log.warning('Reclaim {0} expired msg leases from {1}', count, self.lease_zset_key)
+            return count
+        except Exception as e:
+            app_log.error('Reclaim expired msg leases error, key={0}', e, self.lease_zset_key)
+            return 0
+
+
+class InMemoryMsgQueue(object):
+    """
+    进程内用户消息队列，和RedisMsgQueue接口相同，租约不会过期，用于分片和消息处理测试
+    """
+
+    def __init__(self, queue_key='sp_msg_queue_{0}'):
+        self.queue_key = queue_key
+        self.queue_dict = {}
+        self.lease_dict = {}
+
+    def get_queue_key(self, admin_id):
+        return self.queue_key.format(admin_id)
+
+    def push(self, admin_msgs_list):
+        for admin_id, str_msgs in admin_msgs_list:
+            if str_msgs:
+                self.queue_dict.setdefault(admin_id, []).extend(str_msgs)
+
+    def sizes(self, admin_ids):
+        return [len(self.queue_dict.get(admin_id, [])) for admin_id in admin_ids]
+
+    def query_admin_ids(self, discovery='set'):
+        return [admin_id for admin_id, str_msgs in self.queue_dict.iteritems() if str_msgs]
+
+    def pop(self, admin_size_list):
+        result_list = []
+        for admin_id, size in filter(lambda item: item[1] > 0, admin_size_list):
+            str_msgs = self.queue_dict.get(admin_id, [])[:size]
+            lease_id = None
+            if str_msgs:
+                self.queue_dict[admin_id] = self.queue_dict[admin_id][len(str_msgs):]
+                lease_id = uuid.uuid4().hex
+                self.lease_dict[lease_id] = (admin_id, str_msgs)
+            result_list.append((admin_id, lease_id, str_msgs))
+        return result_list
+
+    def ack(self, *lease_ids):
+        for lease_id in lease_ids:
+            self.lease_dict.pop(lease_id, None)
+
+    def requeue(self, *lease_ids):
+        count = 0
+        for lease_id in lease_ids:
+            if lease_id in self.lease_dict:
+                admin_id, str_msgs = self.lease_dict.pop(lease_id)
+                self.queue_dict[admin_id] = str_msgs + self.queue_dict.get(admin_id, [])
+                count += 1
+        return count
+
+    def reclaim_expired_leases(self, force=False):
+        return 0
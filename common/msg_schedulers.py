@@ -0,0 +1,246 @@
+# coding=utf-8
+"""
+MQ消息公平调度，同一级别的用户之间按照权重进行差额轮询(DRR)，用户消费速度由集群共享的REDIS令牌桶限制
+"""
+from bisect import bisect_right
+import time
+
+__author__ = 'liuzhaoming'
+
+# 批量获取令牌，令牌不足时返回剩余的整数个令牌
+# KEYS[i] 用户令牌桶key
+# ARGV[1] 当前时间 ARGV[i*3-1] 请求令牌数目 ARGV[i*3] 每秒生成令牌数目 ARGV[i*3+1] 令牌桶容量
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local result = {}
+for index = 1, #KEYS do
+    local requested = tonumber(ARGV[index * 3 - 1])
+    local rate = tonumber(ARGV[index * 3])
+    local capacity = tonumber(ARGV[index * 3 + 1])
+    local bucket = redis.call('HMGET', KEYS[index], 'tokens', 'time')
+    local tokens = tonumber(bucket[1]) or capacity
+    local last_time = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - last_time) * rate)
+    local granted = math.max(0, math.min(requested, math.floor(tokens)))
+    redis.call('HMSET', KEYS[index], 'tokens', tostring(tokens - granted), 'time', tostring(now))
+    redis.call('EXPIRE', KEYS[index], math.ceil(capacity / rate) + 60)
+    result[index] = granted
+end
+return result
+"""
+
+
+class RedisTokenBucket(object):
+    """
+    集群共享的用户令牌桶，每个用户一个REDIS hash，多个用户的令牌一次脚本调用获取
+    """
+
+    def __init__(self, redis_conn, key_prefix='sp_msg_bucket'):
+        self._redis_conn = redis_conn
+        self.key_prefix = key_prefix
+        self._acquire_script = redis_conn.register_script(_ACQUIRE_SCRIPT)
+
+    def get_key(self, admin_id):
+        return '{0}_{1}'.format(self.key_prefix, admin_id)
+
+    def acquire(self, request_list, cur_time=None):
+        """
+        批量获取令牌
+        :param request_list: [(admin_id, requested, rate, capacity), ...]，rate为每秒生成令牌数目
+        :param cur_time:
+        :return: 和request_list对应的获取到的令牌数目列表
+        """
+        if not request_list:
+            return []
+        args = [cur_time or time.time()]
+        for _, requested, rate, capacity in request_list:
+            args.extend((requested, rate, capacity))
+        return map(int, self._acquire_script(keys=[self.get_key(item[0]) for item in request_list], args=args))
+
+    def refund(self, refund_list):
+        """
+        归还没有使用的令牌，下次获取时按照容量截断
+        :param refund_list: [(admin_id, tokens), ...]
+        :return:
+        """
+        refund_list = filter(lambda item: item[1] > 0, refund_list)
+        if not refund_list:
+            return
+        pipe = self._redis_conn.pipeline(transaction=False)
+        for admin_id, tokens in refund_list:
+            pipe.hincrbyfloat(self.get_key(admin_id), 'tokens', tokens)
+        pipe.execute()
+
+    def get_tokens(self, admin_ids):
+        """
+        获取用户令牌桶中上次获取后剩余的令牌数目，不包含之后生成的令牌
+        :param admin_ids:
+        :return: {admin_id: tokens}
+        """
+        pipe = self._redis_conn.pipeline(transaction=False)
+        for admin_id in admin_ids:
+            pipe.hget(self.get_key(admin_id), 'tokens')
+        return dict((admin_id, float(tokens) if tokens is not None else None) for admin_id, tokens in
+                    zip(admin_ids, pipe.execute()))
+
+
+class LocalTokenBucket(object):
+    """
+    进程内令牌桶，和RedisTokenBucket接口相同，用于调度模拟
+    """
+
+    def __init__(self):
+        self.bucket_dict = {}
+
+    def acquire(self, request_list, cur_time=None):
+        cur_time = cur_time if cur_time is not None else time.time()
+        result = []
+        for admin_id, requested, rate, capacity in request_list:
+            tokens, last_time = self.bucket_dict.get(admin_id, (capacity, cur_time))
+            tokens = min(capacity, tokens + max(0, cur_time - last_time) * rate)
+            granted = max(0, min(requested, int(tokens)))
+            self.bucket_dict[admin_id] = (tokens - granted, cur_time)
+            result.append(granted)
+        return result
+
+    def refund(self, refund_list):
+        for admin_id, tokens in refund_list:
+            if admin_id in self.bucket_dict and tokens > 0:
+                bucket_tokens, last_time = self.bucket_dict[admin_id]
+                self.bucket_dict[admin_id] = (bucket_tokens + tokens, last_time)
+
+    def get_tokens(self, admin_ids):
+        return dict((admin_id, self.bucket_dict[admin_id][0] if admin_id in self.bucket_dict else None) for admin_id
+                    in admin_ids)
+
+
+class MsgScheduler(object):
+    """
+    差额轮询调度器，按照用户ID顺序轮询，每次轮到用户时额度增加quantum*weight，可以获取的消息数目为额度整数部分。
+    每一轮所有用户的获取数目之和不超过round_budget，用户因为本轮上限没有用完额度时，下一轮从该用户继续且不再增加额度。
+    额度最多累积两次，队列中消息不足时额度清零，防止空闲或者限速的用户之后突发占用
+    """
+
+    def __init__(self, token_bucket):
+        self.token_bucket = token_bucket
+        self.__deficit_dict = {}
+        self.__cursor_dict = {}
+
+    def plan(self, tier, quota_list, round_budget=None, cur_time=None):
+        """
+        计算本轮每个用户获取的消息数目
+        :param tier: 调度分组，每个分组单独轮询
+        :param quota_list: [(admin_id, quantum, weight, rate, capacity), ...]
+        :param round_budget: 本轮所有用户获取消息数目上限，为空时不限制
+        :param cur_time:
+        :return: [(admin_id, size), ...]，size为获取到令牌的消息数目
+        """
+        deficit_dict = self.__deficit_dict.setdefault(tier, {})
+        quota_dict = dict((item[0], item[1:]) for item in quota_list)
+        for admin_id in deficit_dict.keys():
+            if admin_id not in quota_dict:
+                del deficit_dict[admin_id]
+
+        admin_ids = sorted(quota_dict)
+        # 上一轮最后访问的用户，以及该用户是否因为本轮上限没有用完额度
+        cursor, is_resume = self.__cursor_dict.get(tier, (None, False))
+        if cursor is None:
+            start = 0
+        elif is_resume and cursor in quota_dict:
+            start = admin_ids.index(cursor)
+        else:
+            start, is_resume = bisect_right(admin_ids, cursor), False
+        remaining = round_budget if round_budget else float('inf')
+        # 同一个用户本轮可能访问两次，获取数目合并为一个请求
+        size_dict = {}
+        plan_ids = []
+        visit_ids = admin_ids[start:] + admin_ids[:start]
+        if is_resume:
+            # 继续上一轮没有用完的额度不算作一次轮询，本轮最后再次访问该用户
+            visit_ids.append(cursor)
+        for pos, admin_id in enumerate(visit_ids):
+            if remaining <= 0:
+                break
+            quantum, weight, rate, capacity = quota_dict[admin_id]
+            share = quantum * weight
+            planned = size_dict.get(admin_id, 0)
+            if pos == 0 and is_resume:
+                deficit = deficit_dict.get(admin_id, 0)
+            else:
+                deficit = min(deficit_dict.get(admin_id, 0) + share, planned + max(share * 2, 1))
+            deficit_dict[admin_id] = deficit
+            size = int(min(deficit - planned, remaining))
+            self.__cursor_dict[tier] = (admin_id, size < int(deficit - planned))
+            if size > 0:
+                if admin_id not in size_dict:
+                    plan_ids.append(admin_id)
+                size_dict[admin_id] = planned + size
+                remaining -= size
+
+        request_list = [(admin_id, size_dict[admin_id]) + quota_dict[admin_id][2:] for admin_id in plan_ids]
+        granted_list = self.token_bucket.acquire(request_list, cur_time)
+        return [(item[0], granted) for item, granted in zip(request_list, granted_list) if granted > 0]
+
+    def complete(self, tier, fetch_result_list):
+        """
+        根据实际获取的消息数目更新用户额度，归还没有使用的令牌
+        :param tier:
+        :param fetch_result_list: [(admin_id, size, fetched), ...]
+        :return:
+        """
+        deficit_dict = self.__deficit_dict.setdefault(tier, {})
+        refund_list = []
+        for admin_id, size, fetched in fetch_result_list:
+            if fetched < size:
+                # 队列中的消息已经取完
+                deficit_dict[admin_id] = 0
+                refund_list.append((admin_id, size - fetched))
+            elif admin_id in deficit_dict:
+                deficit_dict[admin_id] = max(deficit_dict[admin_id] - fetched, 0)
+        self.token_bucket.refund(refund_list)
+
+    def get_deficits(self, tier):
+        return dict(self.__deficit_dict.get(tier, {}))
+
+
+def simulate_msg_schedule(admin_specs, rounds=100, round_budget=None, round_interval=0.02):
+    """
+    调度模拟，用于调整权重、限速和每轮上限配置，不访问REDIS
+    :param admin_specs: {admin_id: {'backlog': 初始积压消息数, 'arrival': 每轮新到达消息数, 'quantum': 每轮额度,
+                         'weight': 权重, 'rate': 每秒令牌数, 'capacity': 令牌桶容量}}
+    :param rounds: 模拟轮数
+    :param round_budget: 每轮所有用户获取消息数目上限
+    :param round_interval: 每轮间隔时间，单位秒
+    :return: {admin_id: {'served': 处理消息数, 'share': 处理消息占比, 'backlog': 剩余积压, 'max_backlog': 最大积压,
+              'lag_seconds': 剩余积压按照处理速度估算的延迟}}
+    """
+    scheduler = MsgScheduler(LocalTokenBucket())
+    backlog_dict = dict((admin_id, spec.get('backlog', 0)) for admin_id, spec in admin_specs.iteritems())
+    served_dict = dict.fromkeys(admin_specs, 0)
+    max_backlog_dict = dict(backlog_dict)
+    for round_num in xrange(rounds):
+        cur_time = round_num * round_interval
+        for admin_id, spec in admin_specs.iteritems():
+            backlog_dict[admin_id] += spec.get('arrival', 0)
+            max_backlog_dict[admin_id] = max(max_backlog_dict[admin_id], backlog_dict[admin_id])
+        quota_list = [(admin_id, spec.get('quantum', 50), spec.get('weight', 1), spec.get('rate', 20),
+                       spec.get('capacity', 100)) for admin_id, spec in admin_specs.iteritems()
+                      if backlog_dict[admin_id] > 0]
+        fetch_result_list = []
+        for admin_id, size in scheduler.plan('simulate', quota_list, round_budget, cur_time):
+            fetched = min(size, backlog_dict[admin_id])
+            backlog_dict[admin_id] -= fetched
+            served_dict[admin_id] += fetched
+            fetch_result_list.append((admin_id, size, fetched))
+        scheduler.complete('simulate', fetch_result_list)
+
+    total_served = sum(served_dict.itervalues())
+    duration = rounds * round_interval
+    result = {}
+    for admin_id in admin_specs:
+        served_rate = served_dict[admin_id] / duration if duration else 0
+        result[admin_id] = {'served': served_dict[admin_id],
+                            'share': round(float(served_dict[admin_id]) / total_served, 4) if total_served else 0,
+                            'backlog': backlog_dict[admin_id], 'max_backlog': max_backlog_dict[admin_id],
+                            'lag_seconds': round(backlog_dict[admin_id] / served_rate, 3) if served_rate else None}
+    return result
@@ -0,0 +1,230 @@
+# coding=utf-8
+"""
+SLA消息队列分片，用户队列按照adminId一致性哈希分布到多个REDIS实例
+"""
+from bisect import bisect_right, insort
+import hashlib
+import time
+
+__author__ = 'liuzhaoming'
+
+# 租约ID中分片名称和原始租约ID的分隔符，原始租约ID为uuid hex，不包含该字符
+LEASE_SEPARATOR = '@'
+
+
+class ConsistentHashRing(object):
+    """
+    一致性哈希环，每个节点对应replicas个虚拟节点，新增节点时只有落在新节点上的key改变归属
+    """
+
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self.__hash_list = []
+        self.__node_dict = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, str):
+            key = unicode(key).encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def add_node(self, node):
+        for index in xrange(self.replicas):
+            hash_value = self._hash('{0}#{1}'.format(node, index))
+            if hash_value not in self.__node_dict:
+                insort(self.__hash_list, hash_value)
+            self.__node_dict[hash_value] = node
+
+    def get_node(self, key):
+        if not self.__hash_list:
+            return None
+        pos = bisect_right(self.__hash_list, self._hash(key)) % len(self.__hash_list)
+        return self.__node_dict[self.__hash_list[pos]]
+
+
+class ShardedMsgQueue(object):
+    """
+    分片用户消息队列，和RedisMsgQueue接口相同，每个分片是一个RedisMsgQueue或者接口相同的队列。
+    新增分片后部分用户的归属分片发生变化，出队时先取完旧分片中剩余的消息，再读取归属分片，保证同一个用户的消息顺序。
+    租约ID带有分片名称，确认和重新入队时发送到租约所在的分片
+    """
+
+    def __init__(self, shard_queue_dict, replicas=160):
+        """
+        :param shard_queue_dict: {分片名称: 分片队列}
+        :param replicas: 每个分片的虚拟节点数目
+        """
+        self.shard_queue_dict = shard_queue_dict
+        self.ring = ConsistentHashRing(sorted(shard_queue_dict), replicas)
+        # 最近一次查询到的用户所在分片列表
+        self.__admin_shards_dict = {}
+
+    def get_shard(self, admin_id):
+        return self.ring.get_node(admin_id)
+
+    def get_shard_queue(self, admin_id):
+        return self.shard_queue_dict[self.get_shard(admin_id)]
+
+    def get_queue_key(self, admin_id):
+        return self.get_shard_queue(admin_id).get_queue_key(admin_id)
+
+    def push(self, admin_msgs_list):
+        """
+        按照归属分片分组入队，每个分片一个事务
+        :param admin_msgs_list: [(admin_id, [str_msg, ...]), ...]
+        :return:
+        """
+        shard_msgs_dict = {}
+        for admin_id, str_msgs in admin_msgs_list:
+            shard_msgs_dict.setdefault(self.get_shard(admin_id), []).append((admin_id, str_msgs))
+        for shard, shard_admin_msgs_list in shard_msgs_dict.iteritems():
+            self.shard_queue_dict[shard].push(shard_admin_msgs_list)
+
+    def sizes(self, admin_ids):
+        """
+        用户队列长度，包含旧分片中没有取完的消息
+        :param admin_ids:
+        :return:
+        """
+        total_size_list = [0] * len(admin_ids)
+        for shard_queue in self.shard_queue_dict.itervalues():
+            total_size_list = map(sum, zip(total_size_list, shard_queue.sizes(admin_ids)))
+        return total_size_list
+
+    def query_admin_ids(self, discovery='set'):
+        """
+        查询所有分片中有消息的adminId，同时记录每个用户所在的分片
+        :param discovery:
+        :return:
+        """
+        admin_shards_dict = {}
+        for shard in sorted(self.shard_queue_dict):
+            for admin_id in self.shard_queue_dict[shard].query_admin_ids(discovery):
+                admin_shards_dict.setdefault(admin_id, []).append(shard)
+        self.__admin_shards_dict = admin_shards_dict
+        return admin_shards_dict.keys()
+
+    def get_pop_shard(self, admin_id):
+        """
+        用户出队的分片，旧分片中有剩余消息时优先读取旧分片
+        :param admin_id:
+        :return:
+        """
+        owner_shard = self.get_shard(admin_id)
+        for shard in self.__admin_shards_dict.get(admin_id, ()):
+            if shard != owner_shard:
+                return shard
+        return owner_shard
+
+    def pop(self, admin_size_list):
+        """
+        按照分片分组批量带租约出队，每个分片一次网络往返，返回结果和请求顺序一致
+        :param admin_size_list: [(admin_id, size), ...]
+        :return: [(admin_id, lease_id, [str_msg, ...]), ...]
+        """
+        admin_size_list = filter(lambda item: item[1] > 0, admin_size_list)
+        shard_request_dict = {}
+        for pos, (admin_id, size) in enumerate(admin_size_list):
+            shard_request_dict.setdefault(self.get_pop_shard(admin_id), []).append((pos, admin_id, size))
+        result_list = [None] * len(admin_size_list)
+        for shard, request_list in shard_request_dict.iteritems():
+            shard_queue = self.shard_queue_dict[shard]
+            pop_result_list = shard_queue.pop([(admin_id, size) for _, admin_id, size in request_list])
+            for (pos, _, _), (admin_id, lease_id, str_msgs) in zip(request_list, pop_result_list):
+                result_list[pos] = (admin_id, self.__tag_lease(shard, lease_id), str_msgs)
+        return result_list
+
+    def ack(self, *lease_ids):
+        for shard, shard_lease_ids in self.__group_leases(lease_ids).iteritems():
+            self.shard_queue_dict[shard].ack(*shard_lease_ids)
+
+    def requeue(self, *lease_ids):
+        return sum(self.shard_queue_dict[shard].requeue(*shard_lease_ids) for shard, shard_lease_ids in
+                   self.__group_leases(lease_ids).iteritems())
+
+    def reclaim_expired_leases(self, force=False):
+        return sum(shard_queue.reclaim_expired_leases(force) for shard_queue in self.shard_queue_dict.itervalues())
+
+    def shard_stats(self):
+        """
+        各分片的用户数目，stray_admins为归属其它分片但是仍有剩余消息的用户数目
+        :return:
+        """
+        stats = dict((shard, {'admins': 0, 'stray_admins': 0}) for shard in self.shard_queue_dict)
+        for shard in self.shard_queue_dict:
+            for admin_id in self.shard_queue_dict[shard].query_admin_ids():
+                stats[shard]['admins'] += 1
+                if self.get_shard(admin_id) != shard:
+                    stats[shard]['stray_admins'] += 1
+        return stats
+
+    @staticmethod
+    def __tag_lease(shard, lease_id):
+        return shard + LEASE_SEPARATOR + lease_id if lease_id else None
+
+    def __group_leases(self, lease_ids):
+        shard_leases_dict = {}
+        for tagged_lease_id in filter(None, lease_ids):
+            shard, _, lease_id = tagged_lease_id.rpartition(LEASE_SEPARATOR)
+            if shard in self.shard_queue_dict:
+                shard_leases_dict.setdefault(shard, []).append(lease_id)
+        return shard_leases_dict
+
+
+class ShardedDelayQueue(object):
+    """
+    分片延迟消息队列，和RedisDelayQueue接口相同，消息保存在用户归属分片。
+    领取时遍历所有分片，新增分片后从旧分片领取的消息先写入归属分片再从旧分片删除，之后的确认和重新调度都在归属分片
+    """
+
+    def __init__(self, shard_queue_dict, replicas=160):
+        self.shard_queue_dict = shard_queue_dict
+        self.ring = ConsistentHashRing(sorted(shard_queue_dict), replicas)
+
+    def get_shard_queue(self, admin_id):
+        return self.shard_queue_dict[self.ring.get_node(admin_id)]
+
+    def schedule(self, admin_id, tier, due_msg_list, remove_msgs=()):
+        return self.get_shard_queue(admin_id).schedule(admin_id, tier, due_msg_list, remove_msgs)
+
+    def ack(self, admin_id, tier, str_msgs):
+        return self.get_shard_queue(admin_id).ack(admin_id, tier, str_msgs)
+
+    def claim(self, tier, size, max_admins=100, cur_time=None):
+        """
+        领取所有分片的到期消息
+        :param tier:
+        :param size:
+        :param max_admins:
+        :param cur_time:
+        :return:
+        """
+        cur_time = cur_time or time.time()
+        result_list = []
+        for shard in sorted(self.shard_queue_dict):
+            shard_queue = self.shard_queue_dict[shard]
+            for admin_id, str_msgs in shard_queue.claim(tier, size, max_admins, cur_time):
+                owner_queue = self.get_shard_queue(admin_id)
+                if owner_queue is not shard_queue:
+                    # 先写入再删除，进程在两步之间退出时消息可能重复处理但是不会丢失
+                    owner_queue.schedule(admin_id, tier,
+                                         [(cur_time + owner_queue.lease_timeout, str_msg) for str_msg in str_msgs])
+                    shard_queue.ack(admin_id, tier, str_msgs)
+                result_list.append((admin_id, str_msgs))
+        return result_list
+
+    def next_due_time(self, tier):
+        due_time_list = filter(lambda due_time: due_time is not None,
+                               [shard_queue.next_due_time(tier) for shard_queue in self.shard_queue_dict.itervalues()])
+        return min(due_time_list) if due_time_list else None
+
+    def size(self, admin_id):
+        return sum(shard_queue.size(admin_id) for shard_queue in self.shard_queue_dict.itervalues())
+
+    def range(self, admin_id, start=0, size=0):
+        return self.get_shard_queue(admin_id).range(admin_id, start, size)
+
+    def delete(self, admin_id):
+        return sum(shard_queue.delete(admin_id) for shard_queue in self.shard_queue_dict.itervalues())
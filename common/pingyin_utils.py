@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 __author__ = 'liuzhaoming'
 
-from itertools import product, imap
+from itertools import product, imap, islice
 
 import re
 from pypinyin import pinyin
 import pypinyin
 
+from common.caches import TtlLruCache
+from common.configs import config
+
+try:
+    from pypinyin.phrases_dict import phrases_dict
+except ImportError:
+    phrases_dict = {}
+
 SEPARATOR = ' '
+HANS_CHARS = u'\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
 
 
 class PinyinTools(object):
     english_filter_regr = u'[A-Za-z0-9]+'
+    # 和pypinyin一样将字符串切分为汉字片段和非汉字片段
+    segment_regex = re.compile(u'[{0}]+|[^{0}]+'.format(HANS_CHARS))
+    hans_regex = re.compile(u'[{0}]'.format(HANS_CHARS))
+
+    def __init__(self):
+        # 拼音查询结果缓存，key为单个汉字、词典中的词语或者非汉字片段，value为(全拼列表, 首字母和声母列表)
+        self.pinyin_cache = TtlLruCache(config.get_value('/consts/suggest/pinyin_cache_size') or 50000, 0)
+        # 每个词汇最多生成的拼音组合数目，防止多音字过多时组合数目爆炸
+        self.max_combination = config.get_value('/consts/suggest/pinyin_max_combination') or 512
 
     def get_pingyin_combination(self, input_str, separator=SEPARATOR):
         """
@@ -23,18 +41,27 @@ class PinyinTools(object):
         """
         if not input_str:
             return []
-        pinyin_list = self.combine_element(pinyin(input_str, style=pypinyin.NORMAL, heteronym=True), 0)
-        first_letter_list = pinyin(input_str, style=pypinyin.FIRST_LETTER, heteronym=True)
-        initials_letter_list = pinyin(input_str, style=pypinyin.INITIALS, heteronym=True)
-        merge_letter_list = map(lambda a_list, b_list: filter(lambda item: item, set(a_list + b_list)),
-                                first_letter_list, initials_letter_list)
-        pinyin_list += self.combine_element(merge_letter_list, 0) + self.combine_low_up_chars(input_str)
-        # result.extend(self.combine_element(pinyin(input_str, style=pypinyin.FIRST_LETTER, heteronym=True), 0))
+        normal_list, letter_list = self.__get_word_pinyin(input_str)
+        pinyin_list = list(self.combine_element(normal_list, separator))
+        pinyin_list += list(self.combine_element(letter_list, separator)) + self.combine_low_up_chars(input_str)
         pinyin_list += map((lambda element: element.replace(separator, '')), pinyin_list)
-
-        # result + [ele.replace(self.separator) for ele in result]
         return list(set(pinyin_list))
 
+    def get_pingyin_combination_list(self, input_str_list, separator=SEPARATOR):
+        """
+        批量获取词汇的拼音组合，重复的词汇只计算一次
+        :param input_str_list:
+        :param separator:
+        :return: 和input_str_list对应的拼音组合列表
+        """
+        combination_dict = {}
+        result = []
+        for input_str in input_str_list:
+            if input_str not in combination_dict:
+                combination_dict[input_str] = self.get_pingyin_combination(input_str, separator)
+            result.append(list(combination_dict[input_str]))
+        return result
+
     def get_integrated_pingyin_strs(self, input_str):
         """
         获取词汇的完整拼音，包含多音词
@@ -43,21 +70,16 @@ class PinyinTools(object):
         """
         if not input_str:
             return []
-        return self.combine_element(pinyin(input_str, style=pypinyin.NORMAL, heteronym=True), 0, '')
+        return list(self.combine_element(self.__get_word_pinyin(input_str)[0], ''))
 
-
-    def combine_element(self, input_list, start, separator=SEPARATOR):
+    def combine_element(self, input_list, separator=SEPARATOR):
         """
-        组合各个字的拼音
+        组合各个字的拼音，生成器方式计算笛卡尔积，最多生成max_combination个组合
         :param input_list:
-        :param start:
         :param separator:
         :return:
         """
-        if start == len(input_list) - 1:
-            return input_list[start]
-        return [separator.join(element) for element in
-                product(input_list[start], self.combine_element(input_list, start + 1, separator))]
+        return islice(imap(separator.join, product(*input_list)), self.max_combination)
 
     def combine_low_up_chars(self, word):
         """
@@ -70,6 +92,50 @@ class PinyinTools(object):
 
         return []
 
+    def __get_word_pinyin(self, input_str):
+        """
+        获取词汇每个字的全拼列表和首字母声母列表，拼音查询结果按照字缓存
+        :param input_str:
+        :return: (全拼列表的列表, 首字母和声母列表的列表)
+        """
+        normal_list = []
+        letter_list = []
+        for unit in self.__split_pinyin_units(input_str):
+            unit_pinyin = self.pinyin_cache.get(unit)
+            if unit_pinyin is None:
+                unit_pinyin = self.__query_pinyin(unit)
+                self.pinyin_cache.set(unit, unit_pinyin)
+            normal_list.extend(unit_pinyin[0])
+            letter_list.extend(unit_pinyin[1])
+        return normal_list, letter_list
+
+    def __split_pinyin_units(self, input_str):
+        """
+        将词汇切分为拼音查询单元，词典中的词语和非汉字片段作为整体，其他汉字片段按字切分，
+        pypinyin对不在词典中的词语也是逐字查询，因此结果和整体查询一致
+        :param input_str:
+        :return:
+        """
+        for segment in self.segment_regex.findall(input_str):
+            if len(segment) > 1 and segment not in phrases_dict and self.hans_regex.match(segment):
+                for char in segment:
+                    yield char
+            else:
+                yield segment
+
+    def __query_pinyin(self, unit):
+        """
+        查询单元的拼音
+        :param unit:
+        :return:
+        """
+        normal_list = pinyin(unit, style=pypinyin.NORMAL, heteronym=True)
+        first_letter_list = pinyin(unit, style=pypinyin.FIRST_LETTER, heteronym=True)
+        initials_letter_list = pinyin(unit, style=pypinyin.INITIALS, heteronym=True)
+        merge_letter_list = map(lambda a_list, b_list: filter(lambda item: item, set(a_list + b_list)),
+                                first_letter_list, initials_letter_list)
+        return tuple(map(tuple, normal_list)), tuple(map(tuple, merge_letter_list))
+
 
 pingyin_utils = PinyinTools()
 
@@ -84,4 +150,4 @@ if __name__ == '__main__':
                              _initials_letter_list)
     print list(_merge_letter_list)
     print pingyin_utils.get_integrated_pingyin_strs(u'安踏凉鞋测试')
-    print pingyin_utils.get_integrated_pingyin_strs(u'重庆火锅')
\ No newline at end of file
+    print pingyin_utils.get_integrated_pingyin_strs(u'重庆火锅')
@@ -2,8 +2,10 @@
 """
 SLA等级服务策略
 """
+import random
 import threading
 import time
+import uuid
 import ujson as json
 from datetime import date
 from itertools import groupby
@@ -16,7 +18,14 @@ from common.configs import config
 from common.connections import RedisConnectionFactory, KafkaClientFactory
 from common.exceptions import MsgHandlingFailError, RedoMsgQueueFullError, FinalFailMsgQueueFullError, MsgQueueFullError
 from common.loggers import app_log
+from common.msg_codecs import msg_codec
+from common.msg_coalescers import MsgCoalescer
+from common.msg_delay_queues import RedisDelayQueue
+from common.msg_queues import RedisMsgQueue
+from common.msg_schedulers import MsgScheduler, RedisTokenBucket
+from common.msg_shards import ShardedMsgQueue, ShardedDelayQueue
 from common.rest_quest import RestRequest
+from common.utils import get_dict_value_by_path
 from search_platform.settings import SERVICE_BASE_CONFIG
 
 __author__ = 'liuzhaoming'
@@ -91,13 +100,25 @@ class MsgSLA(object):
         # 消息队列key
         self._msg_queue_key = config.get_value(
             '/consts/global/admin_id_cfg/msg_queue_key') or "sp_msg_queue_{0}"
-        # 消息队列key前缀
-        self._msg_queue_key_prefix = config.get_value(
-            '/consts/global/admin_id_cfg/msg_queue_key_prefix') or "sp_msg_queue_*"
-        self._msg_queue_key_pos = len(self._msg_queue_key_prefix) - 1
         # 有消息的用户admin ID队列key
         self._msg_admin_queue_key = config.get_value(
             '/consts/global/admin_id_cfg/msg_admin_queue_key') or "sp_msg_admin_queue"
+        # 有消息的用户admin ID查询方式，set表示读取admin ID集合，scan表示通过SCAN遍历消息队列key
+        self._msg_admin_discovery = config.get_value('/consts/global/admin_id_cfg/msg_admin_discovery') or 'set'
+        # 消息就绪通知key，生产者写入消息后通知对应级别的处理线程，{0}为vip或者experience
+        self._msg_ready_key = config.get_value('/consts/global/admin_id_cfg/msg_ready_key') or 'sp_msg_ready_{0}'
+        # 重做消息就绪通知key
+        self._redo_msg_ready_key = config.get_value(
+            '/consts/global/admin_id_cfg/msg_redo_ready_key') or 'sp_msg_redo_ready_{0}'
+        # 没有消息时阻塞等待通知的超时时间，单位秒，超时后仍然会检查一次队列
+        self._msg_wait_timeout = config.get_value('/consts/global/admin_id_cfg/msg_wait_timeout') or 1
+        # 消息租约key前缀
+        self._msg_lease_key = config.get_value('/consts/global/admin_id_cfg/msg_lease_key') or 'sp_msg_lease'
+        # 重做消息租约key前缀
+        self._redo_msg_lease_key = config.get_value(
+            '/consts/global/admin_id_cfg/msg_redo_lease_key') or 'sp_msg_redo_lease'
+        # 消息租约超时时间，超时未确认的消息会重新放回队列
+        self._msg_lease_timeout = config.get_value('/consts/global/admin_id_cfg/msg_lease_timeout') or 300
         # vip用户每次重做消息数目
         self._vip_redo_msg_iter_size = config.get_value(
             '/consts/global/admin_id_cfg/vip_redo_iter_capacity') or 50
@@ -140,8 +161,33 @@ class MsgSLA(object):
         self._final_queue_threshold = config.get_value(
             '/consts/global/admin_id_cfg/final_queue_threshold') or 500
 
+        # msg_queue保存通知、统计、令牌桶和最终失败消息等全局数据，没有配置msg_queue_shards时同时保存用户队列
         self._redis_host = SERVICE_BASE_CONFIG.get('msg_queue')
         self._redis_conn = RedisConnectionFactory.get_redis_connection(self._redis_host)
+        # 用户消息队列、重做队列和延迟重做队列按照adminId一致性哈希分布到msg_queue_shards中的多个REDIS
+        shard_hosts = filter(None, map(lambda host: host.strip(),
+                                       (SERVICE_BASE_CONFIG.get('msg_queue_shards') or self._redis_host).split(',')))
+        shard_conn_dict = dict((host, RedisConnectionFactory.get_redis_connection(host)) for host in shard_hosts)
+        shard_replicas = config.get_value('/consts/global/admin_id_cfg/msg_shard_replicas') or 160
+        self._msg_queue = ShardedMsgQueue(dict(
+            (host, RedisMsgQueue(redis_conn, self._msg_queue_key, self._msg_admin_queue_key, self._msg_lease_key,
+                                 self._msg_lease_timeout)) for host, redis_conn in shard_conn_dict.iteritems()),
+            shard_replicas)
+        self._redo_msg_queue = ShardedMsgQueue(dict(
+            (host, RedisMsgQueue(redis_conn, self._redo_msg_queue_key, self._redo_msg_admin_queue_key,
+                                 self._redo_msg_lease_key, self._msg_lease_timeout)) for host, redis_conn in
+            shard_conn_dict.iteritems()), shard_replicas)
+        # 延迟重做队列，失败消息按照下次重做时间排序，超过重做次数的消息放入最终失败消息队列
+        redo_delay_cfg = config.get_value('/consts/global/admin_id_cfg/msg_redo_delay') or {}
+        self._redo_delay_queue = ShardedDelayQueue(dict(
+            (host, RedisDelayQueue(redis_conn, redo_delay_cfg.get('queue_key') or 'sp_msg_delay_queue_{0}',
+                                   redo_delay_cfg.get('admin_key') or 'sp_msg_delay_admin_{0}',
+                                   redo_delay_cfg.get('lease_timeout') or self._msg_lease_timeout)) for
+            host, redis_conn in shard_conn_dict.iteritems()), shard_replicas)
+        self._msg_coalescer = MsgCoalescer(self._redis_conn)
+        # 用户之间的公平调度，消费速度由集群共享的令牌桶限制
+        self._msg_scheduler = MsgScheduler(RedisTokenBucket(self._redis_conn, config.get_value(
+            '/consts/global/admin_id_cfg/msg_scheduler/bucket_key') or 'sp_msg_bucket'))
         self._vip_redo_pool = Pool(self._vip_redo_thread_num)
         self._experience_redo_pool = Pool(self._experience_redo_thread_num)
         self._vip_msg_pool = Pool(self._vip_msg_thread_num)
@@ -171,7 +217,7 @@ class MsgSLA(object):
 
     def limit_msg_rate(self, admin_id, fun, max_calls=None, time_interval=None, *args, **kwargs):
         """
-        现在MQ消息消费的速度
+        限制MQ消息消费的速度，使用集群共享的令牌桶
         :param admin_id:
         :param fun:
         :param max_calls:
@@ -188,27 +234,10 @@ class MsgSLA(object):
             time_interval = admin_config.get_admin_param_value(admin_id, 'msg_time_interval') or (
                 self._vip_sla_time_interval if admin_config.is_vip(admin_id) else self._experience_sla_time_interval)
 
-        msg_status_cache = self._get_msg_cache('mq_msg', admin_id)
-        cur_time = time.time()
-        if 'last_time' not in msg_status_cache:
-            msg_status_cache['last_time'] = cur_time
-        if 'last_calls' not in msg_status_cache:
-            msg_status_cache['last_calls'] = 0
-
-        time_delta = cur_time - msg_status_cache['last_time']
-        if msg_status_cache['last_calls'] > max_calls:
-            if time_delta < time_interval:
-                if 'print_log' not in msg_status_cache or not msg_status_cache['print_log']:
-                    app_log.warning("The admin id {} msg exceed limit {} {}", admin_id, max_calls, time_interval)
-                    msg_status_cache['print_log'] = True
-
-                return None
-
-        if time_delta >= time_interval:
-            msg_status_cache['last_calls'] = 1
-            msg_status_cache['last_time'] = cur_time
-        else:
-            msg_status_cache['last_calls'] += 1
+        if not self._msg_scheduler.token_bucket.acquire(
+                [(admin_id, 1, float(max_calls) / time_interval, max_calls)])[0]:
+            app_log.warning("The admin id {} msg exceed limit {} {}", admin_id, max_calls, time_interval)
+            return None
 
         return fun(*args, **kwargs)
 
@@ -222,38 +251,101 @@ class MsgSLA(object):
             return
 
         app_log.info("Send msg to queue {}", msgs)
-        admin_id_list = []
-        for admin_id, admin_msgs in groupby(msgs, lambda msg: msg['adminId'] if 'adminId' in msg else 'default'):
-            admin_id_list.append(admin_id)
-            str_admin_msgs = map(lambda msg: json.dumps(msg), admin_msgs)
-            str_key = self._msg_queue_key.format(admin_id)
-            try:
-                self._redis_conn.rpush(str_key, *str_admin_msgs)
-            except Exception as e:
-                app_log.error('Send msg to queue fail, admin_id={0}, msgs={1}', e, admin_id, str_admin_msgs)
+        admin_msgs_list = [(admin_id, map(msg_codec.encode, admin_msgs)) for admin_id, admin_msgs in
+                           groupby(msgs, lambda msg: msg['adminId'] if 'adminId' in msg else 'default')]
         try:
-            self._redis_conn.sadd(self._msg_admin_queue_key, *admin_id_list)
+            self._msg_queue.push(admin_msgs_list)
         except Exception as e:
-            app_log.error('Send msg admin id to queue fail, admin_ids={0}', e, admin_id_list)
+            app_log.error('Send msg to queue fail, msgs={0}', e, msgs)
+            return
+        self._notify_ready(self._msg_ready_key, [admin_id for admin_id, _ in admin_msgs_list])
+
+    def _notify_ready(self, ready_key, admin_ids):
+        """
+        通知处理线程有新的消息，通知列表最多保留一个元素，多次通知只会唤醒一次
+        :param ready_key:
+        :param admin_ids:
+        :return:
+        """
+        try:
+            pipe = self._redis_conn.pipeline(transaction=False)
+            for tier in set(map(self._get_tier, admin_ids)):
+                pipe.lpush(ready_key.format(tier), 1)
+                pipe.ltrim(ready_key.format(tier), 0, 0)
+            pipe.execute()
+        except Exception as e:
+            app_log.error('Notify msg ready fail, key={0}, admin_ids={1}', e, ready_key, admin_ids)
+
+    def _wait_ready(self, ready_key, is_vip, timeout):
+        """
+        阻塞等待消息就绪通知
+        :param ready_key:
+        :param is_vip:
+        :param timeout: 超时时间，单位秒，BRPOP只支持整数秒
+        :return: 是否收到通知
+        """
+        try:
+            return self._redis_conn.brpop(ready_key.format('vip' if is_vip else 'experience'),
+                                          max(int(timeout), 1)) is not None
+        except Exception as e:
+            app_log.error('Wait msg ready fail, key={0}', e, ready_key)
+            time.sleep(min(timeout, 1))
+            return False
+
+    def wait_msg_ready(self, is_vip, timeout=None):
+        """
+        没有待处理消息时阻塞等待新消息通知，代替固定间隔轮询
+        :param is_vip:
+        :param timeout:
+        :return:
+        """
+        return self._wait_ready(self._msg_ready_key, is_vip, timeout or self._msg_wait_timeout)
+
+    def wait_redo_msg_ready(self, is_vip, timeout):
+        """
+        阻塞等待新的重做消息通知
+        :param is_vip:
+        :param timeout:
+        :return:
+        """
+        return self._wait_ready(self._redo_msg_ready_key, is_vip, timeout)
+
+    @staticmethod
+    def _get_tier(admin_id):
+        return 'vip' if admin_config.is_vip(admin_id) else 'experience'
 
     def process_msg(self, msg_handler_fun, is_vip=True):
         """
         启动消息处理
         :param msg_handler_fun:
         :param is_vip
-        :return:
+        :return: 是否还有待处理的消息，没有时处理线程可以阻塞等待新消息通知
         """
+        self._msg_queue.reclaim_expired_leases()
         experience_admin_ids, vip_admin_ids = self._query_msg_admin_ids()
-        # app_log.info('kkkkkk process_msg experience ids={0},  is_vip={1}', experience_admin_ids, is_vip)
-        if is_vip:
-            if vip_admin_ids:
-                self._vip_msg_pool.map(lambda vip_admin_id: self.process_admin_msg(vip_admin_id, msg_handler_fun),
-                                       vip_admin_ids)
-        else:
-            if experience_admin_ids:
-                self._experience_msg_pool.map(
-                    lambda experience_admin_id: self.process_admin_msg(experience_admin_id, msg_handler_fun),
-                    experience_admin_ids)
+        admin_ids = vip_admin_ids if is_vip else experience_admin_ids
+
+        # 所有用户的消息一次批量出队，处理完成后一次批量确认
+        fetch_admin_msg_list = self._fetch_msg(admin_ids) if admin_ids else []
+        # 合并窗口内同一个文档的消息，窗口未到期时消息保留在缓冲区中，没有新消息时也需要检查窗口
+        tier = 'vip' if is_vip else 'experience'
+        admin_msg_list = self._msg_coalescer.coalesce(fetch_admin_msg_list, tier, self._get_msg_batch_linger(tier))
+        if admin_msg_list:
+            msg_pool = self._vip_msg_pool if is_vip else self._experience_msg_pool
+            self._finish_msg_leases(
+                msg_pool.map(lambda admin_msg: self._handle_admin_msg(admin_msg, msg_handler_fun), admin_msg_list))
+        return bool(fetch_admin_msg_list) or self._msg_coalescer.has_pending(tier)
+
+    def _get_msg_batch_linger(self, tier):
+        """
+        获取批量分发消息的等待时间，等待期间出队的消息合并为更大的批次，单位秒
+        :param tier: vip或者experience
+        :return:
+        """
+        batch_cfg = config.get_value('/consts/global/admin_id_cfg/msg_batch') or {}
+        if not batch_cfg.get('enable', True):
+            return 0
+        return ((batch_cfg.get(tier) or {}).get('linger_ms') or 0) / 1000.0
 
     def process_admin_msg(self, admin_id, msg_handler_fun):
         """
@@ -261,28 +353,75 @@ class MsgSLA(object):
         :param admin_id:
         :return:
         """
-        try:
-            cur_msgs = self._fetch_msg(admin_id)
-            if not cur_msgs:
-                return
+        self._finish_msg_leases(map(lambda admin_msg: self._handle_admin_msg(admin_msg, msg_handler_fun),
+                                    self._msg_coalescer.coalesce(self._fetch_msg([admin_id]))))
 
-            app_log.info("sla fetch {0} messages {1}".format(len(cur_msgs), json.dumps(cur_msgs)))
-            msg_handler_fun(cur_msgs)
-
-            self._update_msg_process_status(admin_id, cur_msgs)
-
-            self._remove_msg(admin_id, len(cur_msgs))
+    def _handle_admin_msg(self, admin_msg, msg_handler_fun):
+        """
+        处理单个用户出队的消息，返回(租约ID列表, 是否处理成功)
+        :param admin_msg: (admin_id, lease_ids, cur_msgs)
+        :param msg_handler_fun:
+        :return:
+        """
+        admin_id, lease_ids, cur_msgs = admin_msg
+        try:
+            if cur_msgs:
+                app_log.info("sla fetch {0} messages {1}".format(len(cur_msgs), json.dumps(cur_msgs)))
+                msg_handler_fun(cur_msgs)
+                if not self._is_scheduler_enable():
+                    self._update_msg_process_status(admin_id, cur_msgs)
+            return lease_ids, True
         except Exception as e:
             app_log.error("process admin {0} msg fail ".format(admin_id))
             app_log.exception(e)
+            return lease_ids, False
+
+    def _finish_msg_leases(self, lease_result_list):
+        """
+        处理成功的消息确认删除，处理失败的消息放回队列头部，被合并的消息和合并后的消息一起确认或者放回
+        :param lease_result_list: [(lease_ids, success), ...]
+        :return:
+        """
+        ack_lease_ids = [lease_id for lease_ids, success in lease_result_list if success for lease_id in lease_ids]
+        # 同一个用户的多个租约按照出队顺序倒序放回队列头部，保持消息原有顺序
+        requeue_lease_ids = [lease_id for lease_ids, success in reversed(lease_result_list) if not success
+                             for lease_id in reversed(lease_ids)]
+        try:
+            self._msg_queue.ack(*ack_lease_ids)
+            self._msg_queue.requeue(*requeue_lease_ids)
+        except Exception as e:
+            app_log.error('finish msg leases error, ack={0}, requeue={1}', e, ack_lease_ids, requeue_lease_ids)
+
+    def get_coalesce_stats(self):
+        """
+        获取各数据流消息合并统计信息
+        :return:
+        """
+        return self._msg_coalescer.stats()
+
+    def reset_coalesce_stats(self):
+        """
+        清空消息合并统计信息
+        :return:
+        """
+        return self._msg_coalescer.reset_stats()
 
     def process_redo_msg(self, msg_handler_fun, is_vip=True):
         """
         启动消息重做任务
         :param msg_handler_fun
         :param is_vip
-        :return:
+        :return: 开启延迟重做队列时返回该级别最早的到期时间，没有重做消息时返回None
         """
+        if self._is_redo_delay_enable():
+            next_due_time = None
+            if self._vip_msg_redo_enable if is_vip else self._experience_msg_redo_enable:
+                self._migrate_legacy_redo_msg(is_vip)
+                next_due_time = self._process_delayed_redo_msg(msg_handler_fun, is_vip)
+            self.check_final_msg_num()
+            return next_due_time
+
+        self._redo_msg_queue.reclaim_expired_leases()
         experience_admin_ids, vip_admin_ids = self._query_redo_admin_ids()
         if is_vip:
             if self._vip_msg_redo_enable and vip_admin_ids:
@@ -303,8 +442,9 @@ class MsgSLA(object):
         :param admin_id:
         :return:
         """
-        cur_redo_msgs = self._fetch_redo_msg(admin_id)
+        lease_id, cur_redo_msgs = self._fetch_redo_msg(admin_id)
         if not cur_redo_msgs:
+            self._ack_redo_msg(lease_id)
             return
 
         cur_time = time.time()
@@ -322,36 +462,175 @@ class MsgSLA(object):
 
             if need_redo_msgs:
                 app_log.info('begin to send redo fail msgs to redo queue')
-                self._send_msg_to_redo_queue_by_admin(not_to_time_msgs, admin_id)
+                self._send_msg_to_redo_queue_by_admin(need_redo_msgs, admin_id)
 
             if final_msgs:
                 app_log.info('begin to send redo fail msgs to final queue')
                 self._send_msg_to_final_queue(final_msgs)
         finally:
-            self._remove_redo_msg(admin_id, len(cur_redo_msgs))
+            self._ack_redo_msg(lease_id)
+
+    def _is_redo_delay_enable(self):
+        return (config.get_value('/consts/global/admin_id_cfg/msg_redo_delay') or {}).get('enable', True)
+
+    def _process_delayed_redo_msg(self, msg_handler_fun, is_vip):
+        """
+        领取延迟重做队列中到期的消息并重做，不读取未到期的消息
+        :param msg_handler_fun:
+        :param is_vip:
+        :return: 该级别最早的到期时间
+        """
+        tier = 'vip' if is_vip else 'experience'
+        claim_admins = (config.get_value('/consts/global/admin_id_cfg/msg_redo_delay') or {}).get('claim_admins')
+        try:
+            claimed_list = self._redo_delay_queue.claim(tier, self._get_redo_iter_size_by_tier(is_vip),
+                                                        claim_admins or 100)
+        except Exception as e:
+            app_log.error('claim delayed redo msg error, tier={0}', e, tier)
+            return None
+
+        if claimed_list:
+            redo_pool = self._vip_redo_pool if is_vip else self._experience_redo_pool
+            redo_pool.map(lambda claimed: self.process_admin_delayed_redo_msg(claimed, tier, msg_handler_fun),
+                          claimed_list)
+        return self._redo_delay_queue.next_due_time(tier)
 
-    def _query_msg_admin_ids_by_set(self):
+    def process_admin_delayed_redo_msg(self, claimed, tier, msg_handler_fun):
         """
-        查询需要处理消息的Admin用户ID，已经废弃，现在直接通过keys * 来查询adminId
+        重做单个用户领取的到期消息，重做失败的消息由process_do_error_message重新放回延迟重做队列
+        :param claimed: (admin_id, [str_msg, ...])
+        :param tier:
+        :param msg_handler_fun:
         :return:
         """
-        admin_ids = self._redis_conn.smembers(self._msg_admin_queue_key)
-        vip_admin_ids = []
-        experience_admin_ids = []
-        for admin_id in admin_ids:
-            if admin_config.is_vip(admin_id):
-                vip_admin_ids.append(admin_id)
-            else:
-                experience_admin_ids.append(admin_id)
-        return experience_admin_ids, vip_admin_ids
+        admin_id, str_msgs = claimed
+        msgs = self._convert_msgs(admin_id, str_msgs)
+        cur_time = time.time()
+        for msg in msgs:
+            msg.setdefault('redo_time', []).append(cur_time)
+            msg['redo_num'] = msg.get('redo_num', 0) + 1
+        try:
+            msg_handler_fun(msgs)
+        except Exception as e:
+            # 消息没有分发出去，不计入重做次数，按照退避时间重新放回延迟重做队列
+            app_log.error('Redo msg error, admin_id={0}', e, admin_id)
+            for msg in msgs:
+                msg['redo_num'] -= 1
+                msg['redo_time'].pop()
+            self._schedule_redo_msg(admin_id, msgs, str_msgs)
+            return
+
+        try:
+            self._redo_delay_queue.ack(admin_id, tier, str_msgs)
+        except Exception as e:
+            app_log.error('ack delayed redo msg error, admin_id={0}', e, admin_id)
+
+    def _schedule_redo_msg(self, admin_id, msgs, remove_msgs=()):
+        """
+        按照退避时间将消息放入延迟重做队列，同时删除已经领取的旧消息
+        :param admin_id:
+        :param msgs:
+        :param remove_msgs:
+        :return:
+        """
+        cur_time = time.time()
+        due_msg_list = []
+        for msg in msgs:
+            # 保证内容相同的消息在有序集合中不会被去重
+            msg.setdefault('redo_id', uuid.uuid4().hex)
+            due_msg_list.append((cur_time + self._get_redo_delay(msg), msg_codec.encode(msg)))
+        app_log.info("Send msg to delay redo queue {}", msgs)
+        try:
+            queue_size = self._redo_delay_queue.schedule(admin_id, self._get_tier(admin_id), due_msg_list,
+                                                         remove_msgs)
+        except Exception as e:
+            app_log.error('Send msg to delay redo queue fail, admin_id={0}, msgs={1}', e, admin_id, msgs)
+            return
+
+        is_vip = admin_config.is_vip(admin_id)
+        threshold = self._vip_redo_queue_threshold if is_vip else self._experience_redo_queue_threshold
+        if queue_size >= threshold:
+            app_log.exception(RedoMsgQueueFullError(admin_id, queue_size, is_vip))
+
+    def _get_redo_delay(self, msg):
+        """
+        计算消息下次重做的等待时间，单位秒。优先使用重做策略中对应次数的间隔（分钟），
+        超出策略配置的次数按照base_delay指数退避，最终结果增加随机抖动，避免同时失败的消息同时重做
+        :param msg:
+        :return:
+        """
+        redo_delay_cfg = config.get_value('/consts/global/admin_id_cfg/msg_redo_delay') or {}
+        redo_num = msg.get('redo_num', 0)
+        redo_interval = msg.get('redo_interval') or []
+        try:
+            delay = float(redo_interval[redo_num]) * 60
+        except (IndexError, ValueError):
+            delay = (redo_delay_cfg.get('base_delay') or 60) * 2 ** redo_num
+        delay = min(delay, redo_delay_cfg.get('max_delay') or 3600)
+        jitter = redo_delay_cfg.get('jitter') or 0
+        return max(delay * (1 + random.uniform(-jitter, jitter)), 0)
+
+    def _migrate_legacy_redo_msg(self, is_vip):
+        """
+        将原有重做list队列中的消息转移到延迟重做队列，原有队列为空时只需要一次查询
+        :param is_vip:
+        :return:
+        """
+        try:
+            self._redo_msg_queue.reclaim_expired_leases()
+            experience_admin_ids, vip_admin_ids = self._query_redo_admin_ids()
+        except Exception as e:
+            app_log.error('query legacy redo msg admin error', e)
+            return
+        for admin_id in (vip_admin_ids if is_vip else experience_admin_ids):
+            lease_id, redo_msgs = self._fetch_redo_msg(admin_id)
+            if redo_msgs:
+                self._schedule_redo_msg(admin_id, redo_msgs)
+            self._ack_redo_msg(lease_id)
+
+    def get_delayed_redo_msgs(self, admin_id, start=0, size=0):
+        """
+        查询用户延迟重做队列，按照到期时间排序
+        :param admin_id:
+        :param start:
+        :param size:
+        :return:
+        """
+        result = {'total': self._redo_delay_queue.size(admin_id)}
+        if size > 0:
+            result['root'] = [dict(msg_codec.decode(str_msg), due_time=due_time) for str_msg, due_time in
+                              self._redo_delay_queue.range(admin_id, start, size)]
+        return result
+
+    def delete_delayed_redo_msgs(self, admin_id):
+        """
+        删除用户延迟重做队列
+        :param admin_id:
+        :return:
+        """
+        return self._redo_delay_queue.delete(admin_id)
+
+    def get_msg_shard_conn(self, admin_id):
+        """
+        获取用户消息队列和重做队列所在分片的REDIS连接
+        :param admin_id:
+        :return:
+        """
+        return self._msg_queue.get_shard_queue(admin_id).redis_conn
+
+    def get_msg_shard_stats(self):
+        """
+        获取各分片的用户数目
+        :return:
+        """
+        return {'msg_queue': self._msg_queue.shard_stats(), 'redo_msg_queue': self._redo_msg_queue.shard_stats()}
 
     def _query_msg_admin_ids(self):
         """
-        查询需要处理消息的Admin用户ID，通过keys * 来查询adminId
+        查询需要处理消息的Admin用户ID，默认读取出队时维护的adminId集合，不再使用keys *
         :return:
         """
-        admin_msg_keys = self._redis_conn.keys(self._msg_queue_key_prefix)
-        admin_ids = map(lambda msg_key: msg_key[self._msg_queue_key_pos:], admin_msg_keys)
+        admin_ids = self._msg_queue.query_admin_ids(self._msg_admin_discovery)
 
         vip_admin_ids = []
         experience_admin_ids = []
@@ -367,7 +646,7 @@ class MsgSLA(object):
         查询需要消息重做的Admin用户ID
         :return:
         """
-        admin_ids = self._redis_conn.smembers(self._redo_msg_admin_queue_key)
+        admin_ids = self._redo_msg_queue.query_admin_ids()
         vip_admin_ids = []
         experience_admin_ids = []
         for admin_id in admin_ids:
@@ -387,33 +666,116 @@ class MsgSLA(object):
         msg_status_cache = self._get_msg_cache(admin_id)
         msg_status_cache['last_calls'] += len(cur_msgs)
 
-    def _fetch_msg(self, admin_id):
+    def _fetch_msg(self, admin_ids):
         """
-        获取用户队列的正常消息
+        批量获取多个用户队列的正常消息，消息出队后处于租约中，需要确认或者放回队列
+        :param admin_ids:
+        :return: [(admin_id, lease_id, msgs), ...]
+        """
+        is_scheduler_enable = self._is_scheduler_enable()
+        if is_scheduler_enable:
+            admin_size_list = self._plan_msg_fetch(admin_ids)
+        else:
+            admin_size_list = []
+            for admin_id in admin_ids:
+                iter_size, is_vip = self._get_msg_iter_size(admin_id)
+                if iter_size > 0:
+                    admin_size_list.append((admin_id, iter_size, is_vip))
+        if not admin_size_list:
+            return []
+
+        try:
+            pop_result_list = self._msg_queue.pop(map(lambda item: item[:2], admin_size_list))
+        except Exception as e:
+            app_log.error('fetch msg error, admin_ids={0}', e, admin_ids)
+            pop_result_list = [(admin_id, None, []) for admin_id, _, _ in admin_size_list]
+            if not is_scheduler_enable:
+                return []
+
+        admin_msg_list = []
+        for (admin_id, iter_size, is_vip), (_, lease_id, str_msgs) in zip(admin_size_list, pop_result_list):
+            self._set_need_check_msg_num(admin_id, is_vip, iter_size, str_msgs)
+            if lease_id:
+                admin_msg_list.append((admin_id, lease_id, self._convert_msgs(admin_id, str_msgs)))
+        if is_scheduler_enable:
+            for tier, tier_result_list in groupby(
+                    sorted(zip(admin_size_list, pop_result_list), key=lambda item: item[0][2]),
+                    lambda item: item[0][2]):
+                self._msg_scheduler.complete(
+                    'vip' if tier else 'experience',
+                    [(admin_id, iter_size, len(str_msgs)) for (admin_id, iter_size, _), (_, _, str_msgs) in
+                     tier_result_list])
+        return admin_msg_list
+
+    def _is_scheduler_enable(self):
+        return (config.get_value('/consts/global/admin_id_cfg/msg_scheduler') or {}).get('enable', True)
+
+    def _plan_msg_fetch(self, admin_ids):
+        """
+        按照用户级别分组进行差额轮询调度，计算每个用户本轮获取的消息数目
+        :param admin_ids:
+        :return: [(admin_id, size, is_vip), ...]
+        """
+        scheduler_cfg = config.get_value('/consts/global/admin_id_cfg/msg_scheduler') or {}
+        admin_size_list = []
+        for is_vip, tier_admin_ids in groupby(sorted(admin_ids, key=admin_config.is_vip), admin_config.is_vip):
+            tier = 'vip' if is_vip else 'experience'
+            quota_list = [(admin_id,) + self._get_msg_quota(admin_id, is_vip, scheduler_cfg) for admin_id in
+                          tier_admin_ids]
+            round_budget = get_dict_value_by_path('round_budget/' + tier, scheduler_cfg)
+            admin_size_list.extend((admin_id, size, is_vip) for admin_id, size in
+                                   self._msg_scheduler.plan(tier, quota_list, round_budget))
+        return admin_size_list
+
+    def _get_msg_quota(self, admin_id, is_vip, scheduler_cfg):
+        """
+        获取用户调度参数，权重从用户参数msg_weight中读取
         :param admin_id:
+        :param is_vip:
+        :param scheduler_cfg:
+        :return: (quantum, weight, rate, capacity)
+        """
+        quantum = self._vip_msg_iter_size if is_vip else self._experience_msg_iter_size
+        weight = admin_config.get_admin_param_value(admin_id, 'msg_weight') or scheduler_cfg.get('default_weight') or 1
+        max_calls, time_interval = self._get_msg_rate_limit(admin_id, is_vip)
+        return quantum, float(weight), float(max_calls) / time_interval, max_calls
+
+    def get_admin_msg_lag(self, admin_ids=None):
+        """
+        获取用户消息积压情况，包括队列长度、令牌桶剩余令牌和按照限速估算的消费延迟
+        :param admin_ids: 为空时查询所有有消息的用户
+        :return:
+        """
+        if not admin_ids:
+            admin_ids = self._msg_queue.query_admin_ids(self._msg_admin_discovery)
+        queue_size_list = self._msg_queue.sizes(admin_ids)
+        token_dict = self._msg_scheduler.token_bucket.get_tokens(admin_ids)
+        lag_dict = {}
+        for admin_id, queue_size in zip(admin_ids, queue_size_list):
+            is_vip = admin_config.is_vip(admin_id)
+            _, weight, rate, capacity = self._get_msg_quota(admin_id, is_vip, config.get_value(
+                '/consts/global/admin_id_cfg/msg_scheduler') or {})
+            lag_dict[admin_id] = {'queue_size': queue_size, 'is_vip': is_vip, 'weight': weight, 'rate': rate,
+                                  'capacity': capacity, 'tokens': token_dict.get(admin_id),
+                                  'lag_seconds': round(queue_size / rate, 3) if rate else None}
+        return lag_dict
+
+    def _convert_msgs(self, admin_id, str_msgs):
+        """
+        反序列化消息，非法消息会被丢弃
+        :param admin_id:
+        :param str_msgs:
         :return:
         """
 
         def __convert_msg(_msg_str):
             try:
-                return json.loads(_msg_str)
+                return msg_codec.decode(_msg_str)
             except Exception as e:
                 app_log.error("Admin {0} has invalid message {1}".format(admin_id, _msg_str))
                 return None
 
-        try:
-            str_key = self._msg_queue_key.format(admin_id)
-            iter_size, is_vip = self._get_msg_iter_size(admin_id)
-            if iter_size == 0:
-                return []
-
-            str_msgs = self._redis_conn.lrange(str_key, 0, iter_size - 1)
-
-            self._set_need_check_msg_num(admin_id, is_vip, iter_size, str_msgs)
-
-            return filter(lambda _: _, map(__convert_msg, str_msgs))
-        except Exception as e:
-            app_log.error('fetch msg error, admin_id={0}', e, admin_id)
+        return filter(lambda _: _, map(__convert_msg, str_msgs))
 
     def _set_need_check_msg_num(self, admin_id, is_vip, iter_size, str_msgs):
         """
@@ -443,19 +805,22 @@ class MsgSLA(object):
         """
         从用户队列中获取指定数目的redo消息
         :param admin_id:
-        :return:
+        :return: (lease_id, msgs)
         """
         try:
-            str_key = self._redo_msg_queue_key.format(admin_id)
             iter_size = self._get_redo_iter_size(admin_id)
-            str_redo_msgs = self._redis_conn.lrange(str_key, 0, iter_size - 1)
+            pop_result_list = self._redo_msg_queue.pop([(admin_id, iter_size)])
+            if not pop_result_list:
+                return None, []
+            _, lease_id, str_redo_msgs = pop_result_list[0]
 
             if len(str_redo_msgs) == iter_size:
-                self._check_admin_redo_msg_num(admin_id, str_key)
+                self._check_admin_redo_msg_num(admin_id)
 
-            return map(lambda msg_str: json.loads(msg_str), str_redo_msgs)
+            return lease_id, self._convert_msgs(admin_id, str_redo_msgs)
         except Exception as e:
             app_log.error('fetch redo msg error, admin_id={0}', e, admin_id)
+            return None, []
 
     def check_msg_num(self):
         """
@@ -476,8 +841,7 @@ class MsgSLA(object):
         :return:
         """
         try:
-            str_key = self._msg_queue_key.format(admin_id)
-            queue_size = self._redis_conn.llen(str_key)
+            queue_size = self._msg_queue.sizes([admin_id])[0]
             threshold = self._vip_msg_queue_threshold if is_vip else self._experience_msg_queue_threshold
             if queue_size >= threshold:
                 app_log.exception(MsgQueueFullError(admin_id, queue_size, is_vip))
@@ -485,14 +849,14 @@ class MsgSLA(object):
         except Exception as e:
             app_log.error('check admin msg num error, admin_id={0}', e, admin_id)
 
-    def _check_admin_redo_msg_num(self, admin_id, str_key):
+    def _check_admin_redo_msg_num(self, admin_id):
         """
         判断重做消息队列是否达到阈值
         :param admin_id:
         :return:
         """
         try:
-            redo_queue_size = self._redis_conn.llen(str_key)
+            redo_queue_size = self._redo_msg_queue.sizes([admin_id])[0]
             is_vip = admin_config.is_vip(admin_id)
             threshold = self._vip_redo_queue_threshold if is_vip else self._experience_redo_queue_threshold
             if redo_queue_size >= threshold:
@@ -523,59 +887,27 @@ class MsgSLA(object):
         except Exception as e:
             app_log.error('check final msg num error', e)
 
-    def _remove_redo_msg(self, admin_id, size):
+    def _ack_redo_msg(self, lease_id):
         """
-        从用户队列中删除redo消息
-        :param admin_id:
-        :param size:
+        确认重做消息已经处理，未到时间和失败的消息已经重新放回重做队列
+        :param lease_id:
         :return:
         """
         try:
-            str_key = self._redo_msg_queue_key.format(admin_id)
-            self._redis_conn.ltrim(str_key, size, -1)
+            self._redo_msg_queue.ack(lease_id)
         except Exception as e:
-            app_log.error('remove redo msg error, admin_id={0}, size={1}', e, admin_id, size)
-
-    def _remove_msg(self, admin_id, size):
-        """
-        从用户队列中删除消息
-        :param admin_id:
-        :param size:
-        :return:
-        """
-        try:
-            str_key = self._msg_queue_key.format(admin_id)
-            self._redis_conn.ltrim(str_key, size, -1)
-        except Exception as e:
-            app_log.error('remove msg error, admin_id={0}, size={1}', e, admin_id, size)
+            app_log.error('ack redo msg error, lease_id={0}', e, lease_id)
 
     def _get_msg_iter_size(self, admin_id):
         """
-        获取该用户正常消息批量大小, 取用户每次迭代消息大小 和 本周期下用户还允许消费的消息数目最小值
+        获取该用户正常消息批量大小, 取用户每次迭代消息大小 和 本周期下用户还允许消费的消息数目最小值，
+        关闭公平调度时使用，只在当前进程内限速
         :param admin_id:
         :return:
         """
         is_vip = admin_config.is_vip(admin_id)
         config_msg_iter_size = self._vip_msg_iter_size if is_vip else self._experience_msg_iter_size
-
-        max_calls = admin_config.get_admin_param_value(admin_id, 'max_msg')
-        time_interval = admin_config.get_admin_param_value(admin_id, 'msg_time_interval')
-
-        if not max_calls:
-            if admin_id.startswith('pc-'):
-                max_calls = self._pc_task_vip_sla_max_calls if is_vip else self._pc_task_experience_sla_max_calls
-            elif admin_id.startswith('trade-'):
-                max_calls = self._trade_task_vip_sla_max_calls if is_vip else self._trade_task_experience_sla_max_calls
-            else:
-                max_calls = self._vip_sla_max_calls if is_vip else self._experience_sla_max_calls
-
-        if not time_interval:
-            if admin_id.startswith('pc-'):
-                time_interval = self._pc_task_vip_sla_time_interval if is_vip else self._pc_task_experience_sla_time_interval
-            elif admin_id.startswith('trade-'):
-                time_interval = self._trade_task_vip_sla_time_interval if is_vip else self._trade_task_experience_sla_time_interval
-            else:
-                time_interval = self._vip_sla_time_interval if is_vip else self._experience_sla_time_interval
+        max_calls, time_interval = self._get_msg_rate_limit(admin_id, is_vip)
 
         msg_status_cache = self._get_msg_cache(admin_id)
         cur_time = time.time()
@@ -602,13 +934,43 @@ class MsgSLA(object):
 
         return min(config_msg_iter_size, left_msg_calls), is_vip
 
+    def _get_msg_rate_limit(self, admin_id, is_vip):
+        """
+        获取用户消息限速配置，优先使用用户参数，其次按照用户类型使用默认配置
+        :param admin_id:
+        :param is_vip:
+        :return: (time_interval时间内最大消息数, time_interval)
+        """
+        max_calls = admin_config.get_admin_param_value(admin_id, 'max_msg')
+        time_interval = admin_config.get_admin_param_value(admin_id, 'msg_time_interval')
+
+        if not max_calls:
+            if admin_id.startswith('pc-'):
+                max_calls = self._pc_task_vip_sla_max_calls if is_vip else self._pc_task_experience_sla_max_calls
+            elif admin_id.startswith('trade-'):
+                max_calls = self._trade_task_vip_sla_max_calls if is_vip else self._trade_task_experience_sla_max_calls
+            else:
+                max_calls = self._vip_sla_max_calls if is_vip else self._experience_sla_max_calls
+
+        if not time_interval:
+            if admin_id.startswith('pc-'):
+                time_interval = self._pc_task_vip_sla_time_interval if is_vip else self._pc_task_experience_sla_time_interval
+            elif admin_id.startswith('trade-'):
+                time_interval = self._trade_task_vip_sla_time_interval if is_vip else self._trade_task_experience_sla_time_interval
+            else:
+                time_interval = self._vip_sla_time_interval if is_vip else self._experience_sla_time_interval
+        return max_calls, time_interval
+
     def _get_redo_iter_size(self, admin_id):
         """
         获取该用户消息重做的批量大小
         :param admin_id:
         :return:
         """
-        return self._vip_redo_msg_iter_size if admin_config.is_vip(admin_id) else self._experience_redo_msg_iter_size
+        return self._get_redo_iter_size_by_tier(admin_config.is_vip(admin_id))
+
+    def _get_redo_iter_size_by_tier(self, is_vip):
+        return self._vip_redo_msg_iter_size if is_vip else self._experience_redo_msg_iter_size
 
     def _do_redo_msg(self, msg, msg_handler_fun, cur_time, not_to_time_msgs, need_redo_msgs, final_msgs):
         """
@@ -634,7 +996,7 @@ class MsgSLA(object):
             except Exception as e:
                 # 重做消息失败，
                 app_log.error("Redo msg error, {0}", e, msg)
-                if msg['redo_num'] >= count:
+                if msg['redo_num'] >= msg['redo_times']:
                     # 如果已到重做次数，则放到最终队列中
                     final_msgs.append(msg)
                 else:
@@ -660,7 +1022,11 @@ class MsgSLA(object):
 
         need_redo, processed_msg = self._get_msg_redo_info(msg, exception, redo_policy)
         if need_redo:
-            self._send_msg_to_redo_queue_by_admin([msg], admin_id)
+            if self._is_redo_delay_enable():
+                self._schedule_redo_msg(admin_id, [msg])
+            else:
+                self._send_msg_to_redo_queue_by_admin([msg], admin_id)
+            self._notify_ready(self._redo_msg_ready_key, [admin_id])
         else:
             self._send_msg_to_final_queue([msg])
 
@@ -736,20 +1102,12 @@ class MsgSLA(object):
         :return:
         """
         app_log.info("Send msg to redo queue {}", msgs)
-        admin_id_list = []
-        for admin_id, admin_msgs in groupby(msgs, lambda msg: msg['adminId']):
-            admin_id_list.append(admin_id)
-            str_admin_msgs = map(lambda msg: json.dumps(msg), admin_msgs)
-            str_key = self._redo_msg_queue_key.format(admin_id)
-            try:
-                self._redis_conn.rpush(str_key, *str_admin_msgs)
-            except Exception as e:
-                app_log.error('Send msg to redo queue fail, admin_id={0}, msgs={1}', e, admin_id, str_admin_msgs)
+        admin_msgs_list = [(admin_id, map(msg_codec.encode, admin_msgs)) for admin_id, admin_msgs in
+                           groupby(msgs, lambda msg: msg['adminId'])]
         try:
-            self._redis_conn.sadd(self._redo_msg_admin_queue_key, *admin_id_list)
+            self._redo_msg_queue.push(admin_msgs_list)
         except Exception as e:
-            app_log.error('Send redo msg admin id to queue fail, admin_ids={0}', e, admin_id_list)
-            app_log.exception(e)
+            app_log.error('Send msg to redo queue fail, msgs={0}', e, msgs)
 
     def _send_msg_to_redo_queue_by_admin(self, msgs, admin_id):
         """
@@ -759,17 +1117,11 @@ class MsgSLA(object):
         :return:
         """
         app_log.info("Send msg to redo queue {}", msgs)
-        str_admin_msgs = map(lambda msg: json.dumps(msg), msgs)
-        str_key = self._redo_msg_queue_key.format(admin_id)
-        try:
-            self._redis_conn.rpush(str_key, *str_admin_msgs)
-        except Exception as e:
-            app_log.error('Send msg to redo queue fail, admin_id={0}, msgs={1}', e, admin_id, str_admin_msgs)
-
+        str_admin_msgs = map(msg_codec.encode, msgs)
         try:
-            self._redis_conn.sadd(self._redo_msg_admin_queue_key, admin_id)
+            self._redo_msg_queue.push([(admin_id, str_admin_msgs)])
         except Exception as e:
-            app_log.error('Send redo msg admin id to queue fail, admin_id={0}', e, admin_id)
+            app_log.error('Send msg to redo queue fail, admin_id={0}, msgs={1}', e, admin_id, msgs)
 
 
 msg_sla = MsgSLA()
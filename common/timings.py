@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+请求处理各阶段耗时统计，每个请求记录各阶段耗时，按照处理器和阶段汇总为进程内直方图
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from common.configs import config
+from common.msg_bus import message_bus, Event
+
+__author__ = 'liuzhaoming'
+
+
+def _build_bucket_bounds(min_value=0.1, max_value=120000.0, factor=1.2):
+    """
+    生成按照指数增长的桶上界，单位毫秒，相对误差不超过factor-1
+    :param min_value:
+    :param max_value:
+    :param factor:
+    :return:
+    """
+    bounds = []
+    bound = min_value
+    while bound < max_value:
+        bounds.append(round(bound, 3))
+        bound *= factor
+    bounds.append(max_value)
+    return bounds
+
+
+class LatencyHistogram(object):
+    """
+    耗时直方图，固定指数桶，占用内存和记录次数无关
+    """
+    BUCKET_BOUNDS = _build_bucket_bounds()
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, cost_ms):
+        self.counts[bisect_left(self.BUCKET_BOUNDS, cost_ms)] += 1
+        self.count += 1
+        self.total += cost_ms
+        if cost_ms > self.max:
+            self.max = cost_ms
+
+    def percentile(self, percent):
+        """
+        获取百分位耗时，返回所在桶的上界，不超过最大值
+        :param percent: 0-100
+        :return:
+        """
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        cumulative = 0
+        for pos, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= rank and bucket_count:
+                bound = self.BUCKET_BOUNDS[pos] if pos < len(self.BUCKET_BOUNDS) else self.max
+                return round(min(bound, self.max), 3)
+        return round(self.max, 3)
+
+    def stats(self):
+        return {'count': self.count, 'avg': round(self.total / self.count, 3) if self.count else 0,
+                'max': round(self.max, 3), 'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+class RequestTimer(object):
+    """
+    单个请求的阶段耗时记录
+    """
+
+    def __init__(self, handler_name=None):
+        self.handler_name = handler_name
+        self.start_time = time.time()
+        self.spans = []
+
+    def add(self, stage, cost_ms):
+        self.spans.append((stage, cost_ms))
+
+
+class RequestTiming(object):
+    """
+    请求阶段耗时统计，当前请求的计时器保存在线程本地变量中，没有计时器时记录操作为空操作
+    """
+    TOTAL_STAGE = 'total'
+
+    def __init__(self):
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.histograms = {}
+        self.init_config()
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.init_config)
+
+    def init_config(self):
+        """
+        初始化耗时统计配置
+        :return:
+        """
+        timing_cfg = config.get_value('/consts/query/timing') or {}
+        self.enable = timing_cfg.get('enable', True)
+
+    def start(self, handler_name=None):
+        """
+        开始记录当前请求的阶段耗时
+        :param handler_name:
+        :return:
+        """
+        timer = RequestTimer(handler_name) if self.enable else None
+        self.__local.timer = timer
+        return timer
+
+    def current(self):
+        return getattr(self.__local, 'timer', None)
+
+    def set_handler(self, handler_name):
+        """
+        设置当前请求的处理器名称，请求路由完成后才能确定
+        :param handler_name:
+        :return:
+        """
+        timer = self.current()
+        if timer:
+            timer.handler_name = handler_name
+
+    def record(self, stage, cost_ms):
+        """
+        记录阶段耗时，用于ES返回的took等外部计时
+        :param stage:
+        :param cost_ms:
+        :return:
+        """
+        timer = self.current()
+        if timer and cost_ms is not None:
+            timer.add(stage, cost_ms)
+
+    @contextmanager
+    def span(self, stage):
+        """
+        记录with语句块的耗时
+        :param stage:
+        :return:
+        """
+        timer = self.current()
+        if not timer:
+            yield
+            return
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            timer.add(stage, (time.time() - start_time) * 1000)
+
+    def finish(self):
+        """
+        结束当前请求的计时，汇总到处理器的各阶段直方图中
+        :return: 当前请求的计时器
+        """
+        timer = self.current()
+        if not timer:
+            return None
+        self.__local.timer = None
+        handler_name = timer.handler_name or 'unknown'
+        total_cost = (time.time() - timer.start_time) * 1000
+        with self.__lock:
+            stage_histograms = self.histograms.setdefault(handler_name, {})
+            for stage, cost_ms in timer.spans + [(self.TOTAL_STAGE, total_cost)]:
+                histogram = stage_histograms.get(stage)
+                if histogram is None:
+                    histogram = stage_histograms[stage] = LatencyHistogram()
+                histogram.add(cost_ms)
+        return timer
+
+    def stats(self, handler_name=None):
+        """
+        获取各处理器各阶段的耗时统计，单位毫秒
+        :param handler_name: 为空时返回所有处理器
+        :return:
+        """
+        with self.__lock:
+            return dict((name, dict((stage, histogram.stats()) for stage, histogram in stage_histograms.iteritems()))
+                        for name, stage_histograms in self.histograms.iteritems()
+                        if not handler_name or name == handler_name)
+
+    def reset(self):
+        with self.__lock:
+            self.histograms = {}
+
+
+request_timing = RequestTiming()
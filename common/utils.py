@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from bisect import bisect_right
 import inspect
 import socket
 import time
@@ -201,6 +202,43 @@ def deep_merge(dict_param, other_dict_param):
     return result_dict
 
 
+def deep_merge_all(dict_list):
+    """
+    一次性合并多个字典，结果和依次调用deep_merge相同，
+    只复制需要合并的中间层字典和列表，不会修改输入的字典
+    :param dict_list:
+    :return:
+    """
+    result_dict = {}
+    # 合并过程中新创建的字典和列表，可以直接原地修改
+    owned_ids = set()
+
+    def merge_into(target_dict, other_dict):
+        for key, value in other_dict.iteritems():
+            cur_value = target_dict.get(key)
+            if isinstance(value, dict) and isinstance(cur_value, dict):
+                if not cur_value or not value:
+                    target_dict[key] = cur_value or value
+                    continue
+                if id(cur_value) not in owned_ids:
+                    cur_value = target_dict[key] = dict(cur_value)
+                    owned_ids.add(id(cur_value))
+                merge_into(cur_value, value)
+            elif isinstance(value, (list, tuple)) and isinstance(cur_value, (list, tuple)):
+                if id(cur_value) in owned_ids:
+                    cur_value.extend(value)
+                else:
+                    cur_value = target_dict[key] = list(cur_value) + list(value)
+                    owned_ids.add(id(cur_value))
+            else:
+                target_dict[key] = value
+
+    for item_dict in dict_list:
+        if item_dict:
+            merge_into(result_dict, item_dict)
+    return result_dict
+
+
 def query_dict_to_normal_dict(query_dict):
     """
     将django QueryDict转化为普通的dict
@@ -220,6 +258,33 @@ def query_dict_to_normal_dict(query_dict):
     return normal_dict
 
 
+class FrozenDict(dict):
+    """
+    不可修改的字典，用于在多个请求之间共享的缓存结果，需要修改时通过dict(frozen_dict, **kwargs)复制
+    """
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('FrozenDict is readonly')
+
+    __setitem__ = __delitem__ = update = pop = popitem = setdefault = clear = __readonly
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+def freeze(value):
+    """
+    递归转换为不可修改的结构，字典转换为FrozenDict，列表转换为元组
+    :param value:
+    :return:
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
 COMBINE_SIGN = '|||'
 
 
@@ -411,6 +476,46 @@ def hash_encode(input_str, modulus=1):
     return abs(hash(input_str)) % modulus
 
 
+def get_java_str_length(text):
+    """
+    获取字符串在Java中的长度(UTF-16编码单元数目)，ES分词结果的offset使用该长度
+    :param text:
+    :return:
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    elif not isinstance(text, unicode):
+        text = unicode(text)
+    return len(text.encode('utf-16-le')) / 2
+
+
+def split_analyze_tokens(text_list, tokens, offset_gap=1):
+    """
+    将一次_analyze请求分析多个文本的分词结果按照offset拆分到各个文本，
+    ES对多个文本分词时，后一个文本的offset等于前面文本长度之和加上offset_gap
+    :param text_list:
+    :param tokens: ES返回的tokens
+    :param offset_gap:
+    :return: 和text_list对应的分词列表，分词offset无法对应到文本时返回None
+    """
+    start_list = []
+    end_list = []
+    base = 0
+    for text in text_list:
+        start_list.append(base)
+        base += get_java_str_length(text)
+        end_list.append(base)
+        base += offset_gap
+
+    token_list_list = [[] for _ in text_list]
+    for token in tokens:
+        pos = bisect_right(start_list, token['start_offset']) - 1
+        if pos < 0 or token['end_offset'] > end_list[pos]:
+            return None
+        token_list_list[pos].append(token['token'])
+    return token_list_list
+
+
 if __name__ == '__main__':
     # print to_utf_chars('China u中华人民共和国 ￥$end')
     print 'bind_variable test start........'
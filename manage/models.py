@@ -10,15 +10,23 @@ from re import search
 import redis
 
 from common.admin_config import admin_config
-from common.connections import EsConnectionFactory, RedisConnectionFactory
+from common.connections import EsConnectionFactory, RedisConnectionFactory, HttpConnectionFactory
 from common.es_routers import es_router
 from common.msg_bus import message_bus, Event
 from common.configs import config, config_holder
 from common.exceptions import UpdateDataNotExistError, InvalidParamError
 from common.loggers import query_log as app_log
 from common.adapter import es_adapter, es7_adapter
+from common.bulk_controllers import bulk_controller_manager
+from common.bulk_writers import bulk_writer_manager
+from common.caches import analyze_token_cache, query_result_cache
 from common.pingyin_utils import pingyin_utils
 from common.registers import register_center
+from common.msg_codecs import msg_codec
+from common.msg_lanes import msg_lanes
+from common.msg_schedulers import simulate_msg_schedule
+from common.sla import msg_sla
+from common.timings import request_timing
 from common.utils import get_dict_value_by_path, bind_dict_variable, merge, unbind_variable
 from river import get_river_key
 from river.rivers import process_syn_message
@@ -507,6 +515,8 @@ class AnsjSegmentation(object):
         msg = self.__to_msg(segmentation)
         if msg:
             self.redis_conn.publish(self.redis_cfg['channel'], msg)
+            # 分词词典变化后，已缓存的分词结果失效
+            analyze_token_cache.invalidate()
 
     def init_config(self):
         self.redis_cfg = config.get_value('consts/global/ansj_segment_redis')
@@ -1278,7 +1288,7 @@ class Cluster():
         if not admin_id:
             raise InvalidParamError('Admin ID cannot be null')
         admin_msg_queue_key = self._msg_queue_key.format(admin_id)
-        return self._get_redis_list_info(admin_msg_queue_key, start, size)
+        return self._get_redis_list_info(admin_msg_queue_key, start, size, msg_sla.get_msg_shard_conn(admin_id))
 
     def delete_msg_queue(self, admin_id):
         """
@@ -1289,7 +1299,63 @@ class Cluster():
         if not admin_id:
             raise InvalidParamError('Admin ID cannot be null')
         admin_msg_queue_key = self._msg_queue_key.format(admin_id)
-        return self._msg_redis_conn.delete(admin_msg_queue_key)
+        return msg_sla.get_msg_shard_conn(admin_id).delete(admin_msg_queue_key)
+
+    def get_msg_coalesce_stats(self):
+        """
+        获取各数据流消息合并统计信息
+        :return:
+        """
+        return msg_sla.get_coalesce_stats()
+
+    def reset_msg_coalesce_stats(self):
+        """
+        清空消息合并统计信息
+        :return:
+        """
+        return msg_sla.reset_coalesce_stats()
+
+    def get_admin_msg_lag(self, admin_id=None):
+        """
+        获取用户消息积压和按照限速估算的消费延迟
+        :param admin_id: 为空时返回所有有消息的用户
+        :return:
+        """
+        return msg_sla.get_admin_msg_lag([admin_id] if admin_id else None)
+
+    def get_msg_shard_stats(self):
+        """
+        获取消息队列各分片的用户分布，用于新增分片后观察旧分片中剩余消息的迁移
+        :return:
+        """
+        return msg_sla.get_msg_shard_stats()
+
+    def get_es_bulk_stats(self):
+        """
+        获取ES bulk自适应批量控制和合并写入的统计信息
+        :return:
+        """
+        return {'adaptive': bulk_controller_manager.stats(), 'coalesce': bulk_writer_manager.stats()}
+
+    def get_msg_lane_stats(self):
+        """
+        获取消息执行通道的积压深度和头部消息等待时间，用于评估提高并发数目后的通道负载
+        :return:
+        """
+        return msg_lanes.stats()
+
+    def simulate_msg_schedule(self, simulate_params):
+        """
+        消息公平调度模拟，用于调整用户权重、限速和每轮上限配置
+        :param simulate_params: {'admins': {admin_id: {...}}, 'rounds': 100, 'round_budget': 500,
+                                 'round_interval': 0.02}
+        :return:
+        """
+        if not simulate_params or not simulate_params.get('admins'):
+            raise InvalidParamError('Simulate admins cannot be null')
+        return simulate_msg_schedule(simulate_params['admins'], int(simulate_params.get('rounds') or 100),
+                                     simulate_params.get('round_budget'),
+                                     float(simulate_params.get('round_interval') or 0.02))
 
     def get_redo_msg_queue(self, admin_id, start=0, size=0):
         """
@@ -1301,8 +1367,10 @@ class Cluster():
         """
         if not admin_id:
             raise InvalidParamError('Admin ID cannot be null')
+        if (config.get_value('/consts/global/admin_id_cfg/msg_redo_delay') or {}).get('enable', True):
+            return msg_sla.get_delayed_redo_msgs(admin_id, start, size)
         admin_msg_queue_key = self._redo_msg_queue_key.format(admin_id)
-        return self._get_redis_list_info(admin_msg_queue_key, start, size)
+        return self._get_redis_list_info(admin_msg_queue_key, start, size, msg_sla.get_msg_shard_conn(admin_id))
 
     def delete_redo_msg_queue(self, admin_id):
         """
@@ -1313,7 +1381,8 @@ class Cluster():
         if not admin_id:
             raise InvalidParamError('Admin ID cannot be null')
         admin_msg_queue_key = self._redo_msg_queue_key.format(admin_id)
-        return self._msg_redis_conn.delete(admin_msg_queue_key)
+        return msg_sla.get_msg_shard_conn(admin_id).delete(admin_msg_queue_key) + msg_sla.delete_delayed_redo_msgs(
+            admin_id)
 
     def get_final_msg_queue(self, start=0, size=0):
         """
@@ -1331,39 +1400,42 @@ class Cluster():
         """
         return self._msg_redis_conn.delete(self._final_msg_queue_key)
 
-    def _get_redis_list_info(self, list_key, start, size):
+    def _get_redis_list_info(self, list_key, start, size, redis_conn=None):
         """
         获取redis list信息，如果size参数大于0，则返回size条记录
         :param list_key:
         :param start:
         :param size:
+        :param redis_conn: 为空时使用msg_queue连接
         :return:
         """
-        queue_size = self._get_redis_list_size(list_key)
+        queue_size = self._get_redis_list_size(list_key, redis_conn)
         result = {'total': queue_size}
         if size > 0:
-            msg_str_list = self._get_redis_list_range(list_key, start, size - 1)
-            msg_list = map(lambda msg_str: json.loads(msg_str), msg_str_list)
+            msg_str_list = self._get_redis_list_range(list_key, start, size - 1, redis_conn)
+            msg_list = map(msg_codec.decode, msg_str_list)
             result['root'] = msg_list
         return result
 
-    def _get_redis_list_size(self, list_key):
+    def _get_redis_list_size(self, list_key, redis_conn=None):
         """
         获取redis队列长度
         :param list_key:
+        :param redis_conn:
         :return:
         """
-        return self._msg_redis_conn.llen(list_key)
+        return (redis_conn or self._msg_redis_conn).llen(list_key)
 
-    def _get_redis_list_range(self, list_key, start=0, size=4):
+    def _get_redis_list_range(self, list_key, start=0, size=4, redis_conn=None):
         """
         获取redis队列范围
         :param list_key:
         :param start:
         :param size:
+        :param redis_conn:
         :return:
         """
-        return self._msg_redis_conn.lrange(list_key, start, start + size)
+        return (redis_conn or self._msg_redis_conn).lrange(list_key, start, start + size)
 
     def get_rest_request_queue(self):
         """
@@ -1381,6 +1453,42 @@ class Cluster():
         _, str_offset_lag = unbind_variable(r'<td>[ ]*(?P<offset_lag>[\d]+)[ ]*</td>', 'offset_lag', content)
         return {'total': int(str_offset_lag) if str_offset_lag else 0}
 
+    def get_analyze_cache_stats(self):
+        """
+        获取当前进程分词结果缓存命中信息
+        :return:
+        """
+        return analyze_token_cache.stats()
+
+    def get_query_result_cache_stats(self):
+        """
+        获取当前进程商品查询结果缓存命中信息
+        :return:
+        """
+        return query_result_cache.stats()
+
+    def get_request_timing_stats(self, handler_name=None):
+        """
+        获取当前进程各处理器请求阶段耗时统计，包括p50/p95/p99
+        :param handler_name:
+        :return:
+        """
+        return request_timing.stats(handler_name)
+
+    def get_http_pool_stats(self):
+        """
+        获取当前进程数据源HTTP连接池统计信息
+        :return:
+        """
+        return HttpConnectionFactory.stats()
+
+    def reset_request_timing_stats(self):
+        """
+        清空当前进程请求阶段耗时统计
+        :return:
+        """
+        request_timing.reset()
+
 
 SUPERVISOR_PROXY_CACHE = {}
 
@@ -542,7 +542,8 @@ class ClusterView(APIView):
             if operation in ('start', 'stop'):
                 cluster.operate_rest_qos_processor(operation)
         elif res_type == 'msg_qos':
-            pass
+            if operation == 'simulate':
+                return Response(cluster.simulate_msg_schedule(dict(request.DATA)))
 
     def get(self, request, res_type=None, admin_id=None, metrics=None):
         if res_type == 'msg_qos':
@@ -556,9 +557,30 @@ class ClusterView(APIView):
                 return Response(cluster.get_redo_msg_queue(admin_id, start, size))
             elif metrics == 'final_queue':
                 return Response(cluster.get_final_msg_queue(start, size))
+            elif metrics == 'coalesce':
+                return Response(cluster.get_msg_coalesce_stats())
+            elif metrics == 'lag':
+                return Response(cluster.get_admin_msg_lag(admin_id))
+            elif metrics == 'shards':
+                return Response(cluster.get_msg_shard_stats())
+            elif metrics == 'lanes':
+                return Response(cluster.get_msg_lane_stats())
         elif res_type == 'rest_qos':
             if metrics == 'redo_queue':
                 return Response(cluster.get_rest_request_queue())
+        elif res_type == 'query':
+            if metrics == 'analyze_cache':
+                return Response(cluster.get_analyze_cache_stats())
+            elif metrics == 'query_result_cache':
+                return Response(cluster.get_query_result_cache_stats())
+            elif metrics == 'timing':
+                # 复用admin_id路径参数作为处理器名称过滤条件
+                return Response(cluster.get_request_timing_stats(admin_id))
+        elif res_type == 'river':
+            if metrics == 'http_pool':
+                return Response(cluster.get_http_pool_stats())
+            elif metrics == 'es_bulk':
+                return Response(cluster.get_es_bulk_stats())
         raise InvalidParamError('Cannot support the request')
 
     def delete(self, request, res_type=None, admin_id=None, metrics=None):
@@ -569,6 +591,11 @@ class ClusterView(APIView):
                 return Response(cluster.delete_redo_msg_queue(admin_id))
             elif metrics == 'final_queue':
                 return Response(cluster.delete_final_msg_queue())
+            elif metrics == 'coalesce':
+                return Response(cluster.reset_msg_coalesce_stats())
+        elif res_type == 'query':
+            if metrics == 'timing':
+                return Response(cluster.reset_request_timing_stats())
         raise InvalidParamError('Cannot support the request')
 
 
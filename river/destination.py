@@ -2,7 +2,10 @@
 import time
 
 from common.adapter import es_adapter, es7_adapter
+from common.bulk_controllers import is_bulk_item_rejected
+from common.caches import query_result_cache
 from common.es_routers import es_router
+from common.exceptions import MsgHandlingFailError
 from common.loggers import app_log
 from river import do_msg_process_error
 
@@ -58,14 +61,18 @@ class ElasticSearchDestination(DataDestination):
         es_config = es_router.route(es_config, input_param=input_param)
         operation = es_config.get('operation', 'create')
         self._add_private_field(es_config, data, input_param)
-        if operation == 'create':
-            es_adapter.batch_create(es_config, data, input_param)
-        elif operation == 'update':
-            es_adapter.batch_update(es_config, data, input_param)
-        elif operation == 'delete':
-            es_adapter.batch_delete(es_config, data, input_param)
-        elif operation == 'ids_same_prop_update':
-            es_adapter.batch_update_with_props_by_ids(es_config, data, input_param)
+        try:
+            if operation == 'create':
+                es_adapter.batch_create(es_config, data, input_param)
+            elif operation == 'update':
+                es_adapter.batch_update(es_config, data, input_param)
+            elif operation == 'delete':
+                es_adapter.batch_delete(es_config, data, input_param)
+            elif operation == 'ids_same_prop_update':
+                es_adapter.batch_update_with_props_by_ids(es_config, data, input_param)
+        finally:
+            # 部分写入失败时数据也可能已经变化，因此总是清除查询结果缓存
+            query_result_cache.invalidate(input_param.get('adminId'))
 
     def clear(self, destination_config, data, param=None):
         """
@@ -103,6 +110,7 @@ class ElasticSearchDestination(DataDestination):
                 return
 
             es_adapter.delete_by_field(es_config, data, '_adminId', data['adminId'])
+            query_result_cache.invalidate(data['adminId'])
 
     def _add_private_field(self, es_config, data_list, param):
         """
@@ -145,14 +153,22 @@ class ElasticSearch7Destination(DataDestination):
         es_config = es_router.route(es_config, input_param=input_param)
         operation = es_config.get('operation', 'create')
         self._add_private_field(es_config, data, input_param)
-        if operation == 'create':
-            es7_adapter.batch_create(es_config, data, input_param)
-        elif operation == 'update':
-            es7_adapter.batch_update(es_config, data, input_param)
-        elif operation == 'delete':
-            es7_adapter.batch_delete(es_config, data, input_param)
-        elif operation == 'ids_same_prop_update':
-            es7_adapter.batch_update_with_props_by_ids(es_config, data, input_param)
+        fail_op_results = None
+        try:
+            if operation == 'create':
+                fail_op_results = es7_adapter.batch_create(es_config, data, input_param)
+            elif operation == 'update':
+                fail_op_results = es7_adapter.batch_update(es_config, data, input_param)
+            elif operation == 'delete':
+                fail_op_results = es7_adapter.batch_delete(es_config, data, input_param)
+            elif operation == 'ids_same_prop_update':
+                fail_op_results = es7_adapter.batch_update_with_props_by_ids(es_config, data, input_param)
+        finally:
+            # 部分写入失败时数据也可能已经变化，因此总是清除查询结果缓存
+            query_result_cache.invalidate(input_param.get('adminId'))
+        if fail_op_results and any(map(is_bulk_item_rejected, fail_op_results)):
+            # 重试后仍然被ES拒绝的操作不能丢弃，消息进入重做流程
+            raise MsgHandlingFailError(MsgHandlingFailError.ES_ERROR)
 
         # app_log.info('ES push spend time {}, config is {}, data is {}'.format(
         #     time.time() - start_time, destination_config, data))
@@ -193,6 +209,7 @@ class ElasticSearch7Destination(DataDestination):
                 return
 
             es7_adapter.delete_by_field(es_config, data, '_adminId', data['adminId'])
+            query_result_cache.invalidate(data['adminId'])
 
     def _add_private_field(self, es_config, data_list, param):
         """
@@ -28,7 +28,8 @@ from common.loggers import debug_log, listener_log as app_log
 from river import get_river_key
 from common.data_parsers import data_parser
 from common.sla import msg_sla
-from common.utils import get_dict_value_by_path
+from common.utils import get_dict_value_by_path, COMBINE_SIGN
+from river.msg_filter import MessageFilter
 
 
 __author__ = 'liuzhaoming'
@@ -46,6 +47,12 @@ class MQMessageListener(pyactivemq.MessageListener):
         self.river_key = river_key
         self.sla_cfg = sla_cfg or {}
         self.data_parser_config = get_dict_value_by_path('data_parser', self.sla_cfg)
+        # 消息合并的文档key字段，从data_parser解析结果中获取
+        self.coalesce_key_fields = get_dict_value_by_path('coalesce/key_fields', self.sla_cfg)
+        # 没有文档key时是否合并内容完全相同的消息，默认不合并
+        self.coalesce_identical = get_dict_value_by_path('coalesce/identical', self.sla_cfg) is True
+        delete_filter_config = get_dict_value_by_path('coalesce/delete_filter', self.sla_cfg)
+        self.coalesce_delete_filter = MessageFilter(delete_filter_config) if delete_filter_config else None
 
     def onMessage(self, message):
         """
@@ -86,12 +93,29 @@ class MQMessageListener(pyactivemq.MessageListener):
                 message_json['adminId'] = data_parse_result['fields']['adminId']
             if 'adminId' not in message_json:
                 message_json['adminId'] = 'default'
+            self.__set_coalesce_info(data_parse_result, message_json)
         if 'redo' in self.sla_cfg:
             message_json['redo'] = self.sla_cfg['redo']
         else:
             message_json['redo'] = False
 
 
+    def __set_coalesce_info(self, data_parse_result, message_json):
+        """
+        设置消息合并的文档key、是否删除消息以及是否合并内容相同的消息，所有key字段都解析成功时才能按照文档key合并
+        """
+        if self.coalesce_identical:
+            message_json['coalesce_identical'] = True
+        if not self.coalesce_key_fields or not data_parse_result or not data_parse_result['fields']:
+            return
+        key_values = map(lambda field: data_parse_result['fields'].get(field), self.coalesce_key_fields)
+        if None in key_values:
+            return
+        message_json['coalesce_key'] = COMBINE_SIGN.join(map(unicode, key_values))
+        if self.coalesce_delete_filter and self.coalesce_delete_filter.filter(message_json):
+            message_json['coalesce_delete'] = True
+
+
 class ExceptionListener(pyactivemq.ExceptionListener):
     """
     异常消息监听器
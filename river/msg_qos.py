@@ -22,21 +22,51 @@ init_django_env()
 import sys
 import threading
 import time
+from functools import partial
 
+from common.configs import config
 from common.distributed_locks import zk_lock_store
 from common.loggers import app_log, debug_log
+from common.msg_lanes import msg_lanes
 from common.sla import msg_sla
-from river.rivers import process_message
+from common.utils import get_dict_value_by_path
+from river.rivers import process_message, process_message_batch, process_message_lane
 
 __author__ = 'liuzhaoming'
 
 
-def process_message_wrapper(_message_dict_list):
+def process_message_wrapper(_message_dict_list, is_vip=True):
     """
-    消息处理函数包装器
+    消息处理函数包装器，开启执行通道时消息写入所在的有序通道，获取到通道令牌时启动通道处理任务；
+    开启批量处理时同一个数据流的消息按照批次大小合并为一个celery任务
     :param _message_dict_list:
+    :param is_vip:
     :return:
     """
+    if msg_lanes.enable:
+        start_lane_tasks(msg_lanes.push(_message_dict_list))
+        return
+
+    batch_cfg = config.get_value('/consts/global/admin_id_cfg/msg_batch') or {}
+    if batch_cfg.get('enable', True):
+        batch_size = get_dict_value_by_path('vip/batch_size' if is_vip else 'experience/batch_size', batch_cfg) or 50
+        river_msgs_dict = {}
+        river_key_list = []
+        for _message_dict in _message_dict_list:
+            river_key = _message_dict['river_key']
+            if river_key not in river_msgs_dict:
+                river_msgs_dict[river_key] = []
+                river_key_list.append(river_key)
+            river_msgs_dict[river_key].append(_message_dict)
+        for river_key in river_key_list:
+            river_msgs = river_msgs_dict[river_key]
+            for start in xrange(0, len(river_msgs), batch_size):
+                try:
+                    process_message_batch.delay(river_msgs[start:start + batch_size], river_key)
+                except Exception as e:
+                    app_log.error('process message batch error {0}', e, river_msgs[start:start + batch_size])
+        return
+
     for _message_dict in _message_dict_list:
         try:
             process_message.delay(_message_dict, _message_dict['river_key'])
@@ -45,6 +75,28 @@ def process_message_wrapper(_message_dict_list):
             app_log.error('process message error {0}', e, _message_dict)
 
 
+def start_lane_tasks(lane_token_list):
+    """
+    为获取到令牌的通道启动通道处理任务
+    :param lane_token_list: [(lane, owner_token), ...]
+    :return:
+    """
+    for lane, owner_token in lane_token_list:
+        try:
+            process_message_lane.delay(lane, owner_token)
+        except Exception as e:
+            app_log.error('process message lane error, lane={0}', e, lane)
+
+
+def revive_msg_lanes():
+    """
+    恢复有消息但是没有令牌的通道，队列空闲时也需要执行，执行频率由msg_lanes.revive_interval限制
+    :return:
+    """
+    if msg_lanes.enable:
+        start_lane_tasks(msg_lanes.revive())
+
+
 class MsgQos(object):
     def __init__(self):
         pass
@@ -115,34 +167,49 @@ class MsgQos(object):
         time_interval = 0.02
         while True:
             _start_time = time.time()
+            has_msg = True
             try:
-                msg_sla.process_msg(process_message_wrapper, is_vip)
+                has_msg = msg_sla.process_msg(partial(process_message_wrapper, is_vip=is_vip), is_vip)
                 _cost_time = time.time() - _start_time
                 debug_log.print_log('handle admin vip({0}) msg spends {1}', is_vip, _cost_time)
             except Exception as e:
                 app_log.error('handle vip({0}) msg has error, {1}', is_vip, e)
             finally:
-                time_delta = time_interval - (time.time() - _start_time)
-                if time_delta >= 0.01:
-                    time.sleep(time_delta)
+                revive_msg_lanes()
+                if not has_msg:
+                    # 队列为空时阻塞等待生产者通知，超时后再检查一次队列
+                    msg_sla.wait_msg_ready(is_vip)
+                else:
+                    time_delta = time_interval - (time.time() - _start_time)
+                    if time_delta >= 0.01:
+                        time.sleep(time_delta)
 
     def _handle_redo_msg(self, is_vip):
         """
         处理重做消息
         """
         time_interval = 60
+        # 收到新重做消息通知后提前处理的最小间隔，避免连续失败时频繁扫描重做队列
+        min_interval = config.get_value('/consts/global/admin_id_cfg/redo_min_interval') or 5
         while True:
             _start_time = time.time()
+            # 延迟重做队列中最早的到期时间，到期后提前处理
+            next_due_time = None
             try:
-                msg_sla.process_redo_msg(process_message_wrapper, is_vip)
+                next_due_time = msg_sla.process_redo_msg(partial(process_message_wrapper, is_vip=is_vip), is_vip)
                 _cost_time = time.time() - _start_time
                 debug_log.print_log('handle vip({0}) redo msg spends {1}', is_vip, _cost_time)
             except Exception as e:
                 app_log.error('handle vip({0}) redo msg has error, {1}', is_vip, e)
             finally:
-                time_delta = time_interval - (time.time() - _start_time)
+                time_delta = min_interval - (time.time() - _start_time)
                 if time_delta >= 1:
                     time.sleep(time_delta)
+                time_delta = time_interval - (time.time() - _start_time)
+                if next_due_time is not None:
+                    time_delta = min(time_delta, next_due_time - time.time())
+                if time_delta >= 1:
+                    msg_sla.wait_redo_msg_ready(is_vip, time_delta)
 
     def _handle_check_msg_num(self):
         """
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+迭代数据源分页预取，后台线程提前拉取后续分页放入有界缓冲区，消费者按照页码顺序处理，
+使数据源拉取和ES写入的耗时重叠
+"""
+import threading
+
+__author__ = 'liuzhaoming'
+
+
+class _FetchError(object):
+    """
+    分页拉取异常，按照页码顺序在消费者线程中重新抛出
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+class PagePrefetcher(object):
+    """
+    分页预取器，已拉取未消费和正在拉取的页数不超过max_buffer_pages。
+    fetch_page(page_from)返回(data, has_next)，data为None表示没有数据；
+    已知总页数时可以使用多个线程并行拉取，未知时只能使用一个线程顺序拉取
+    """
+
+    def __init__(self, fetch_page, first_page=0, page_count=None, max_buffer_pages=2, workers=1):
+        self.fetch_page = fetch_page
+        self.max_buffer_pages = max(max_buffer_pages, workers, 1)
+        self.workers = max(workers, 1) if page_count is not None else 1
+        self.__cond = threading.Condition()
+        self.__pages = {}
+        self.__next_fetch = first_page
+        self.__next_consume = first_page
+        self.__end_page = page_count
+        self.__closed = False
+        self.__threads = []
+
+    def __iter__(self):
+        """
+        按照页码顺序返回(page_from, data)，拉取异常在对应页码处抛出
+        :return:
+        """
+        self.start()
+        try:
+            while True:
+                with self.__cond:
+                    while self.__next_consume not in self.__pages and not self.__is_end(self.__next_consume):
+                        self.__cond.wait()
+                    if self.__next_consume not in self.__pages:
+                        return
+                    page_from = self.__next_consume
+                    page_result = self.__pages.pop(page_from)
+                    self.__next_consume += 1
+                    self.__cond.notify_all()
+                if isinstance(page_result, _FetchError):
+                    raise page_result.error
+                if page_result is None:
+                    return
+                yield page_from, page_result
+        finally:
+            self.close()
+
+    def start(self):
+        if self.__threads:
+            return
+        for num in xrange(self.workers):
+            thread = threading.Thread(target=self.__fetch, name='Page prefetch thread {0}'.format(num))
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def close(self):
+        """
+        停止预取，正在拉取的分页结果会被丢弃
+        :return:
+        """
+        with self.__cond:
+            self.__closed = True
+            self.__pages.clear()
+            self.__cond.notify_all()
+
+    def __is_end(self, page_from):
+        return self.__end_page is not None and page_from >= self.__end_page
+
+    def __fetch(self):
+        while True:
+            with self.__cond:
+                while not self.__closed and not self.__is_end(self.__next_fetch) \
+                        and self.__next_fetch - self.__next_consume >= self.max_buffer_pages:
+                    self.__cond.wait()
+                if self.__closed or self.__is_end(self.__next_fetch):
+                    return
+                page_from = self.__next_fetch
+                self.__next_fetch += 1
+
+            has_next = False
+            try:
+                data, has_next = self.fetch_page(page_from)
+                page_result = data
+            except Exception as e:
+                page_result = _FetchError(e)
+
+            with self.__cond:
+                if self.__closed:
+                    return
+                if page_result is None or isinstance(page_result, _FetchError) or not has_next:
+                    # 最后一页、没有数据或者异常时不再拉取后续分页
+                    self.__end_page = min(self.__end_page, page_from + 1) \
+                        if self.__end_page is not None else page_from + 1
+                elif self.__end_page == page_from + 1:
+                    # 数据源总数偏小，最后一页仍然是满页时由当前线程继续顺序拉取
+                    self.__end_page = None
+                self.__pages[page_from] = page_result
+                self.__cond.notify_all()
@@ -1,5 +1,6 @@
 # coding=utf-8
 from __future__ import absolute_import
+import math
 
 from common.configs import config
 from common.data_parsers import data_parser
@@ -8,6 +9,7 @@ from common.utils import get_dict_value_by_path
 from river import get_river_key, do_msg_process_error
 from river.destination import destination
 from river.msg_filter import MessageFilter
+from river.prefetchers import PagePrefetcher
 from river.source import source
 
 __author__ = 'liuzhaoming'
@@ -111,35 +113,92 @@ class MessageProcessor(object):
     @staticmethod
     def __do_iteration_data_flow(river_config, pull_request_param):
         """
-        迭代处理数据流
+        迭代处理数据流，第一页同步拉取，后续分页由预取器在后台拉取，和写入目的地并行执行
         """
         if not source or not destination or not river_config:
             return
-        has_next, page_from, size = True, 0, config.get_value('consts/source/default_iteration_get_size')
+        size = config.get_value('consts/source/default_iteration_get_size')
         source_config = get_dict_value_by_path('source', river_config)
+        pipeline_cfg = config.get_value('consts/source/iteration_pipeline') or {}
+
+        def fetch_page(page_from):
+            return MessageProcessor.__pull_page(river_config, source_config, pull_request_param, page_from, size)
+
+        data, has_next, total = fetch_page(0)
+        if data is None:
+            return
+        if not has_next:
+            page_iterator = []
+        elif not pipeline_cfg.get('enable', True):
+            page_iterator = MessageProcessor.__iter_pages(fetch_page, 1)
+        else:
+            page_count = int(math.ceil(float(total) / size)) if total is not None and size else None
+            page_iterator = PagePrefetcher(lambda page_from: fetch_page(page_from)[:2], 1, page_count,
+                                           pipeline_cfg.get('prefetch_pages') or 2,
+                                           pipeline_cfg.get('fetch_workers') or 1)
+            # 写入第一页之前开始预取后续分页
+            page_iterator.start()
+
+        try:
+            # 如果是第一次执行，支持清除掉数据目的地中数据
+            first_request_param = MessageProcessor.__get_page_request_param(pull_request_param, 0, size)
+            destination.clear(river_config, data, first_request_param)
+            destination.push(river_config, data, first_request_param)
+            for page_from, data in page_iterator:
+                destination.push(river_config, data,
+                                 MessageProcessor.__get_page_request_param(pull_request_param, page_from, size))
+        finally:
+            if isinstance(page_iterator, PagePrefetcher):
+                page_iterator.close()
+
+    @staticmethod
+    def __iter_pages(fetch_page, page_from):
+        """
+        顺序拉取分页，预取关闭时使用
+        """
+        has_next = True
         while has_next:
-            for key in pull_request_param:
-                pull_request_param[key].update({'page_from': page_from, 'page_size': size})
-            debug_log.print_log('__do_iteration_data_flow iter page_from={0} , page_size={1}', page_from, size)
-            pull_response = source.pull(source_config, pull_request_param)
-            if pull_response is None:
-                app_log.info('Pull response is None')
-                break
-
-            if isinstance(pull_response, tuple) or isinstance(pull_response, list):
-                pull_response = pull_response[0]
-            pull_parser_values = MessageProcessor.__parse_pull_response(river_config, pull_response)
-            data = pull_parser_values['data']
-            if page_from == 0:
-                # 如果是第一次执行，支持清除掉数据目的地中数据
-                destination.clear(river_config, data, pull_request_param)
-            destination.push(river_config, data, pull_request_param)
+            data, has_next, _ = fetch_page(page_from)
+            if data is None:
+                return
+            yield page_from, data
             page_from += 1
 
-            result_size = 1
-            if isinstance(data, (list, tuple)):
-                result_size = len(data)
-            has_next = result_size == size
+    @staticmethod
+    def __get_page_request_param(pull_request_param, page_from, size):
+        """
+        生成分页拉取参数，每一页使用独立的参数，预取线程修改参数不影响正在写入的分页
+        """
+        page_request_param = {}
+        for key in pull_request_param:
+            page_request_param[key] = dict(pull_request_param[key], page_from=page_from, page_size=size)
+        return page_request_param
+
+    @staticmethod
+    def __pull_page(river_config, source_config, pull_request_param, page_from, size):
+        """
+        拉取一页数据
+        :return: (data, has_next, total)，data为None表示没有数据，total为数据源返回的总数，没有返回时为None
+        """
+        debug_log.print_log('__do_iteration_data_flow iter page_from={0} , page_size={1}', page_from, size)
+        pull_response = source.pull(source_config,
+                                    MessageProcessor.__get_page_request_param(pull_request_param, page_from, size))
+        if pull_response is None:
+            app_log.info('Pull response is None')
+            return None, False, None
+
+        if isinstance(pull_response, tuple) or isinstance(pull_response, list):
+            pull_response = pull_response[0]
+        pull_parser_values = MessageProcessor.__parse_pull_response(river_config, pull_response)
+        data = pull_parser_values['data']
+        result_size = 1
+        if isinstance(data, (list, tuple)):
+            result_size = len(data)
+        try:
+            total = int(pull_parser_values['total']) if pull_parser_values.get('total') is not None else None
+        except (TypeError, ValueError):
+            total = None
+        return data, result_size == size, total
 
     @staticmethod
     def __do_single_data_flow(river_config, pull_request_param):
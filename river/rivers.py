@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import time
+from multiprocessing.dummy import Pool
 
+from common.bulk_writers import bulk_writer_manager
 from common.configs import config
 from common.exceptions import MsgHandlingFailError
 from common.loggers import app_log
 from common.msg_bus import message_bus, Event
+from common.msg_lanes import msg_lanes
 from common.sla import msg_sla
 from common.utils import COMBINE_SIGN
 from river import get_river_key
@@ -41,6 +44,99 @@ def process_message(self, message, river_key):
             msg_sla.process_do_error_message(message, e)
 
 
+@app.task(bind=True)
+def process_message_batch(self, messages, river_key):
+    """
+    批量处理同一个数据流的消息，处理器责任链只获取一次。
+    相同文档的消息按照顺序串行处理，不同文档的消息并发处理，并发分组的ES bulk写入在合并写入器中合并为一次请求；
+    每条消息单独处理异常，失败消息仍然进入重做流程
+    :param messages:
+    :param river_key:
+    :return:
+    """
+    message_process_chain = data_rivers.get_message_process_chain(river_key)
+    if not message_process_chain:
+        app_log.error('Cannot find process chain by river_key : {0}, message size : {1}', river_key, len(messages))
+        return
+
+    def __process_lane(lane_messages):
+        for message in lane_messages:
+            try:
+                message_process_chain.process(message)
+            except Exception as e:
+                app_log.error('Process_message_batch has error, message={0}, river_key={1}', e, message, river_key)
+                if isinstance(e, MsgHandlingFailError):
+                    msg_sla.process_do_error_message(message, e)
+
+    def __process_concurrent_lane(lane_messages):
+        with bulk_writer_manager.batch_scope():
+            __process_lane(lane_messages)
+
+    lanes = split_message_lanes(messages)
+    batch_pool = get_batch_pool()
+    if len(lanes) > 1 and batch_pool:
+        batch_pool.map(__process_concurrent_lane, lanes)
+    else:
+        map(__process_lane, lanes)
+
+
+@app.task(bind=True)
+def process_message_lane(self, lane, owner_token):
+    """
+    顺序处理一个执行通道中的消息，同一个文档的消息总是在同一个通道中，同时只有持有通道令牌的一个任务处理该通道，
+    跨任务保证同一个文档的消息按照顺序处理。每批消息处理完成后才从通道中删除，通道为空时释放令牌后退出；
+    处理每条消息前延长令牌，令牌失效说明通道已经由其它任务处理，立即退出
+    :param lane:
+    :param owner_token:
+    :return:
+    """
+    processed_count = 0
+    while True:
+        processed_count, messages = msg_lanes.next_batch(lane, owner_token, processed_count)
+        if not processed_count:
+            return
+        for message in messages:
+            if not msg_lanes.refresh(lane, owner_token):
+                return
+            process_message(message, message.get('river_key'))
+
+
+def split_message_lanes(messages):
+    """
+    按照消息合并的文档key将消息切分为多个串行处理的分组，没有文档key的消息之间没有顺序要求，每条消息一个分组
+    :param messages:
+    :return:
+    """
+    lane_dict = {}
+    lanes = []
+    for message in messages:
+        lane_key = message.get('coalesce_key') if isinstance(message, dict) else None
+        if lane_key is None:
+            lanes.append([message])
+            continue
+        if lane_key not in lane_dict:
+            lane_dict[lane_key] = []
+            lanes.append(lane_dict[lane_key])
+        lane_dict[lane_key].append(message)
+    return lanes
+
+
+_BATCH_POOL = {}
+
+
+def get_batch_pool():
+    """
+    获取批量消息并发处理线程池，第一次使用时创建，并发数目为1时不使用线程池
+    :return:
+    """
+    concurrency = config.get_value('/consts/global/admin_id_cfg/msg_batch/concurrency') or 4
+    if concurrency <= 1:
+        return None
+    if concurrency not in _BATCH_POOL:
+        _BATCH_POOL[concurrency] = Pool(concurrency)
+    return _BATCH_POOL[concurrency]
+
+
 def process_syn_message(message, river_key):
     """
     同步调用处理MQ消息
@@ -5,7 +5,6 @@ from common.exceptions import MsgHandlingFailError
 
 __author__ = 'liuzhaoming'
 
-import httplib
 import urllib
 import ujson as json
 
@@ -13,7 +12,7 @@ from common.utils import get_dict_value_by_path, bind_variable, bind_dict_variab
     format_time
 from common.configs import config
 from common.loggers import debug_log, app_log, interface_log
-from common.connections import DubboRegistryFactory
+from common.connections import DubboRegistryFactory, HttpConnectionFactory
 
 
 class DataSource(object):
@@ -107,21 +106,26 @@ class HttpDataSource(DataSource):
         start_time = time.time()
         result = None
         try:
-            # h1 = httplib.HTTPConnection(host, timeout=timeout)
-            h1 = httplib.HTTPConnection(host)
-            h1.request("POST", url, urllib.urlencode(app_params), headers)
-            response = h1.getresponse()
-            result = response.read()
+            pool_cfg = config.get_value('/consts/source/http_pool') or {}
+            result = HttpConnectionFactory.request(host, 'POST', url, urllib.urlencode(app_params), headers,
+                                                   connect_timeout=pool_cfg.get('connect_timeout') or 3,
+                                                   read_timeout=timeout,
+                                                   retries=pool_cfg.get('retries', 2),
+                                                   retry_backoff=(pool_cfg.get('retry_backoff_ms') or 100) / 1000.0,
+                                                   gzip=pool_cfg.get('gzip', True),
+                                                   maxsize=pool_cfg.get('max_size') or 10,
+                                                   pool_timeout=pool_cfg.get('pool_timeout') or 10)
             app_log.info('Call http method finish successfully host = {0}, url={1}', host, url)
 
-            cost_time = int((time.time() - start_time) * 1000)
-            json_log_record = {'cost_time': cost_time, 'sender_host': local_host_name, 'sender_name': 'search_platform',
-                               'receiver_host': host,
-                               'invoke_time': format_time(start_time), 'message': 'Call http method is invoked',
-                               'param_types': ['host', 'url', 'app_params'],
-                               'param_values': [host, url, app_params],
-                               'result_value': result}
-            interface_log.print_log(json_log_record)
+            if interface_log.is_enabled():
+                cost_time = int((time.time() - start_time) * 1000)
+                json_log_record = {'cost_time': cost_time, 'sender_host': local_host_name,
+                                   'sender_name': 'search_platform', 'receiver_host': host,
+                                   'invoke_time': format_time(start_time), 'message': 'Call http method is invoked',
+                                   'param_types': ['host', 'url', 'app_params'],
+                                   'param_values': [host, url, app_params],
+                                   'result_value': result}
+                interface_log.print_log(json_log_record)
             return result
         except Exception as e:
             app_log.error('Call http method error host = {0}, url={1}', host, url)
@@ -214,15 +218,16 @@ class DubboDataSource(DataSource):
             #     'Call JsonRPC method finished successfully host = {0}, service_interface={1}, method={2}, body={3}',
             #     host, service_interface, method, body)
 
-            cost_time = int((time.time() - start_time) * 1000)
-            json_log_record = {'cost_time': cost_time, 'sender_host': local_host_name, 'sender_name': 'search_platform',
-                               'receiver_host': host,
-                               'invoke_time': format_time(start_time), 'message': 'Call JsonRPC method is invoked',
-                               'param_types': ['host', 'service_interface', 'method', 'version', 'body'],
-                               'param_values': [host, service_interface, method, version, body],
-                               'srv_group': '{0}.{1}'.format(service_interface, method),
-                               'result_value': result}
-            interface_log.print_log(json_log_record)
+            if interface_log.is_enabled():
+                cost_time = int((time.time() - start_time) * 1000)
+                json_log_record = {'cost_time': cost_time, 'sender_host': local_host_name,
+                                   'sender_name': 'search_platform', 'receiver_host': host,
+                                   'invoke_time': format_time(start_time), 'message': 'Call JsonRPC method is invoked',
+                                   'param_types': ['host', 'service_interface', 'method', 'version', 'body'],
+                                   'param_values': [host, service_interface, method, version, body],
+                                   'srv_group': '{0}.{1}'.format(service_interface, method),
+                                   'result_value': result}
+                interface_log.print_log(json_log_record)
             return result
         except Exception as e:
             app_log.error('Call JsonRPC method has error, host = {0}, service_interface={1}, method={2}, body={3}',
@@ -300,6 +300,8 @@ SERVICE_BASE_CONFIG = {
     'celery_broker_url': 'redis://172.17.8.253:6379/0',
     'register_center_key': 'SEARCH_PLATFORM_REGISTER_CENTER',
     'msg_queue': 'redis://172.17.8.253:6379/4',
+    # SLA用户消息队列分片，多个地址用逗号分隔，不配置时用户消息队列保存在msg_queue中
+    # 'msg_queue_shards': 'redis://172.17.8.253:6379/4,redis://172.17.8.254:6379/4',
     'redis_admin_id_config': 'redis://172.17.8.253:6379/3',
     'register_zk_host': '192.168.65.183:2181,192.168.65.184:2181,192.168.65.185:2181',
     'keywords_redis_host': 'redis://172.17.8.253:6379/1',
@@ -4,16 +4,20 @@ import json
 import re
 
 from algorithm.section_partitions import equal_section_partitions
+from common.caches import TtlLruCache
 from common.configs import config
 from common.connections import Es7ConnectionFactory
 from common.exceptions import InvalidParamError, GenericError
 from common.loggers import query_log
+from common.msg_bus import message_bus, Event
 from common.scripts import python_invoker
-from common.utils import deep_merge, unbind_variable, get_dict_value
+from common.utils import deep_merge, deep_merge_all, unbind_variable, get_dict_value
 from search_platform import settings
 
 __author__ = 'liuzhaoming'
 
+_MISSING = object()
+
 
 class ExtendQdslParser(object):
     """
@@ -24,6 +28,12 @@ class ExtendQdslParser(object):
         self.regex_field_str = '(?P<op_type>[\\d\\D]+?)\\((?P<field_str>[\\d\\D]*)\\)'
         self.dsl_regex_tmpl = 'tmpl:\\((?P<tmpl>[\\d\\D]+?)\\)'
         self.dsl_regex_param = 'param:\\((?P<param>[\\d\\D]+?)\\)'
+        self.regex_field_pattern = re.compile(self.regex_field_str)
+        self.dsl_tmpl_pattern = re.compile(self.dsl_regex_tmpl)
+        self.dsl_param_pattern = re.compile(self.dsl_regex_param)
+        # 单个参数值解析出来的DSL片段缓存，片段在多个请求之间共享，使用方不能修改
+        self.fragment_cache = TtlLruCache(config.get_value('/consts/query/ex_fragment_cache_size') or 5000, 0)
+        message_bus.add_event_listener(Event.TYPE_CONFIG_UPDATE, self.fragment_cache.clear)
         self.variable_name_pattern = re.compile(r'{[a-zA-Z$][a-zA-Z0-9_$]*?}')
         self.section_regex_optimize = 'optimize:(?P<optimize>[\\w]+)'
         self.section_regex_size = 'size:(?P<size>[\\d]+)'
@@ -101,7 +111,7 @@ class ExtendQdslParser(object):
         script_fields_qdsl = self.get_script_fields_dsl(query_params, es_config)
         fielddata_fields_qdsl = self.get_fielddata_fields_dsl(query_params, es_config)
         filter_qdsl = self.get_filter_qdsl(query_params, es_config)
-        return reduce(deep_merge, (
+        return deep_merge_all((
             query_qdsl, rescore_qdsl, dsl_qdsl, script_qdsl, hight_qdsl, fields_qdsl, script_fields_qdsl,
             fielddata_fields_qdsl, filter_qdsl, custom_hight_qdsl))
 
@@ -178,20 +188,31 @@ class ExtendQdslParser(object):
             sum_agg_static_dsl = deep_merge(sum_agg_static_dsl, agg_static_dsl)
         return sum_agg_static_dsl
 
-    def get_section_agg_range_dsl(self, query_params, agg_es_result):
+    def get_section_fields(self, query_params):
         """
-        返回section range aggreations dsl
+        获取需要自动分区的字段和区间数目，ex_section_salePrice=section(optimize:true,size:6)
         :param query_params:
-        :param agg_es_result:
-        :return:
+        :return: [(field_name, section_num), ...]
         """
         ex_query_params_dict = self.get_query_params_by_prefix(query_params, 'ex_section_')
-        sum_agg_range_dsl = {}
-        if not agg_es_result:
-            return sum_agg_range_dsl
+        section_fields = []
         for (key, value_list) in ex_query_params_dict.iteritems():
-            value = value_list[0]
             var_name, field_name = unbind_variable('ex_section_(?P<field_name>[\\d\\D]+)', 'field_name', key)
+            section_num = int(unbind_variable(self.section_regex_size, 'size', value_list[0])[1] or '0')
+            section_fields.append((field_name, section_num))
+        return section_fields
+
+    def get_section_child_size_dict(self, query_params, agg_es_result):
+        """
+        根据section统计结果计算各字段的子区间数目和大小
+        :param query_params:
+        :param agg_es_result:
+        :return: {field_name: (child_section_num, child_section_size)}
+        """
+        size_dict = {}
+        if not agg_es_result:
+            return size_dict
+        for field_name, section_num in self.get_section_fields(query_params):
             agg_stats_result_key = field_name + '_stats'
             if agg_stats_result_key not in agg_es_result:
                 continue
@@ -200,8 +221,30 @@ class ExtendQdslParser(object):
             std_deviation = 0 if std_deviation == 'NaN' else std_deviation
             if avg is None or std_deviation is None:
                 continue
-            section_num = int(unbind_variable(self.section_regex_size, 'size', value)[1] or '0')
-            agg_range_list = equal_section_partitions.get_child_section_range_list(avg, std_deviation, section_num)
+            child_section_num = equal_section_partitions.get_child_section_num(section_num)
+            size_dict[field_name] = (child_section_num, equal_section_partitions.get_child_section_size(
+                avg, std_deviation, child_section_num))
+        return size_dict
+
+    def get_section_agg_range_dsl(self, query_params, agg_es_result):
+        """
+        返回section range aggreations dsl
+        :param query_params:
+        :param agg_es_result:
+        :return:
+        """
+        return self.get_section_agg_range_dsl_by_size(self.get_section_child_size_dict(query_params, agg_es_result))
+
+    def get_section_agg_range_dsl_by_size(self, size_dict):
+        """
+        根据各字段的子区间数目和大小返回section range aggreations dsl
+        :param size_dict: {field_name: (child_section_num, child_section_size)}
+        :return:
+        """
+        sum_agg_range_dsl = {}
+        for field_name, (child_section_num, child_section_size) in size_dict.iteritems():
+            agg_range_list = equal_section_partitions.get_child_section_range_list_by_size(child_section_num,
+                                                                                           child_section_size)
             agg_range_dsl = {
                 'aggs': {field_name + '_range': {"range": {"ranges": agg_range_list, "field": field_name}}}}
             sum_agg_range_dsl = deep_merge(sum_agg_range_dsl, agg_range_dsl)
@@ -473,8 +516,8 @@ class ExtendQdslParser(object):
         input_qdsl_param_str = query_params.get('ex_dsl')
         if not input_qdsl_param_str:
             return {}
-        temp_name, dsl_tmpl = unbind_variable(self.dsl_regex_tmpl, 'tmpl', input_qdsl_param_str)
-        temp_name, param_str = unbind_variable(self.dsl_regex_param, 'param', input_qdsl_param_str)
+        temp_name, dsl_tmpl = unbind_variable(self.dsl_tmpl_pattern, 'tmpl', input_qdsl_param_str)
+        temp_name, param_str = unbind_variable(self.dsl_param_pattern, 'param', input_qdsl_param_str)
         if not dsl_tmpl:
             return None
         if param_str:
@@ -552,7 +595,7 @@ class ExtendQdslParser(object):
         if len(qdsl_fragment_list) == 1:
             return qdsl_fragment_list[0]
         elif len(qdsl_fragment_list) > 1:
-            return reduce(deep_merge, qdsl_fragment_list)
+            return deep_merge_all(qdsl_fragment_list)
 
     def get_query_qdsl_single_fragment(self, field_name, input_str, es_config):
         """
@@ -561,8 +604,11 @@ class ExtendQdslParser(object):
         :param input_str:
         :return:
         """
-        temp_name, op_type = unbind_variable(self.regex_field_str, 'op_type', input_str)
-        temp_name, field_str = unbind_variable(self.regex_field_str, 'field_str', input_str)
+        return self.__get_cached_fragment('query', self.__parse_query_qdsl_single_fragment, field_name, input_str,
+                                          es_config)
+
+    def __parse_query_qdsl_single_fragment(self, field_name, input_str, es_config):
+        op_type, field_str = self.__parse_op_input_str(input_str)
         if field_str is None:
             # query_log.info('Get query qdsl fragment the field_str is null')
             return None
@@ -578,8 +624,11 @@ class ExtendQdslParser(object):
         :param input_str:
         :return:
         """
-        temp_name, op_type = unbind_variable(self.regex_field_str, 'op_type', input_str)
-        temp_name, field_str = unbind_variable(self.regex_field_str, 'field_str', input_str)
+        return self.__get_cached_fragment('filter', self.__parse_filter_qdsl_single_fragment, field_name, input_str,
+                                          es_config)
+
+    def __parse_filter_qdsl_single_fragment(self, field_name, input_str, es_config):
+        op_type, field_str = self.__parse_op_input_str(input_str)
         field_str = field_str or ''
         if op_type not in self.FILTER_QDSL_PARSER_DICT:
             query_log.warning('Get filter qdsl fragment has not support op type {0}', op_type)
@@ -593,14 +642,52 @@ class ExtendQdslParser(object):
         :param input_str:
         :return:
         """
-        temp_name, op_type = unbind_variable(self.regex_field_str, 'op_type', input_str)
-        temp_name, field_str = unbind_variable(self.regex_field_str, 'field_str', input_str)
+        return self.__get_cached_fragment('agg', self.__parse_agg_qdsl_single_fragment, field_name, input_str,
+                                          es_config)
+
+    def __parse_agg_qdsl_single_fragment(self, field_name, input_str, es_config):
+        op_type, field_str = self.__parse_op_input_str(input_str)
         field_str = field_str or ''
         if op_type not in self.AGGS_QDSL_PARSER_DICT:
             query_log.warning('Get agg qdsl fragment has not support op type {0}', op_type)
             return None
         return self.AGGS_QDSL_PARSER_DICT[op_type](field_name, field_str, es_config)
 
+    def __get_cached_fragment(self, fragment_type, parse_fun, field_name, input_str, es_config):
+        """
+        从缓存中获取DSL片段，片段解析只和destination_type相关，所以用它代表es_config
+        :param fragment_type:
+        :param parse_fun:
+        :param field_name:
+        :param input_str:
+        :param es_config:
+        :return:
+        """
+        key = (fragment_type, field_name, input_str, es_config.get('destination_type', 'elasticsearch'))
+        fragment = self.fragment_cache.get(key, _MISSING)
+        if fragment is _MISSING:
+            fragment = parse_fun(field_name, input_str, es_config)
+            self.fragment_cache.set(key, fragment)
+        return fragment
+
+    def __parse_op_input_str(self, input_str):
+        """
+        解析'op_type(field_str)'格式的参数值
+        :param input_str:
+        :return: (op_type, field_str)，空字符串返回None
+        """
+        match = self.regex_field_pattern.search(input_str)
+        if not match:
+            return None, None
+        return match.group('op_type') or None, match.group('field_str') or None
+
+    def fragment_cache_stats(self):
+        """
+        获取DSL片段缓存命中信息
+        :return:
+        """
+        return self.fragment_cache.stats()
+
     def get_query_params_by_prefix(self, query_params, prefix_str):
         """
         根据前缀过滤http request请求的参数名称
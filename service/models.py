@@ -8,11 +8,13 @@ from algorithm.content_based_recom import content_recom
 from algorithm.like_query_string import like_str_algorithm
 from algorithm.section_partitions import equal_section_partitions
 from common.adapter import es_adapter, es7_adapter
+from common.caches import query_result_cache
 from common.configs import config
 from common.connections import EsConnectionFactory, Es7ConnectionFactory
 from common.exceptions import InvalidParamError, EsConnectionError
 from common.loggers import debug_log, query_log as app_log
 from common.pingyin_utils import pingyin_utils
+from common.timings import request_timing
 from common.utils import unbind_variable, deep_merge, bind_variable, get_default_es_host, get_dict_value, get_cats_path, \
     get_day_and_hour
 from dsl_parser import qdsl_parser, extend_parser, DEFAULT_VALUE
@@ -71,6 +73,22 @@ class EsProductManager(object):
     }
 
     def get(self, es_config, index_name, doc_type, args, parse_fields=None):
+        """
+        通过ES查询产品数据，相同用户相同参数的查询结果会缓存一段时间
+        :param index_name:
+        :param args:
+        :return:
+        """
+        cache_ttl = query_result_cache.get_ttl(es_config, args)
+        admin_id = parse_fields.get('adminId') if parse_fields else None
+        # 请求处理器在配置变化时预先计算了配置摘要，其它调用方没有摘要时才计算
+        config_digest = es_config.get('config_digest') or (
+            query_result_cache.get_config_digest(es_config) if admin_id and cache_ttl > 0 else None)
+        return query_result_cache.get_or_query(admin_id, index_name, args, cache_ttl,
+                                               lambda: self.__query(es_config, index_name, doc_type, args,
+                                                                    parse_fields), doc_type, config_digest)
+
+    def __query(self, es_config, index_name, doc_type, args, parse_fields=None):
         """
         通过ES查询产品数据
         :param index_name:
@@ -82,7 +100,9 @@ class EsProductManager(object):
         if not es_connection:
             raise EsConnectionError()
         start_time = time.time()
-        qdsl = qdsl_parser.get_product_query_qdsl(es_config, index_name, doc_type, args, parse_fields, es_connection)
+        with request_timing.span('build_dsl'):
+            qdsl = qdsl_parser.get_product_query_qdsl(es_config, index_name, doc_type, args, parse_fields,
+                                                      es_connection)
         # Elasticsearch7返回所有的数据条数
         if es_config.get('destination_type', 'elasticsearch') == 'elasticsearch7':
             qdsl['track_total_hits'] = True
@@ -92,8 +112,9 @@ class EsProductManager(object):
         if args.get('scene') == 'spu_aggs':
             # 根据sku聚合搜索spu场景
             es_search_params = get_es_search_params(es_config, index_name, doc_type, args, parse_fields)
-            result, es_agg_result = spu_search_scene.get_spu_by_sku(qdsl, es_config, args, parse_fields,
-                                                                    es_search_params)
+            with request_timing.span('spu_scene'):
+                result, es_agg_result = spu_search_scene.get_spu_by_sku(qdsl, es_config, args, parse_fields,
+                                                                        es_search_params)
         else:
             if args.get('ex_body_type') == 'scroll':
                 es_result = self.__scroll_search(qdsl, es_config, index_name, doc_type, args, parse_fields)
@@ -101,16 +122,20 @@ class EsProductManager(object):
                 es_result = self.__scan_search(qdsl, es_config, index_name, doc_type, args, parse_fields)
             else:
                 es_search_params = get_es_search_params(es_config, index_name, doc_type, args, parse_fields)
-                es_result = es_connection.search(
-                    index=index_name,
-                    doc_type=doc_type if doc_type != 'None' else None,
-                    body=qdsl,
-                    **es_search_params
-                )
+                with request_timing.span('es_search'):
+                    es_result = es_connection.search(
+                        index=index_name,
+                        doc_type=doc_type if doc_type != 'None' else None,
+                        body=qdsl,
+                        **es_search_params
+                    )
+                # ES服务端耗时，和es_search的差值为网络传输和序列化耗时
+                request_timing.record('es_took', es_result.get('took'))
             es_end_time = time.time()
             # app_log.info('Elasticsearch search index={0} , type={1} , spend time {2}', index_name, doc_type,
             #              es_end_time - qdsl_end_time)
-            result = self.parse_es_result(es_result, args)
+            with request_timing.span('parse_result'):
+                result = self.parse_es_result(es_result, args)
             # app_log.info('Parse elasticsearch search result index={0} , type={1} , spend time {2}', index_name,
             #              doc_type, time.time() - es_end_time)
 
@@ -153,6 +178,7 @@ class EsProductManager(object):
                                                 params={'request_timeout': BATCH_REQUEST_TIMEOUT,
                                                         'timeout': BATCH_TIMEOUT})
 
+        self._invalidate_result_cache(parse_fields)
         return es_adapter.get_es_bulk_result(es_bulk_result)
 
     def _filter_has_update_doc(self, es_config, index_name, doc_type, es_connection, _bulk_body, timestamp,
@@ -227,6 +253,14 @@ class EsProductManager(object):
             _bulk_body.append(item_product)
         return _bulk_body
 
+    def _invalidate_result_cache(self, parse_fields):
+        """
+        用户商品数据变化，清除该用户的查询结果缓存
+        :param parse_fields:
+        :return:
+        """
+        query_result_cache.invalidate(parse_fields.get('adminId') if parse_fields else None)
+
     def _add_private_field(self, es_config, data_list, param):
         """
         添加搜索平台私有字段，主要是将adminId作为私有字段添加到数据结构中
@@ -282,6 +316,7 @@ class EsProductManager(object):
             es_bulk_result = es_connection.bulk(_bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
                                                                     'timeout': BATCH_TIMEOUT})
 
+        self._invalidate_result_cache(parse_fields)
         return es_adapter.get_es_bulk_result(es_bulk_result)
 
     def _build_update_body(self, es_config, index_name, doc_type, product, parse_fields, timestamp, doc_id=None):
@@ -373,6 +408,7 @@ class EsProductManager(object):
                 es_bulk_result = es_connection.bulk(_bulk_body, params={'request_timeout': BATCH_REQUEST_TIMEOUT,
                                                                         'timeout': BATCH_TIMEOUT})
 
+            self._invalidate_result_cache(parse_fields)
             return es_adapter.get_es_bulk_result(es_bulk_result)
 
     def parse_es_result(self, es_result, args):
@@ -545,13 +581,15 @@ class EsAggManager(object):
         connection_pool = self.connection_pools[es_config.get('destination_type', 'elasticsearch')]
         es_connection = connection_pool.get_es_connection(es_config=es_config, create_index=False)
         qdsl = qdsl_parser.get_agg_qdl(es_config, index_name, doc_type, args, parse_fields, es_connection)
+        qdsl, section_size_dict = self.add_section_range_aggs(qdsl, index_name, args, parse_fields)
         app_log.info('Get agg dsl index={0} , type={1} , args={2}, qdsl={3}', index_name, doc_type, args, qdsl)
         es_result = es_connection.search(
             index=index_name,
             doc_type=doc_type if doc_type != 'None' else None,
             body=qdsl)
         result = self.parse_es_result(es_result, args)
-        range_result = self.get_agg_range_result(es_config, index_name, doc_type, args, es_result, qdsl)
+        range_result = self.get_agg_range_result(es_config, index_name, doc_type, args, es_result, qdsl,
+                                                 section_size_dict, parse_fields)
         if range_result:
             result = deep_merge(result, range_result)
         app_log.info('EsAggManager get return is {0}', result)
@@ -588,23 +626,58 @@ class EsAggManager(object):
 
         return result
 
-    def get_agg_range_result(self, es_config, index_name, doc_type, args, es_result, qdsl):
+    def add_section_range_aggs(self, qdsl, index_name, args, parse_fields=None):
+        """
+        将缓存的价格区间子区间range聚合加入到原始查询中，子区间和本次统计结果一致时不需要再次查询
+        :param qdsl:
+        :param index_name:
+        :param args:
+        :param parse_fields:
+        :return: (qdsl, 加入查询的子区间 {field_name: (child_section_num, child_section_size)})
+        """
+        section_fields = extend_parser.get_section_fields(args)
+        if not section_fields or not qdsl or 'aggs' not in qdsl:
+            return qdsl, {}
+        section_size_dict = equal_section_partitions.get_cached_child_sizes(
+            self.__get_section_cache_prefix(index_name, args, parse_fields), section_fields)
+        if not section_size_dict:
+            return qdsl, {}
+        return deep_merge(qdsl, extend_parser.get_section_agg_range_dsl_by_size(section_size_dict)), section_size_dict
+
+    def get_agg_range_result(self, es_config, index_name, doc_type, args, es_result, qdsl, section_size_dict=None,
+                             parse_fields=None):
         """
-        进行聚合 range查询
+        进行聚合 range查询，原始查询中已经包含和统计结果一致的子区间聚合时直接解析，否则再查询一次
         :param es_config:
         :param index_name:
         :param doc_type:
         :param args:
+        :param section_size_dict: 原始查询中已经加入的子区间
+        :param parse_fields:
         :return:
         """
         start_time = time.time()
         if 'aggregations' not in es_result or not es_result['aggregations']:
             return
+        cur_size_dict = extend_parser.get_section_child_size_dict(args, es_result['aggregations'])
+        if not cur_size_dict:
+            return
+        equal_section_partitions.cache_child_sizes(self.__get_section_cache_prefix(index_name, args, parse_fields),
+                                                   extend_parser.get_section_fields(args), cur_size_dict)
+        # 子区间只由子区间数目和大小决定，两者一致时原始查询的range聚合结果和再查询一次的结果相同
+        section_size_dict = section_size_dict or {}
+        hit_fields = filter(lambda field_name: section_size_dict.get(field_name) == cur_size_dict[field_name] and
+                                               field_name + '_range' in es_result['aggregations'], cur_size_dict)
+        result = self.parse_es_agg_range_result(es_result, args, hit_fields) if hit_fields else {}
+        miss_size_dict = dict((field_name, child_size) for field_name, child_size in cur_size_dict.iteritems()
+                              if field_name not in hit_fields)
+        if not miss_size_dict:
+            debug_log.print_log('get_agg_range_result use single request, spends {0}', time.time() - start_time)
+            return result
+
         connection_pool = self.connection_pools[es_config.get('destination_type', 'elasticsearch')]
         es_connection = connection_pool.get_es_connection(es_config=es_config, create_index=False)
-        agg_range_qdsl = extend_parser.get_section_agg_range_dsl(args, es_result['aggregations'])
-        if not agg_range_qdsl:
-            return
+        agg_range_qdsl = extend_parser.get_section_agg_range_dsl_by_size(miss_size_dict)
         if qdsl and 'aggs' in qdsl:
             del qdsl['aggs']
 
@@ -615,16 +688,17 @@ class EsAggManager(object):
             index=index_name,
             doc_type=doc_type if doc_type != 'None' else None,
             body=cur_qdsl)
-        result = self.parse_es_agg_range_result(es_result, args)
+        result.update(self.parse_es_agg_range_result(es_result, args, miss_size_dict.keys()) or {})
         # app_log.info('EsAggManager get agg range return is {0}', result)
         debug_log.print_log('get_agg_range_result spends {0}'.format(time.time() - start_time))
         return result
 
-    def parse_es_agg_range_result(self, es_result, query_params):
+    def parse_es_agg_range_result(self, es_result, query_params, field_names=None):
         """
         解析ES range聚合查询结果
         :param es_result:
         :param query_params:
+        :param field_names: 需要解析的字段，为空时解析所有字段
         :return:
         """
         start_time = time.time()
@@ -639,7 +713,8 @@ class EsAggManager(object):
             value = value_list[0]
             var_name, field_name = unbind_variable('ex_section_(?P<field_name>[\\d\\D]+)', 'field_name', key)
             agg_range_result_key = field_name + '_range'
-            if agg_range_result_key not in es_result['aggregations']:
+            if agg_range_result_key not in es_result['aggregations'] or (
+                    field_names is not None and field_name not in field_names):
                 continue
             optimize = bool(
                 unbind_variable(extend_parser.section_regex_optimize, 'optimize', value)[1] or config.get_value(
@@ -651,6 +726,17 @@ class EsAggManager(object):
         debug_log.print_log('parse_es_agg_range_result spends {0}', (time.time() - start_time))
         return agg_range_result
 
+    def __get_section_cache_prefix(self, index_name, args, parse_fields):
+        """
+        子区间缓存前缀，同一个用户同一个类目下的价格分布比较稳定
+        :param index_name:
+        :param args:
+        :param parse_fields:
+        :return:
+        """
+        admin_id = parse_fields.get('adminId') if parse_fields else None
+        return index_name, admin_id, get_dict_value(args, 'cats')
+
     def __parse_nomal_agg_result(self, agg_result_dict, field):
         """
         解析普通的字段聚合结果
@@ -844,6 +930,10 @@ class EsCommonSuggestManager(object):
             word_list = [word_list]
 
         app_log.info('Save common suggest words, {}, {}'.format(word_list, index_name))
+        # 批量计算拼音组合，非字符串的词汇在后面校验
+        text_word_list = filter(lambda _word: isinstance(_word, (str, unicode)),
+                                map(lambda _word: _word.get('word') if isinstance(_word, dict) else _word, word_list))
+        word_pinyin_dict = dict(zip(text_word_list, pingyin_utils.get_pingyin_combination_list(text_word_list)))
         if es_config.get('destination_type', 'elasticsearch') == 'elasticsearch7':
             # 兼容elasticsearch7.5.2的suggester操作
             body = []
@@ -856,7 +946,7 @@ class EsCommonSuggestManager(object):
                 if not isinstance(word, (str, unicode)):
                     raise ValueError('{} is not string type.'.format(word))
 
-                input_value = pingyin_utils.get_pingyin_combination(word) + [word]
+                input_value = word_pinyin_dict[word] + [word]
                 dsl = {
                     'id': self._encode_unicode(word),
                     'word': word,
@@ -884,7 +974,7 @@ class EsCommonSuggestManager(object):
                 if not isinstance(word, (str, unicode)):
                     raise ValueError('{} is not string type.'.format(word))
 
-                input_value = pingyin_utils.get_pingyin_combination(word) + [word]
+                input_value = word_pinyin_dict[word] + [word]
                 dsl = {
                     'id': self._encode_unicode(word),
                     'word': word,
@@ -1133,6 +1223,7 @@ class EsSearchManager(object):
         connection_pool = self.connection_pools[es_config.get('destination_type', 'elasticsearch')]
         es_connection = connection_pool.get_es_connection(es_config=es_config, create_index=False)
         qdsl = qdsl_parser.get_search_qdl(es_config, index_name, doc_type, args, parse_fields, es_connection)
+        qdsl, section_size_dict = Aggregation.objects.add_section_range_aggs(qdsl, index_name, args, parse_fields)
         # Elasticsearch7返回所有的数据条数
         if es_config.get('destination_type', 'elasticsearch') == 'elasticsearch7':
             qdsl['track_total_hits'] = True
@@ -1156,7 +1247,7 @@ class EsSearchManager(object):
             app_log.info('Parse elasticsearch search result index={0} , type={1} , spend time {2}', index_name,
                          doc_type, time.time() - es_end_time)
         range_result = Aggregation.objects.get_agg_range_result(es_config, index_name, doc_type, args, es_result,
-                                                                qdsl)
+                                                                qdsl, section_size_dict, parse_fields)
         if range_result:
             result = deep_merge(result, {'aggregations': range_result})
         debug_log.print_log('EsSearchManager get return is omitted')
@@ -1,34 +1,129 @@
 # -*- coding: utf-8 -*-
-from re import search
+import re
 
 from service import get_url, get_request_data
 
 
 __author__ = 'liuzhaoming'
 
+# 正则表达式编译结果缓存，配置中的表达式数量有限，不需要淘汰
+_pattern_cache = {}
+
+REGEX_META_CHARS = '.^$*+?{}[]\\|()'
+
+
+def compile_expression(expression):
+    """
+    获取编译后的正则表达式
+    :param expression:
+    :return:
+    """
+    pattern = _pattern_cache.get(expression)
+    if pattern is None:
+        pattern = _pattern_cache[expression] = re.compile(expression)
+    return pattern
+
+
+def get_literal_prefix(expression):
+    """
+    获取正则表达式开头的字面量前缀，用于在正则匹配前缩小候选范围
+    :param expression:
+    :return: (是否以^开头, 字面量前缀)，无法确定前缀时返回(False, '')
+    """
+    if not expression or has_top_level_alternation(expression):
+        return False, ''
+    anchored = expression.startswith('^')
+    body = expression[1:] if anchored else expression
+    literal_chars = []
+    for index, char in enumerate(body):
+        if char in REGEX_META_CHARS:
+            # 量词作用于前一个字符，该字符不是必需的
+            if char in '*?{' and literal_chars:
+                literal_chars.pop()
+            break
+        literal_chars.append(char)
+    return anchored, ''.join(literal_chars)
+
+
+def has_top_level_alternation(expression):
+    """
+    判断正则表达式是否包含不在分组内的'|'
+    :param expression:
+    :return:
+    """
+    depth, escaped, in_class = 0, False, False
+    for char in expression:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+    return False
+
 
 class RequestFilter(object):
     """
     请求过滤器
     """
 
-    def filter(self, request, filter_config):
+    def filter(self, request, filter_config, url=None):
         """
         判断是否符合所有匹配条件
+        :param request:
+        :param filter_config:
+        :param url: 已经获取的请求URL，避免重复获取
         """
         if 'conditions' not in filter_config or not filter_config['conditions']:
             return True
         conditions = filter_config['conditions']
         union_operator = filter_config.get('union_operator', 'and')
         for condition in conditions:
-            match_result = self.__match_single_condition(request, condition)
+            match_result = self.__match_single_condition(request, condition, url)
             if union_operator == 'and' and not match_result:
                 return False
             elif union_operator == 'or' and match_result:
                 return True
         return True if union_operator == 'and' else False
 
-    def __match_single_condition(self, request, condition):
+    def is_url_only(self, filter_config):
+        """
+        判断过滤条件是否只和URL相关，只和URL相关的匹配结果可以按照URL缓存
+        :param filter_config:
+        :return:
+        """
+        if not filter_config:
+            return True
+        return all(map(lambda condition: condition.get('type') != 'regex' or condition.get('field', 'url') == 'url',
+                       filter_config.get('conditions') or []))
+
+    def get_url_literal_prefix(self, filter_config):
+        """
+        获取过滤条件要求URL必须包含的字面量前缀
+        :param filter_config:
+        :return: (是否必须以前缀开头, 字面量前缀)，没有要求时返回(False, '')
+        """
+        if not filter_config or filter_config.get('union_operator', 'and') != 'and':
+            return False, ''
+        prefix_list = [get_literal_prefix(condition.get('expression')) for condition in
+                       filter_config.get('conditions') or []
+                       if condition.get('type') == 'regex' and condition.get('field', 'url') == 'url'
+                       and condition.get('operator') != 'not']
+        prefix_list = sorted(filter(lambda prefix: prefix[1], prefix_list), key=lambda prefix: -len(prefix[1]))
+        anchored_prefix_list = filter(lambda prefix: prefix[0], prefix_list)
+        if anchored_prefix_list:
+            return anchored_prefix_list[0]
+        return prefix_list[0] if prefix_list else (False, '')
+
+    def __match_single_condition(self, request, condition, url=None):
         """
         判断是否符合单个匹配条件
         """
@@ -39,8 +134,8 @@ class RequestFilter(object):
             match_field = condition.get('field', 'url')
             if 'url' == match_field:
                 # URL匹配
-                match_text = get_url(request)
-                match_result = True if search(condition['expression'], match_text) else False
+                match_text = url if url is not None else get_url(request)
+                match_result = True if compile_expression(condition['expression']).search(match_text) else False
             elif 'param' == match_field:
                 # HTTP Request 附加参数匹配
                 match_result = self.__match_request_param(request, condition)
@@ -4,13 +4,16 @@ import re
 from rest_framework import status
 from rest_framework.response import Response
 
+from common.admin_config import admin_config
+from common.caches import TtlLruCache, query_result_cache
 from common.data_parsers import item_parser
 from common.es_routers import es_router
+from common.timings import request_timing
 from service.req_filter import request_filter
 from service import (get_request_data, desc_request, get_url, get_client_ip)
 from service.models import *
 from common.loggers import query_log as app_log, interface_log
-from common.utils import query_dict_to_normal_dict, local_host_name, format_time
+from common.utils import query_dict_to_normal_dict, local_host_name, format_time, freeze, get_dict_value_by_path
 
 __author__ = 'liuzhaoming'
 
@@ -28,6 +31,8 @@ class RequestHandler(object):
     def __init__(self, handler_config):
         self.handler_config = handler_config
         self.filter_config = handler_config.get('filter')
+        # 路由之后的ES配置缓存，key为(配置版本, vip用户版本, 解析出的字段值)，处理器链变化时处理器会重新创建
+        self.__es_config_cache = TtlLruCache(config.get_value('/consts/query/es_config_cache_size') or 2000, 0)
 
     def handle(self, request, format, timestamp=None, redo=False):
         """
@@ -37,11 +42,9 @@ class RequestHandler(object):
         :param timestamp
         :return:
         """
-        request_desc = None
         response = None
         start_time = time.time()
         try:
-            request_desc = desc_request(request)
             # app_log.info("Receive http request : {0} , timestamp={1} , redo={2}", request_desc, timestamp, redo)
             destination_config = self.handler_config.get('destination')
             if not destination_config:
@@ -60,57 +63,106 @@ class RequestHandler(object):
                 response = self.put(request, destination_config, timestamp, redo)
             else:
                 response = Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
-            cost_time = int((time.time() - start_time) * 1000)
-            # app_log.info('Finish handle http request {0}, and spend {1}'.format(request_desc, cost_time))
-            json_log_record = {'cost_time': cost_time, 'sender_host': get_client_ip(request),
-                               'receiver_name': 'search_platform',
-                               'receiver_host': local_host_name,
-                               'invoke_time': format_time(start_time), 'message': 'Http request handle: ',
-                               'param_types': ['http_request'],
-                               'param_values': [request_desc],
-                               'uri': uri_regex_compiled.sub('/', get_url(request)),
-                               'srv_group': request.method,
-                               'result_value': response}
-            interface_log.print_log(json_log_record)
+            # 接口日志关闭或者未被采样时不构建日志记录，请求描述和响应内容的序列化开销较大
+            if interface_log.is_enabled():
+                interface_log.print_log(self.__get_interface_log_record(request, start_time, response))
             return response
         except Exception as e:
-            cost_time = int((time.time() - start_time) * 1000)
-            json_log_record = {'cost_time': cost_time, 'sender_host': get_client_ip(request),
-                               'receiver_name': 'search_platform',
-                               'receiver_host': local_host_name,
-                               'invoke_time': format_time(start_time), 'message': 'Http request handle: ',
-                               'param_types': ['http_request'],
-                               'param_values': [request_desc],
-                               'uri': uri_regex_compiled.sub('/', get_url(request)),
-                               'srv_group': request.method,
-                               'result_value': response}
-            app_log.error('Handle http request error, {0}, {1}', e,
-                          self.handler_config.get('name') or self.handler_config.get('res_type'), request_desc)
-            interface_log.print_error(json_log_record, e)
+            request_desc = desc_request(request)
+            app_log.error('Handle http request error, {0}, {1}', e, self.get_name(), request_desc)
+            interface_log.print_error(self.__get_interface_log_record(request, start_time, response, request_desc), e)
             raise e
 
-    def match(self, request):
+    def __get_interface_log_record(self, request, start_time, response, request_desc=None):
+        """
+        构建接口日志记录
+        :param request:
+        :param start_time:
+        :param response:
+        :param request_desc:
+        :return:
+        """
+        cost_time = int((time.time() - start_time) * 1000)
+        return {'cost_time': cost_time, 'sender_host': get_client_ip(request),
+                'receiver_name': 'search_platform',
+                'receiver_host': local_host_name,
+                'invoke_time': format_time(start_time), 'message': 'Http request handle: ',
+                'param_types': ['http_request'],
+                'param_values': [request_desc or desc_request(request)],
+                'uri': uri_regex_compiled.sub('/', get_url(request)),
+                'srv_group': request.method,
+                'result_value': response}
+
+    def get_name(self):
+        """
+        获取处理器名称，用于日志和耗时统计
+        :return:
+        """
+        return self.handler_config.get('name') or self.handler_config.get('res_type')
+
+    def match(self, request, url=None):
         """
         是否匹配请求
         :param request:
+        :param url: 已经获取的请求URL
         :return:
         """
-        return request_filter.filter(request, self.filter_config)
+        return request_filter.filter(request, self.filter_config, url)
 
     def __get_es_config(self, destination_config, field_values):
         """
-        获取ES配置参数
+        获取ES配置参数，返回的配置不可修改。
+        路由结果确定时结果只和配置版本、vip用户和字段值相关，缓存整个结果；
+        随机路由每次请求重新选择目标，只缓存合并引用后的配置
         :param destination_config:
         :return:
         """
-        es_config = es_router.merge_es_config(destination_config)
-        es_config = es_router.route(es_config, input_param=field_values)
-        index, doc_type, doc_id = es_adapter.get_es_doc_keys(es_config, kwargs=field_values)
-        es_config['index'] = index
-        es_config['type'] = doc_type
-        es_config['id'] = doc_id
+        if not es_router.is_deterministic(destination_config):
+            return self.__resolve_es_config(self.__get_merged_es_config(destination_config), field_values)
+        try:
+            cache_key = (config.version, admin_config.vip_version, frozenset(field_values.iteritems()))
+        except TypeError:
+            # 字段值不可hash时不使用缓存
+            return self.__resolve_es_config(self.__get_merged_es_config(destination_config), field_values)
+        es_config = self.__es_config_cache.get(cache_key)
+        if es_config is None:
+            es_config = self.__resolve_es_config(self.__get_merged_es_config(destination_config), field_values)
+            self.__es_config_cache.set(cache_key, es_config)
         return es_config
 
+    def __get_merged_es_config(self, destination_config):
+        """
+        合并引用后的ES配置，只和配置版本相关，处理器的destination配置不变。
+        同时为每个路由目标计算查询结果缓存使用的配置摘要，避免每次请求序列化包含索引设置的整个配置
+        :param destination_config:
+        :return:
+        """
+        cache_key = ('merged', config.version)
+        merged_es_config = self.__es_config_cache.get(cache_key)
+        if merged_es_config is None:
+            merged_es_config = freeze(self.__add_config_digest(es_router.merge_es_config(destination_config)))
+            self.__es_config_cache.set(cache_key, merged_es_config)
+        return merged_es_config
+
+    @staticmethod
+    def __add_config_digest(merged_es_config):
+        """
+        路由结果是路由目标中的一个，摘要加到每个路由目标中；合并结果可能是处理器的原始配置，复制后修改
+        :param merged_es_config:
+        :return:
+        """
+        targets = get_dict_value_by_path('router/target', merged_es_config)
+        if not targets:
+            return dict(merged_es_config, config_digest=query_result_cache.get_config_digest(merged_es_config))
+        targets = [dict(target, config_digest=query_result_cache.get_config_digest(target)) for target in targets]
+        return dict(merged_es_config, router=dict(merged_es_config['router'], target=targets))
+
+    @staticmethod
+    def __resolve_es_config(merged_es_config, field_values):
+        es_config = es_router.route(merged_es_config, input_param=field_values)
+        index, doc_type, doc_id = es_adapter.get_es_doc_keys(es_config, kwargs=field_values)
+        return freeze(dict(es_config, index=index, type=doc_type, id=doc_id))
+
     def __fetch_from_es(self, request, destination_config, format):
         """
         从ES获取数据
@@ -119,14 +171,17 @@ class RequestHandler(object):
         :param format:
         :return:
         """
-        field_values = self.__get_fields_value(request)
-        es_config = self.__get_es_config(destination_config, field_values)
+        with request_timing.span('parse_fields'):
+            field_values = self.__get_fields_value(request)
+        with request_timing.span('es_config'):
+            es_config = self.__get_es_config(destination_config, field_values)
 
         res_type = self.handler_config.get('res_type', 'product')
         model = self.__get_model(res_type)
         if model:
-            result = model.objects.get(es_config, index_name=es_config['index'], doc_type=es_config['type'],
-                                       args=get_request_data(request), parse_fields=field_values)
+            with request_timing.span('query'):
+                result = model.objects.get(es_config, index_name=es_config['index'], doc_type=es_config['type'],
+                                           args=get_request_data(request), parse_fields=field_values)
             return result
 
     def post(self, request, destination_config, timestamp, redo=False):
@@ -137,8 +192,10 @@ class RequestHandler(object):
         :param redo
         :return:
         """
-        field_values = self.__get_fields_value(request)
-        es_config = self.__get_es_config(destination_config, field_values)
+        with request_timing.span('parse_fields'):
+            field_values = self.__get_fields_value(request)
+        with request_timing.span('es_config'):
+            es_config = self.__get_es_config(destination_config, field_values)
 
         res_type = self.handler_config.get('res_type', 'product')
         model = self.__get_model(res_type)
@@ -155,8 +212,10 @@ class RequestHandler(object):
         :param redo
         :return:
         """
-        field_values = self.__get_fields_value(request)
-        es_config = self.__get_es_config(destination_config, field_values)
+        with request_timing.span('parse_fields'):
+            field_values = self.__get_fields_value(request)
+        with request_timing.span('es_config'):
+            es_config = self.__get_es_config(destination_config, field_values)
 
         res_type = self.handler_config.get('res_type', 'product')
         model = self.__get_model(res_type)
@@ -173,8 +232,10 @@ class RequestHandler(object):
         :param redo
         :return:
         """
-        field_values = self.__get_fields_value(request)
-        es_config = self.__get_es_config(destination_config, field_values)
+        with request_timing.span('parse_fields'):
+            field_values = self.__get_fields_value(request)
+        with request_timing.span('es_config'):
+            es_config = self.__get_es_config(destination_config, field_values)
 
         res_type = self.handler_config.get('res_type', 'product')
         model = self.__get_model(res_type)
@@ -1,13 +1,51 @@
 # -*- coding: utf-8 -*-
+from common.caches import TtlLruCache
 from common.configs import config
 from common.msg_bus import message_bus, Event
 from common.loggers import query_log as app_log
-from service import desc_request
+from service import desc_request, get_url
+from service.req_filter import request_filter
 from service.req_handler import RequestHandler
 
 __author__ = 'liuzhaoming'
 
 
+class RouteEntry(object):
+    """
+    编译后的路由项，保存处理器在chain中的顺序以及URL字面量前缀
+    """
+
+    def __init__(self, order, handler):
+        self.order = order
+        self.handler = handler
+        self.anchored, self.literal = request_filter.get_url_literal_prefix(handler.filter_config)
+        self.url_only = request_filter.is_url_only(handler.filter_config)
+        # 以'/'开头且包含完整第一段路径的前缀可以按照第一段路径建立索引
+        self.segment = get_url_segment(self.literal) \
+            if self.anchored and self.literal.find('/', 1) > 0 else None
+
+    def may_match(self, url):
+        """
+        通过字面量前缀快速判断URL是否可能匹配，不可能匹配时不需要执行正则
+        :param url:
+        :return:
+        """
+        if not self.literal:
+            return True
+        return url.startswith(self.literal) if self.anchored else self.literal in url
+
+
+def get_url_segment(url):
+    """
+    获取URL第一段路径
+    :param url:
+    :return:
+    """
+    if not url or not url.startswith('/'):
+        return None
+    return url.split('/', 2)[1]
+
+
 class RequestRouter(object):
     """
     HTTP请求路由器
@@ -23,13 +61,36 @@ class RequestRouter(object):
         根据配置数据初始化HTTP请求路由器
         :return:
         """
+        self.load_chain(config.get_value('query/chain'))
+
+    def load_chain(self, chain):
+        """
+        加载处理器链配置并编译路由表
+        :param chain:
+        :return:
+        """
         self.__handler_list = None
-        chain = config.get_value('query/chain')
+        self.__segment_index = {}
+        self.__unindexed_entries = []
+        self.__route_cache = TtlLruCache(config.get_value('/consts/query/route_cache_size') or 10000, 0)
         if not chain or len(chain) == 0:
             app_log.error("Chain config is invalid")
             return
 
         self.__handler_list = map(lambda handler_config: RequestHandler(handler_config), chain)
+        self.__compile(self.__handler_list)
+
+    def __compile(self, handler_list):
+        """
+        将处理器列表编译为按照URL第一段路径索引的路由表，每个索引项都保持chain中的原始顺序
+        :param handler_list:
+        :return:
+        """
+        entry_list = [RouteEntry(order, handler) for order, handler in enumerate(handler_list)]
+        self.__unindexed_entries = filter(lambda entry: entry.segment is None, entry_list)
+        segment_set = set(entry.segment for entry in entry_list if entry.segment is not None)
+        for segment in segment_set:
+            self.__segment_index[segment] = filter(lambda entry: entry.segment in (None, segment), entry_list)
 
     def route(self, request):
         """
@@ -37,11 +98,33 @@ class RequestRouter(object):
         :param request:
         :return:
         """
-        for handler in self.__handler_list:
-            if handler.match(request):
-                return handler
+        if self.__handler_list is None:
+            app_log.error('Cannot route http request, chain config is invalid : {0}', desc_request(request))
+            return
+        url = get_url(request)
+        handler = self.__route_cache.get(url)
+        if handler is not None:
+            return handler
+
+        cacheable = True
+        for entry in self.__segment_index.get(get_url_segment(url), self.__unindexed_entries):
+            if not entry.may_match(url):
+                continue
+            cacheable = cacheable and entry.url_only
+            if entry.handler.match(request, url):
+                if cacheable:
+                    # 之前的路由项都只和URL相关，同一个URL的路由结果不会变化
+                    self.__route_cache.set(url, entry.handler)
+                return entry.handler
 
         app_log.error('Cannot route http request : {0}', desc_request(request))
 
+    def route_cache_stats(self):
+        """
+        获取路由缓存命中信息
+        :return:
+        """
+        return self.__route_cache.stats()
+
 
-request_router = RequestRouter()
\ No newline at end of file
+request_router = RequestRouter()
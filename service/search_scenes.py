@@ -3,8 +3,13 @@ import time
 from collections import OrderedDict
 from itertools import chain
 
+import elasticsearch7
+
 from common.adapter import es_adapter, es7_adapter
+from common.configs import config
+from common.connections import EsConnectionFactory, Es7ConnectionFactory
 from common.loggers import app_log
+from common.utils import get_default_es_host
 
 __author__ = 'liuzhaoming'
 
@@ -82,11 +87,21 @@ class SpuSearchBySku(object):
     结果以SPU的方式展示
     流程为：先查询所有符合条件的spuId、skuId，然后手工根据spuId和skuId进行分页，分页后在根据spuId和skuId分别查询数据
     如果原查询中带有aggs聚合，那么还要做一次聚合
+    配置/consts/query/spu_aggs/mode为stream时使用流式模式，只获取到当前页为止的spuId，默认为全量扫描模式。
+    流式模式没有扫描完所有数据时SPU总数来自cardinality聚合，SPU数目小于precision_threshold时接近精确，超过时为估算值
     """
 
+    def __init__(self):
+        # 不支持collapse的索引，例如spuId没有doc_values
+        self.__collapse_unsupported_indexes = set()
+
     def get_spu_by_sku(self, sku_dsl, es_cfg, args, parse_fields, es_search_params=None):
         from service.models import Aggregation
 
+        spu_aggs_cfg = config.get_value('/consts/query/spu_aggs') or {}
+        if spu_aggs_cfg.get('mode', 'scan') == 'stream':
+            return self.get_spu_by_sku_streaming(sku_dsl, es_cfg, args, parse_fields, es_search_params, spu_aggs_cfg)
+
         total_start_time = time.time()
         start_time = time.time()
         spu_dsl = self.get_spu_sku_id_query_dsl(sku_dsl)
@@ -245,6 +260,193 @@ class SpuSearchBySku(object):
             # app_log.info('spu by sku total spends {0}  {1}', time.time() - total_start_time, parse_fields)
             return product_dict, None
 
+    def get_spu_by_sku_streaming(self, sku_dsl, es_cfg, args, parse_fields, es_search_params=None,
+                                 spu_aggs_cfg=None):
+        """
+        流式获取SPU，只获取当前页及之前的spuId，然后根据当前页的spuId查询符合条件的SKU，
+        不需要在内存中保存所有的spuId、skuId
+        ES7优先使用collapse按照spuId折叠，不支持时使用scroll逐页获取，获取到足够的spuId后立即停止
+        :param sku_dsl:
+        :param es_cfg:
+        :param args:
+        :param parse_fields:
+        :param es_search_params:
+        :param spu_aggs_cfg:
+        :return:
+        """
+        from service.models import Aggregation
+
+        spu_aggs_cfg = spu_aggs_cfg or {}
+        es_search_params = es_search_params or {}
+        is_es7 = es_cfg.get('destination_type', 'elasticsearch') == 'elasticsearch7'
+        from_pos = sku_dsl.get('from') or 0
+        page_size = sku_dsl.get('size') or 0
+
+        page_spu_ids = None
+        if is_es7 and spu_aggs_cfg.get('collapse', True) and 'rescore' not in sku_dsl \
+                and es_cfg['index'] not in self.__collapse_unsupported_indexes:
+            page_spu_ids, total_size = self.__get_page_spu_ids_by_collapse(sku_dsl, es_cfg, from_pos, page_size,
+                                                                          es_search_params)
+        if page_spu_ids is None:
+            page_spu_ids, total_size = self.__get_page_spu_ids_by_scroll(sku_dsl, es_cfg, from_pos, page_size,
+                                                                        es_search_params,
+                                                                        spu_aggs_cfg.get('scroll_size') or 1000)
+
+        admin_id = parse_fields['adminId']
+        spu_query_dsl = {'query': {'bool': {'must': [{'terms': {'spuId': page_spu_ids}},
+                                                     {'term': {'_adminId': admin_id}}]}},
+                         'size': len(page_spu_ids)}
+        sku_query_dsl = {'query': {'bool': {'must': [{'terms': {'spuId': page_spu_ids}},
+                                                     {'term': {'_adminId': admin_id}}]}},
+                         'size': spu_aggs_cfg.get('max_sku_size') or 10000}
+        if 'query' in sku_dsl:
+            sku_query_dsl['query']['bool']['must'].insert(0, sku_dsl['query'])
+        if 'sort' in sku_dsl:
+            sku_query_dsl['sort'] = sku_dsl['sort']
+        if 'post_filter' in sku_dsl:
+            # spuId按照post_filter过滤后的SKU获取，当前页SKU也需要同样过滤
+            sku_query_dsl['post_filter'] = sku_dsl['post_filter']
+
+        if 'spu_index' in es_cfg:
+            spu_index, _, _ = es_adapter.get_es_doc_keys({'index': es_cfg['spu_index']}, kwargs=parse_fields)
+        else:
+            spu_index = es_cfg['index']
+        if is_es7:
+            spu_header, sku_header = {'index': spu_index}, {'index': es_cfg['index']}
+        else:
+            spu_type = es_cfg['spu_type'] if 'spu_type' in es_cfg else es_adapter.get_spu_es_setting(
+                admin_id).get('type')
+            spu_header = {'index': spu_index, 'type': spu_type}
+            sku_header = {'index': es_cfg['index'], 'type': es_cfg['type']}
+        multi_search_body = [spu_header, spu_query_dsl, sku_header, sku_query_dsl]
+        if 'aggs' in sku_dsl:
+            # 如果原来的dsl带聚合，那么还需要额外做一次聚合操作
+            sku_dsl['size'] = 0
+            multi_search_body.extend((dict(sku_header), sku_dsl))
+        adapter = es7_adapter if is_es7 else es_adapter
+        multi_search_results = adapter.multi_search(multi_search_body, es_cfg['host'], es_cfg['index'], None)
+
+        # 按照SKU的排序结果组装当前页SPU和SKU的对应关系
+        aggs_sku_size = int(args['aggs_sku_size']) if 'aggs_sku_size' in args and int(args['aggs_sku_size']) > 0 else 0
+        page_spu_sku_dict = SpuAndSkuDict(aggs_sku_size=aggs_sku_size) if aggs_sku_size > 0 else SpuAndSkuDict()
+        for spu_id in page_spu_ids:
+            page_spu_sku_dict.put_list(spu_id, [])
+        for sku_hit in multi_search_results['responses'][1]['hits']['hits']:
+            sku_source = sku_hit.get('_source') or {}
+            if sku_source.get('spuId') is not None and sku_source.get('skuId') is not None:
+                page_spu_sku_dict.put(sku_source['spuId'], sku_source['skuId'])
+
+        spu_list = self.parse_spu_search_result(multi_search_results, page_spu_sku_dict,
+                                                delete_goods_field=aggs_sku_size > 0)
+        self.parse_sku_search_result(spu_list, args, multi_search_results, page_spu_sku_dict)
+
+        product_dict = {'root': spu_list, 'total': total_size}
+        if 'aggs' in sku_dsl:
+            aggs_search_response = multi_search_results['responses'][2]
+            aggs_dict = Aggregation.objects.parse_es_result(aggs_search_response, args)
+            return {'products': product_dict, 'aggregations': aggs_dict}, aggs_search_response
+        return product_dict, None
+
+    def __get_page_spu_ids_by_collapse(self, sku_dsl, es_cfg, from_pos, page_size, es_search_params):
+        """
+        通过collapse按照spuId折叠SKU，直接由ES完成SPU分页，SPU总数通过cardinality聚合获取
+        :return: (当前页spuId列表, SPU总数)，索引不支持collapse时返回(None, 0)
+        """
+        spu_id_dsl = self.__get_spu_id_query_body(sku_dsl)
+        spu_id_dsl.update({'collapse': {'field': 'spuId'}, 'from': from_pos, 'size': page_size, '_source': ['spuId'],
+                           'track_total_hits': False, 'aggs': self.__get_spu_total_agg(sku_dsl)})
+        es_connection = Es7ConnectionFactory.get_es_connection(host=es_cfg.get('host') or get_default_es_host())
+        try:
+            es_result = es_connection.search(index=es_cfg['index'], body=spu_id_dsl, **es_search_params)
+        except elasticsearch7.TransportError as e:
+            if e.status_code != 400 or 'collapse' not in str(e):
+                raise
+            app_log.warning('Index {0} does not support collapse on spuId, use scroll instead', es_cfg['index'])
+            self.__collapse_unsupported_indexes.add(es_cfg['index'])
+            return None, 0
+        spu_id_list = [hit['_source']['spuId'] for hit in es_result['hits']['hits'] if
+                       'spuId' in (hit.get('_source') or {})]
+        return spu_id_list, self.__get_spu_total(es_result)
+
+    def __get_page_spu_ids_by_scroll(self, sku_dsl, es_cfg, from_pos, page_size, es_search_params, scroll_size):
+        """
+        通过scroll逐页获取spuId，获取到from+size个不同的spuId后停止
+        :return: (当前页spuId列表, SPU总数)
+        """
+        is_es7 = es_cfg.get('destination_type', 'elasticsearch') == 'elasticsearch7'
+        spu_id_dsl = self.__get_spu_id_query_body(sku_dsl)
+        spu_id_dsl['size'] = scroll_size
+        spu_id_dsl['aggs'] = self.__get_spu_total_agg(sku_dsl)
+        host = es_cfg.get('host') or get_default_es_host()
+        if is_es7:
+            scroll_time, adapter = '10s', es7_adapter
+            spu_id_dsl['_source'] = ['spuId']
+            spu_id_dsl.setdefault('sort', ['_doc'])
+            es_connection = Es7ConnectionFactory.get_es_connection(host=host)
+            es_result = es_connection.search(index=es_cfg['index'], body=spu_id_dsl, scroll=scroll_time,
+                                             **es_search_params)
+        else:
+            scroll_time, adapter = '1m', es_adapter
+            spu_id_dsl['fields'] = ['spuId']
+            es_connection = EsConnectionFactory.get_es_connection(host=host)
+            es_result = es_connection.search(index=es_cfg['index'], doc_type=es_cfg.get('type'), body=spu_id_dsl,
+                                             scroll=scroll_time, **es_search_params)
+        total_size = self.__get_spu_total(es_result)
+        need_size = from_pos + page_size
+        spu_id_list, spu_id_set = [], set()
+        scroll_id = es_result.get('_scroll_id')
+        exhausted = False
+        try:
+            while True:
+                hits = es_result['hits']['hits']
+                for hit in hits:
+                    spu_id = (hit.get('_source') or {}).get('spuId') if is_es7 else \
+                        ((hit.get('fields') or {}).get('spuId') or [None])[0]
+                    if spu_id is not None and spu_id not in spu_id_set:
+                        spu_id_set.add(spu_id)
+                        spu_id_list.append(spu_id)
+                if len(spu_id_list) >= need_size:
+                    break
+                if len(hits) < scroll_size or not scroll_id:
+                    exhausted = True
+                    break
+                es_result = es_connection.scroll(scroll_id=scroll_id, scroll=scroll_time)
+                scroll_id = es_result.get('_scroll_id') or scroll_id
+        finally:
+            if scroll_id:
+                # 立即删除scroll以减小scroll_context的数量
+                adapter.delete_scroll(scroll_id, **es_cfg)
+        if exhausted:
+            # 扫描完所有数据时SPU总数是精确值
+            total_size = len(spu_id_list)
+        return spu_id_list[from_pos:need_size], total_size
+
+    def __get_spu_id_query_body(self, sku_dsl):
+        """
+        获取查询spuId的DSL，只保留查询和排序相关的条件
+        :param sku_dsl:
+        :return:
+        """
+        return dict((key, value) for (key, value) in sku_dsl.iteritems() if key not in (
+            'aggs', 'from', 'size', 'fields', '_source', 'highlight', 'script_fields', 'track_total_hits'))
+
+    def __get_spu_total_agg(self, sku_dsl):
+        """
+        SPU总数聚合，cardinality为近似去重计数，SPU数目超过precision_threshold时有误差，40000为ES允许的最大值。
+        聚合不受post_filter影响，有post_filter时在filter聚合中计数
+        :param sku_dsl:
+        :return:
+        """
+        total_agg = {'spu_total': {'cardinality': {'field': 'spuId', 'precision_threshold': 40000}}}
+        if 'post_filter' in sku_dsl:
+            return {'spu_total_filter': {'filter': sku_dsl['post_filter'], 'aggs': total_agg}}
+        return total_agg
+
+    def __get_spu_total(self, es_result):
+        aggregations = es_result.get('aggregations') or {}
+        aggregations = aggregations.get('spu_total_filter') or aggregations
+        return int((aggregations.get('spu_total') or {}).get('value') or 0)
+
     def generate_sku_query_dsl(self, sku_dsl, sku_id_list, es_cfg, admin_id):
         """
         生成SKU查询DSL
@@ -304,15 +506,18 @@ class SpuSearchBySku(object):
         :return:
         """
         spu_search_response = multi_search_results['responses'][0]
+        spu_source_dict = {}
+        for spu_item in spu_search_response['hits']['hits']:
+            spu_source_dict.setdefault(spu_item['_source']['spuId'], spu_item['_source'])
         spu_list = []
         for spu_id in page_spu_sku_dict.get_spu_ids():
-            for spu_item in spu_search_response['hits']['hits']:
-                if spu_id == spu_item['_source']['spuId']:
-                    spu_item['_source']['skuList'] = []
-                    if delete_goods_field and 'goods' in spu_item['_source']:
-                        del spu_item['_source']['goods']
-                    spu_list.append(spu_item['_source'])
-                    break
+            spu_source = spu_source_dict.get(spu_id)
+            if spu_source is None:
+                continue
+            spu_source['skuList'] = []
+            if delete_goods_field and 'goods' in spu_source:
+                del spu_source['goods']
+            spu_list.append(spu_source)
         return spu_list
 
     def get_spu_sku_id_query_dsl(self, sku_dsl):
@@ -8,6 +8,7 @@ from rest_framework.response import Response
 from common.exceptions import GenericError
 
 from common.sla import rest_sla
+from common.timings import request_timing
 from search_platform.responses import ExceptionResponse
 from service.req_router import request_router
 
@@ -51,11 +52,30 @@ class RestfulFacadeView(APIView):
         """
         return self.__handle_request(request, format)
 
+    def finalize_response(self, request, response, *args, **kwargs):
+        """
+        渲染响应并结束当前请求的阶段计时
+        :param request:
+        :param response:
+        :return:
+        """
+        response = super(RestfulFacadeView, self).finalize_response(request, response, *args, **kwargs)
+        if request_timing.current():
+            try:
+                with request_timing.span('render'):
+                    response.render()
+            finally:
+                request_timing.finish()
+        return response
+
     def __handle_request(self, request, format):
         try:
             timestamp = int(time.time() * 100)
-            req_handler = request_router.route(request)
+            request_timing.start()
+            with request_timing.span('route'):
+                req_handler = request_router.route(request)
             if req_handler:
+                request_timing.set_handler(req_handler.get_name())
                 result = req_handler.handle(request, format, timestamp)
                 return result if isinstance(result, Response) else Response(result)
             return Response(status=status.HTTP_404_NOT_FOUND)
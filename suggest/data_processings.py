@@ -53,17 +53,19 @@ class BasicElasticsearchDataProcessing(DataProcessing):
         if data_list:
             admin_id = data_list[0]['adminId']
             word_query_freq_list = keyword_freq_service.get_keyword_freq(admin_id, word_list)
+        word_pinyin_list = pingyin_utils.get_pingyin_combination_list(word_list)
         index = 0
         for data in data_list:
             data['id'] = self.__to_suggest_doc_id(data['word'], data['adminId'])
             weight_update_body = self.__get_weight_update_body(processing_config, data, word_query_freq_list[index])
+            word_pinyin = word_pinyin_list[index]
             index += 1
             payloads_update_body = self.__get_payload_update_body(processing_config, data)
             common_fields_update_body = self.__get_common_fields_update_body(processing_config, data)
             word = data['word']
             suggest_field = 'suggest'
             create_doc = {'name': word, suggest_field: {'payload': {}, 'weight': 0,
-                                                        'input': pingyin_utils.get_pingyin_combination(word) + [word],
+                                                        'input': word_pinyin + [word],
                                                         'output': word, 'context': {'adminId': admin_id}}}
 
             update_doc = None
@@ -1,8 +1,10 @@
 # coding=utf-8
 from collections import OrderedDict
 from itertools import chain
+import re
 
 import ujson as json
+from common.caches import TtlLruCache, analyze_token_cache
 from common.configs import config
 from common.connections import EsConnectionFactory
 from common.es_routers import es_router
@@ -13,6 +15,11 @@ from service.dsl_parser import qdsl_parser
 
 __author__ = 'liuzhaoming'
 
+# 分词结果缓存key的前缀，suggest缓存未过滤、未去重的分词结果，和查询分词结果的格式不同
+SUGGEST_ANALYZE_KEY_PREFIX = 'suggest'
+# 字段分词器缓存，key为(host, index, doc_type, fields)
+field_analyzer_cache = TtlLruCache(1000, config.get_value('consts/suggest/analyze_cache_ttl') or 3600)
+
 
 class SuggestSource(object):
     def pull(self, suggest_config, request_param, suggest_term_dict={}):
@@ -60,19 +67,13 @@ class ElasticsearchDataSource(SuggestSource):
         if source_docs['total'] == 0:
             return source_docs
 
-        if es_version == 7:
-            field_mapping_result = es7_adapter.get_fields_mapping(host, request_param['index'], None, query_fields)
-            field_mapping_dict = field_mapping_result[request_param['index']]['mappings']
-        else:
-            field_mapping_result = es_adapter.get_fields_mapping(host, request_param['index'], request_param['type'],
-                                                                 query_fields)
-            field_mapping_dict = field_mapping_result[request_param['index']]['mappings'][request_param['type']]
-
-        keyword_filter_regex = str(get_dict_value_by_path('data_parser/keyword_filter_regex',
-                                                          source_config) or u'[\u4e00-\u9fa5A-Za-z0-9]+')
-        temp_list_list = [
-            self.__get_keywords_from_doc(host, keyword_filter_regex, query_fields, source_doc, field_mapping_dict,
-                                         request_param, es_version) for source_doc in source_docs['root']]
+        field_analyzer_dict = self.__get_field_analyzer_dict(host, request_param, query_fields, es_version)
+        keyword_filter_regex = re.compile(str(get_dict_value_by_path('data_parser/keyword_filter_regex',
+                                                                     source_config) or u'[\u4e00-\u9fa5A-Za-z0-9]+'))
+        analyzed_words_dict = self.__batch_analyze(host, request_param, query_fields, source_docs['root'],
+                                                   field_analyzer_dict, keyword_filter_regex, es_version)
+        temp_list_list = [self.__get_keywords_from_doc(query_fields, source_doc, field_analyzer_dict,
+                                                       analyzed_words_dict) for source_doc in source_docs['root']]
         keyword_list = list(chain(*temp_list_list))
         for _keyword in keyword_list:
             if suggest_term_dict.get(_keyword):
@@ -128,15 +129,91 @@ class ElasticsearchDataSource(SuggestSource):
 
         return tags_hits_list
 
-    def __get_keywords_from_doc(self, host, keyword_filter_regex, query_fields, source_doc, field_mapping_dict,
-                                request_param, es_version):
+    def __get_field_analyzer_dict(self, host, request_param, query_fields, es_version):
+        """
+        获取字段对应的分词器，每个索引只需要查询一次mapping
+        :param host:
+        :param request_param:
+        :param query_fields:
+        :param es_version:
+        :return: {field_name: analyzer}
+        """
+        doc_type = request_param.get('type') if es_version != 7 else None
+        cache_key = (host, request_param['index'], doc_type, tuple(query_fields))
+        field_analyzer_dict = field_analyzer_cache.get(cache_key)
+        if field_analyzer_dict is not None:
+            return field_analyzer_dict
+
+        if es_version == 7:
+            field_mapping_result = es7_adapter.get_fields_mapping(host, request_param['index'], None, query_fields)
+            field_mapping_dict = field_mapping_result[request_param['index']]['mappings']
+        else:
+            field_mapping_result = es_adapter.get_fields_mapping(host, request_param['index'], doc_type, query_fields)
+            field_mapping_dict = field_mapping_result[request_param['index']]['mappings'][doc_type]
+
+        field_analyzer_dict = {}
+        for field_name in query_fields:
+            if field_name not in field_mapping_dict:
+                continue
+            field_mapping = get_dict_value_by_path(field_name + '/mapping/' + field_name, field_mapping_dict) or {}
+            field_analyzer = field_mapping.get('analyzer') or field_mapping.get('index_analyzer')
+            if field_analyzer:
+                field_analyzer_dict[field_name] = field_analyzer
+        field_analyzer_cache.set(cache_key, field_analyzer_dict)
+        return field_analyzer_dict
+
+    def __batch_analyze(self, host, request_param, query_fields, source_docs, field_analyzer_dict,
+                        keyword_filter_regex, es_version):
         """
-        根据field mapping中指定的分词器对关键词进行分词
+        对一页文档需要分词的文本去重后批量分词，分词结果跨页缓存
         :param host:
+        :param request_param:
+        :param query_fields:
+        :param source_docs:
+        :param field_analyzer_dict:
         :param keyword_filter_regex:
+        :param es_version:
+        :return: {(analyzer, text): [keyword, ...]}
+        """
+        index = request_param['index']
+        analyzer_texts_dict = {}
+        for source_doc in source_docs:
+            for field_name in query_fields:
+                if source_doc.get(field_name) and field_name in field_analyzer_dict:
+                    analyzer_texts_dict.setdefault(field_analyzer_dict[field_name], set()).update(
+                        self.__get_field_texts(source_doc[field_name]))
+
+        adapter = es7_adapter if es_version == 7 else es_adapter
+        batch_size = config.get_value('consts/suggest/analyze_batch_size') or 100
+        analyzed_words_dict = {}
+        for analyzer, text_set in analyzer_texts_dict.iteritems():
+            uncached_text_list = []
+            for text in text_set:
+                tokens = analyze_token_cache.get_cached((SUGGEST_ANALYZE_KEY_PREFIX, host, index, analyzer, text))
+                if tokens is None:
+                    uncached_text_list.append(text)
+                else:
+                    analyzed_words_dict[(analyzer, text)] = tokens
+
+            for start in xrange(0, len(uncached_text_list), batch_size):
+                text_list = uncached_text_list[start:start + batch_size]
+                token_list_list = adapter.batch_query_text_analyze_result(host, analyzer, text_list, index)
+                for text, tokens in zip(text_list, token_list_list):
+                    analyze_token_cache.set_cached((SUGGEST_ANALYZE_KEY_PREFIX, host, index, analyzer, text), tokens)
+                    analyzed_words_dict[(analyzer, text)] = tokens
+
+        for key, tokens in analyzed_words_dict.iteritems():
+            analyzed_words_dict[key] = [token for token in tokens if
+                                        keyword_filter_regex.search(str(token)) and len(token) > 1]
+        return analyzed_words_dict
+
+    def __get_keywords_from_doc(self, query_fields, source_doc, field_analyzer_dict, analyzed_words_dict):
+        """
+        根据field mapping中指定的分词器对关键词进行分词，分词结果已经批量获取
         :param query_fields:
         :param source_doc:
-        :param field_mapping_dict:
+        :param field_analyzer_dict:
+        :param analyzed_words_dict:
         :return:
         """
         keyword_list = []
@@ -144,21 +221,23 @@ class ElasticsearchDataSource(SuggestSource):
             if not source_doc.get(field_name):
                 continue
             text = source_doc.get(field_name)
-            if field_name in field_mapping_dict:
-                field_mapping = get_dict_value_by_path(field_name + '/mapping/' + field_name, field_mapping_dict)
-                field_analyzer = field_mapping.get('analyzer') or field_mapping.get('index_analyzer')
-            if field_analyzer:
-                if es_version == 7:
-                    analyzed_words = es7_adapter.query_text_analyze_result(host, field_analyzer, text,
-                                                                           keyword_filter_regex, request_param)
-                else:
-                    analyzed_words = es_adapter.query_text_analyze_result(host, field_analyzer, text,
-                                                                          keyword_filter_regex, request_param)
-                keyword_list.extend(analyzed_words)
+            if field_name in field_analyzer_dict:
+                for field_text in self.__get_field_texts(text):
+                    keyword_list.extend(analyzed_words_dict[(field_analyzer_dict[field_name], field_text)])
             else:
                 keyword_list.append(text)
         return keyword_list
 
+    def __get_field_texts(self, value):
+        """
+        获取字段中需要分词的文本，数组字段的每个元素分别分词，和ES对数组分词的结果一致
+        :param value:
+        :return:
+        """
+        if isinstance(value, (list, tuple)):
+            return [item for item in value if item]
+        return [value]
+
     def __query_source_docs(self, source_config, request_param, host, query_fields, es_version):
         try:
             query_body = self.__get_es_query_body(source_config, request_param)
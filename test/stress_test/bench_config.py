@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+配置读取微基准测试，基于config目录中的真实配置，比较原有的逐次解析路径、路径缓存和预先绑定访问句柄的耗时
+运行方式：python test/stress_test/bench_config.py
+"""
+__author__ = 'liuzhaoming'
+
+
+def init_django_env():
+    """
+    初始化Django环境
+    :return:
+    """
+    import sys
+    import os
+
+    sys.path.append(os.path.dirname(__file__).replace('\\', '/'))
+    sys.path.append(os.path.join(os.path.dirname(__file__).replace('\\', '/'), '../../'))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'search_platform.settings'
+
+    import django
+
+    django.setup()
+
+
+init_django_env()
+
+import time
+
+from common.configs import config
+
+# 查询和消息处理过程中常用的配置路径
+BENCH_PATHS = ('/consts/query/scroll_time', '/consts/global/query_size', 'consts/custom_variables', 'version',
+               '/consts/query/query_string/match_all/analyzer', '/consts/query/spu_aggs', '/consts/global/agg_size',
+               'consts/global/admin_id_cfg/msg_lease_timeout', '/consts/query/not_exist_path')
+
+
+def legacy_get_value(config_data, path, admin_id=None):
+    """
+    原有的配置读取方式，每次调用都切分路径并递归查找
+    """
+
+    def get_value_from_dict(data_dict, key_list):
+        if not key_list or not data_dict:
+            return None
+        elif len(key_list) == 1:
+            return data_dict[key_list[0]] if key_list[0] in data_dict else None
+        else:
+            return get_value_from_dict(data_dict[key_list[0]], key_list[1:]) if key_list[0] in data_dict else None
+
+    if not path:
+        return None
+    default_key_list = filter(lambda key: key, '/'.join(('default', path)).split('/'))
+    admin_key_list = filter(lambda key: key, '/'.join((str(admin_id), path)).split('/'))
+    admin_value = get_value_from_dict(config_data, admin_key_list)
+    return admin_value if admin_value is not None else get_value_from_dict(config_data, default_key_list)
+
+
+def bench(admin_id=None, times=20000):
+    config_data = config.get_config()
+    accessor_list = [config.get_accessor(path, admin_id) for path in BENCH_PATHS]
+    for path in BENCH_PATHS:
+        assert legacy_get_value(config_data, path, admin_id) == config.get_value(path, admin_id), path
+
+    start_time = time.time()
+    for _ in xrange(times):
+        for path in BENCH_PATHS:
+            legacy_get_value(config_data, path, admin_id)
+    legacy_cost = time.time() - start_time
+
+    start_time = time.time()
+    for _ in xrange(times):
+        for path in BENCH_PATHS:
+            config.get_value(path, admin_id)
+    cached_cost = time.time() - start_time
+
+    start_time = time.time()
+    for _ in xrange(times):
+        for accessor in accessor_list:
+            accessor.get()
+    accessor_cost = time.time() - start_time
+
+    lookups = float(times * len(BENCH_PATHS))
+    print 'admin_id={0}, legacy={1:.3f}us, cached={2:.3f}us, accessor={3:.3f}us per lookup'.format(
+        admin_id, legacy_cost / lookups * 1000000, cached_cost / lookups * 1000000,
+        accessor_cost / lookups * 1000000)
+
+
+if __name__ == '__main__':
+    bench()
+    bench('A857673')
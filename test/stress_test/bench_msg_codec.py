@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+SLA消息队列编码微基准测试，比较JSON、msgpack和msgpack+zlib的编解码耗时和编码后大小
+运行方式：python test/stress_test/bench_msg_codec.py [captured_msgs_file]
+captured_msgs_file为抓取的队列消息，每行一条JSON，例如 redis-cli --raw LRANGE sp_msg_final_queue 0 999 > msgs.txt
+"""
+__author__ = 'liuzhaoming'
+
+
+def init_django_env():
+    """
+    初始化Django环境
+    :return:
+    """
+    import sys
+    import os
+
+    sys.path.append(os.path.dirname(__file__).replace('\\', '/'))
+    sys.path.append(os.path.join(os.path.dirname(__file__).replace('\\', '/'), '../../'))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'search_platform.settings'
+
+    import django
+
+    django.setup()
+
+
+init_django_env()
+
+import sys
+import time
+import ujson as json
+
+from common.msg_codecs import JsonMsgCodec, MsgCodec
+
+
+def build_sample_msgs(count=1000):
+    """
+    按照商品中心消息格式构造样例消息，包括库存价格变更的小消息、批量商品变更的大消息和重做消息
+    """
+    msgs = []
+    for index in xrange(count):
+        if index % 10 == 0:
+            body = {'adminId': 'A{0}'.format(index % 20), 'operation': 'update',
+                    'skus': [{'skuId': 'S{0}'.format(index * 100 + sku_index), 'price': 100 + sku_index,
+                              'stock': sku_index, 'title': u'测试商品标题{0}'.format(sku_index)} for sku_index in
+                             xrange(50)]}
+        else:
+            body = {'adminId': 'A{0}'.format(index % 20), 'operation': 'stock', 'skuId': 'S{0}'.format(index),
+                    'stock': index % 100}
+        msg = {'type': 'pyactivemq.TextMessage', 'text': json.dumps(body), 'river_key': 'product_river',
+               'adminId': body['adminId'], 'redo': True, 'coalesce_key': 'S{0}'.format(index)}
+        if index % 7 == 0:
+            msg.update({'redo_num': 1, 'redo_times': 3, 'redo_interval': ['5', '60', '120'], 'time': time.time(),
+                        'redo_time': [time.time()], 'error': 'es bulk error', 'redo_id': '%032x' % index})
+        msgs.append(msg)
+    return msgs
+
+
+def load_captured_msgs(file_path):
+    with open(file_path) as captured_file:
+        return [json.loads(line) for line in captured_file if line.strip()]
+
+
+def bench(name, codec, msgs, times=5):
+    start_time = time.time()
+    for _ in xrange(times):
+        data_list = map(codec.encode, msgs)
+    encode_cost = time.time() - start_time
+
+    start_time = time.time()
+    for _ in xrange(times):
+        map(codec.decode, data_list)
+    decode_cost = time.time() - start_time
+
+    total_bytes = sum(map(len, data_list))
+    count = len(msgs) * times
+    print '{0:>14}: encode={1:.2f}us/msg, decode={2:.2f}us/msg, avg size={3:.0f}B, total={4}B'.format(
+        name, encode_cost / count * 1000000, decode_cost / count * 1000000, float(total_bytes) / len(msgs),
+        total_bytes)
+    return total_bytes
+
+
+if __name__ == '__main__':
+    sample_msgs = load_captured_msgs(sys.argv[1]) if len(sys.argv) > 1 else build_sample_msgs()
+    json_bytes = bench('json', JsonMsgCodec(), sample_msgs)
+    for threshold in (0, 1024, 256):
+        msg_codec = MsgCodec()
+        msg_codec.compress_threshold = threshold
+        codec_bytes = bench('msgpack z>{0}'.format(threshold) if threshold else 'msgpack', msg_codec, sample_msgs)
+        print '{0:>14}  size ratio to json={1:.2%}'.format('', float(codec_bytes) / json_bytes)
@@ -0,0 +1,89 @@
+# coding=utf-8
+"""
+请求路由微基准测试，比较逐个正则匹配和编译后路由表的耗时
+运行方式：python test/stress_test/bench_router.py
+"""
+__author__ = 'liuzhaoming'
+
+
+def init_django_env():
+    """
+    初始化Django环境
+    :return:
+    """
+    import sys
+    import os
+
+    sys.path.append(os.path.dirname(__file__).replace('\\', '/'))
+    sys.path.append(os.path.join(os.path.dirname(__file__).replace('\\', '/'), '../../'))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'search_platform.settings'
+
+    import django
+
+    django.setup()
+
+
+init_django_env()
+
+import re
+import time
+
+from service.req_router import RequestRouter
+
+
+class BenchRequest(object):
+    """
+    模拟的HTTP请求
+    """
+
+    class InnerRequest(object):
+        def __init__(self, path):
+            self.path = path
+
+    def __init__(self, path):
+        self._request = BenchRequest.InnerRequest(path)
+        self.QUERY_PARAMS = {}
+        self.DATA = {}
+        self.method = 'GET'
+
+
+def build_chain(size):
+    return [{'name': 'bench_{0}'.format(index),
+             'filter': {'type': 'regex', 'union_operator': 'and',
+                        'conditions': [{'operator': 'is', 'type': 'regex', 'field': 'url',
+                                        'expression': '^/bench{0}/items/[\\d\\D]+'.format(index)}]}}
+            for index in xrange(size)]
+
+
+def linear_route(chain, url):
+    """
+    原有的逐个正则匹配方式
+    """
+    for handler_config in chain:
+        if re.search(handler_config['filter']['conditions'][0]['expression'], url):
+            return handler_config
+
+
+def bench(chain_size, times=20000):
+    chain = build_chain(chain_size)
+    router = RequestRouter()
+    router.load_chain(chain)
+    request_list = [BenchRequest('/bench{0}/items/A{1}'.format(chain_size - 1, index % 500)) for index in
+                    xrange(times)]
+
+    start_time = time.time()
+    for request in request_list:
+        linear_route(chain, request._request.path)
+    linear_cost = time.time() - start_time
+
+    start_time = time.time()
+    for request in request_list:
+        router.route(request)
+    router_cost = time.time() - start_time
+    print 'chain size={0:>5}, linear={1:.2f}us/req, compiled={2:.2f}us/req, cache={3}'.format(
+        chain_size, linear_cost / times * 1000000, router_cost / times * 1000000, router.route_cache_stats())
+
+
+if __name__ == '__main__':
+    for size in (10, 50, 200, 1000):
+        bench(size)
@@ -0,0 +1,29 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.utils import split_analyze_tokens
+
+__author__ = 'liuzhaoming'
+
+
+class TestSplitAnalyzeTokens(unittest.TestCase):
+    def setUp(self):
+        self.text_list = [u'苹果手机', u'华为']
+        self.tokens = [{'token': u'苹果', 'start_offset': 0, 'end_offset': 2},
+                       {'token': u'手机', 'start_offset': 2, 'end_offset': 4},
+                       {'token': u'华为', 'start_offset': 5, 'end_offset': 7}]
+
+    def test_split(self):
+        self.assertEqual(split_analyze_tokens(self.text_list, self.tokens), [[u'苹果', u'手机'], [u'华为']])
+
+    def test_invalid_offset(self):
+        self.tokens.append({'token': u'为', 'start_offset': 6, 'end_offset': 9})
+        self.assertIsNone(split_analyze_tokens(self.text_list, self.tokens))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.bulk_controllers import AdaptiveBulkController, is_bulk_item_rejected
+
+__author__ = 'liuzhaoming'
+
+
+class RejectedError(Exception):
+    status_code = 429
+
+
+class FakeBulkSender(object):
+    """
+    模拟ES bulk，reject_times记录每个_id被拒绝的次数，整个请求被拒绝时抛出429异常
+    """
+
+    def __init__(self, reject_times=None, reject_requests=0):
+        self.reject_times = reject_times or {}
+        self.reject_requests = reject_requests
+        self.requests = []
+
+    def __call__(self, bulk_body):
+        ids = [action.values()[0]['_id'] for action in bulk_body[::2]]
+        self.requests.append(ids)
+        if self.reject_requests:
+            self.reject_requests -= 1
+            raise RejectedError('es_rejected_execution_exception')
+        items = []
+        for doc_id in ids:
+            status = 201
+            if self.reject_times.get(doc_id):
+                self.reject_times[doc_id] -= 1
+                status = 429
+            items.append({'index': {'_id': doc_id, 'status': status}})
+        return {'took': 1, 'errors': False, 'items': items}
+
+
+def build_bulk_body(count):
+    body = []
+    for index in xrange(count):
+        body.extend(({'index': {'_index': 'test', '_id': str(index)}}, {'name': index}))
+    return body
+
+
+class TestAdaptiveBulkController(unittest.TestCase):
+    def test_retry_rejected_items_only(self):
+        controller = AdaptiveBulkController(initial_size=4, min_size=1, retry_base=0)
+        sender = FakeBulkSender({'1': 1, '6': 1})
+        result = controller.bulk(build_bulk_body(8), sender)
+        self.assertEqual(sender.requests, [['0', '1', '2', '3'], ['4', '5'], ['6', '7'], ['1', '6']])
+        self.assertEqual([item['index']['_id'] for item in result['items']], [str(index) for index in xrange(8)])
+        self.assertFalse(result['errors'])
+        self.assertEqual(controller.stats()['retry_count'], 2)
+
+    def test_still_rejected_after_retries(self):
+        controller = AdaptiveBulkController(initial_size=10, max_retries=2, retry_base=0)
+        result = controller.bulk(build_bulk_body(3), FakeBulkSender(reject_requests=5))
+        self.assertTrue(result['errors'])
+        self.assertTrue(all(map(is_bulk_item_rejected, result['items'])))
+        self.assertEqual(controller.stats()['fail_count'], 3)
+
+    def test_aimd(self):
+        controller = AdaptiveBulkController(initial_size=100, min_size=10, max_size=120, additive_step=20,
+                                            target_latency=1.0)
+        controller.on_response(100, 0, 0.1)
+        self.assertEqual(controller.batch_size, 120)
+        controller.on_response(120, 0, 0.1)
+        self.assertEqual(controller.batch_size, 120)
+        # 批量没有用满时不增大
+        controller.on_response(10, 0, 0.1)
+        self.assertEqual(controller.batch_size, 120)
+        controller.on_response(120, 1, 0.1)
+        self.assertEqual(controller.batch_size, 60)
+        controller.on_response(60, 0, 2.0)
+        self.assertEqual(controller.batch_size, 30)
+        for _ in xrange(5):
+            controller.on_response(30, 30, 0.1)
+        self.assertEqual(controller.batch_size, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
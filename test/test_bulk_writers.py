@@ -0,0 +1,92 @@
+# coding=utf-8
+import threading
+import unittest
+
+import ujson as json
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.bulk_writers import BulkWriterManager, CoalescingBulkWriter, serialize_bulk_body
+
+__author__ = 'liuzhaoming'
+
+
+class FakeSerializer(object):
+    def dumps(self, data):
+        return json.dumps(data)
+
+
+class FakeEsConnection(object):
+    """
+    模拟ES连接，_id为bad的操作返回404
+    """
+
+    class Transport(object):
+        serializer = FakeSerializer()
+
+    def __init__(self):
+        self.host_list = ['127.0.0.1:9200']
+        self.transport = FakeEsConnection.Transport()
+        self.bulk_sizes = []
+
+    def bulk(self, body, params=None):
+        items = []
+        lines = body.strip().split('\n')
+        pos = 0
+        while pos < len(lines):
+            action = json.loads(lines[pos])
+            op_type = action.keys()[0]
+            status = 404 if action[op_type]['_id'] == 'bad' else 200
+            items.append({op_type: {'status': status, '_id': action[op_type]['_id']}})
+            pos += 1 if op_type == 'delete' else 2
+        self.bulk_sizes.append(len(items))
+        return {'took': 1, 'errors': True, 'items': items}
+
+
+class TestCoalescingBulkWriter(unittest.TestCase):
+    def test_serialize_bulk_body(self):
+        lines, item_count = serialize_bulk_body(FakeSerializer(), [{'delete': {'_id': '1'}}, {'index': {'_id': '2'}},
+                                                                   {'name': 'a'}])
+        self.assertEqual(item_count, 2)
+        self.assertEqual(len(lines), 3)
+
+    def test_route_item_results(self):
+        es_connection = FakeEsConnection()
+        writer = CoalescingBulkWriter(es_connection, {}, max_docs=4, max_latency=0.05)
+        result_dict = {}
+
+        def push(num):
+            bulk_body = [{'index': {'_id': str(num)}}, {'num': num}]
+            if num == 2:
+                bulk_body.append({'delete': {'_id': 'bad'}})
+            result_dict[num] = writer.write(bulk_body)
+
+        thread_list = [threading.Thread(target=push, args=(num,)) for num in xrange(6)]
+        map(lambda thread: thread.start(), thread_list)
+        map(lambda thread: thread.join(), thread_list)
+
+        self.assertEqual(sum(es_connection.bulk_sizes), 7)
+        self.assertLess(len(es_connection.bulk_sizes), 6)
+        for num, result in result_dict.iteritems():
+            self.assertEqual(result['items'][0]['index']['_id'], str(num))
+            self.assertEqual(result['errors'], num == 2)
+
+
+class TestBulkWriterManager(unittest.TestCase):
+    def test_batch_scope_only_current_thread(self):
+        manager = BulkWriterManager()
+        manager.enable = False
+        other_thread_active = []
+        with manager.batch_scope():
+            self.assertTrue(manager.is_active())
+            thread = threading.Thread(target=lambda: other_thread_active.append(manager.is_active()))
+            thread.start()
+            thread.join()
+        self.assertEqual(other_thread_active, [False])
+        self.assertFalse(manager.is_active())
+
+
+if __name__ == '__main__':
+    unittest.main()
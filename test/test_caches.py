@@ -0,0 +1,153 @@
+# coding=utf-8
+import time
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.caches import TtlLruCache, QueryResultCache, analyze_token_cache
+
+__author__ = 'liuzhaoming'
+
+
+class TestTtlLruCache(unittest.TestCase):
+    def test_lru_evict(self):
+        cache = TtlLruCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl_expire(self):
+        cache = TtlLruCache(max_size=10, ttl=60)
+        cache.set('a', 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 0)
+
+
+class TestAnalyzeTokenCache(unittest.TestCase):
+    def test_get_tokens(self):
+        call_list = []
+
+        def analyze():
+            call_list.append(1)
+            return [u'手机', u'苹果']
+
+        analyze_token_cache.clear_local()
+        for _ in xrange(3):
+            tokens = analyze_token_cache.get_tokens('127.0.0.1:9200', 'test_index', 'ik', u'苹果手机', analyze)
+            self.assertEqual(sorted(tokens), [u'手机', u'苹果'])
+        self.assertEqual(len(call_list), 1)
+        analyze_token_cache.clear_local()
+        analyze_token_cache.get_tokens('127.0.0.1:9200', 'test_index', 'ik', u'苹果手机', analyze)
+        self.assertEqual(len(call_list), 2)
+
+    def test_cached_tokens_cleared_with_dictionary(self):
+        key = ('suggest', '127.0.0.1:9200', 'test_index', 'ik', u'苹果手机')
+        analyze_token_cache.clear_local()
+        self.assertIsNone(analyze_token_cache.get_cached(key))
+        analyze_token_cache.set_cached(key, [u'苹果', u'手机', u'苹果'])
+        self.assertEqual(analyze_token_cache.get_cached(key), [u'苹果', u'手机', u'苹果'])
+        # 分词词典更新时suggest的分词结果和查询的分词结果一起失效
+        analyze_token_cache.clear_local()
+        self.assertIsNone(analyze_token_cache.get_cached(key))
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.value_dict = {}
+
+    def get(self, key):
+        return self.value_dict.get(key)
+
+    def incr(self, key):
+        self.value_dict[key] = int(self.value_dict.get(key) or 0) + 1
+        return self.value_dict[key]
+
+
+class TestQueryResultCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = QueryResultCache()
+        self.cache.enable = True
+        self.cache.backend = 'local'
+        self.cache.default_ttl = 60
+        self.cache.redis_conn = FakeRedis()
+        self.cache.local_cache.clear()
+        self.cache.refresh_delay = 0
+        self.call_list = []
+
+    def query(self, admin_id='A1', args=None, ttl=60, doc_type='Product', config_digest=None):
+        def query_fun():
+            self.call_list.append(1)
+            return {'total': len(self.call_list)}
+
+        return self.cache.get_or_query(admin_id, 'sku_index', args or {'q': u'手机'}, ttl, query_fun, doc_type,
+                                       config_digest or QueryResultCache.get_config_digest({'query': 'multi_match'}))
+
+    def test_generation_invalidation(self):
+        self.assertEqual(self.query(), {'total': 1})
+        self.assertEqual(self.query('a1'), {'total': 1})
+        self.assertEqual(self.query('A2'), {'total': 2})
+        # 写操作递增版本号，只有该用户的缓存失效
+        self.cache.invalidate('A1')
+        self.assertEqual(self.query(), {'total': 3})
+        self.assertEqual(self.query(), {'total': 3})
+        self.assertEqual(self.query('A2'), {'total': 2})
+
+        # 其它进程递增版本号，超过gen_check_interval后从REDIS刷新
+        self.cache.gen_check_interval = 0
+        self.cache.redis_conn.incr(QueryResultCache.REDIS_GEN_KEY_PREFIX + 'a2')
+        self.assertEqual(self.query('A2'), {'total': 4})
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    def test_invalidate_after_refresh(self):
+        self.cache.refresh_delay = 0.2
+        self.assertEqual(self.query(), {'total': 1})
+        self.cache.invalidate('A1')
+        # ES refresh之前查询到的是旧数据，refresh之后再次递增版本号，缓存的旧结果失效
+        self.assertEqual(self.query(), {'total': 2})
+        time.sleep(0.1)
+        self.cache.invalidate('A1')
+        self.assertEqual(self.query(), {'total': 3})
+        time.sleep(0.15)
+        # 最后一次写入还没有refresh，定时器继续等待
+        self.assertEqual(self.query(), {'total': 3})
+        time.sleep(0.15)
+        self.assertEqual(self.query(), {'total': 4})
+        self.assertEqual(self.cache.redis_conn.get(QueryResultCache.REDIS_GEN_KEY_PREFIX + 'a1'), 3)
+        self.assertEqual(self.cache.pending_invalidate_dict, {})
+
+    def test_key_scope(self):
+        self.query()
+        self.assertEqual(self.query(doc_type='Spu'), {'total': 2})
+        # 相同参数在不同处理器查询配置下的结果不同
+        self.assertEqual(self.query(config_digest=QueryResultCache.get_config_digest({'query': 'match'})), {'total': 3})
+        self.assertEqual(self.query(args={'q': u'手机', 'size': '20'}), {'total': 4})
+        self.assertEqual(self.query(), {'total': 1})
+        self.assertEqual(self.query(doc_type='Spu'), {'total': 2})
+
+    def test_ttl_bypass(self):
+        self.assertEqual(self.cache.get_ttl({}), 60)
+        self.assertEqual(self.cache.get_ttl({'result_cache_ttl': 10}, {'q': u'手机'}), 10)
+        self.assertEqual(self.cache.get_ttl({'result_cache_ttl': 0}), 0)
+        # 自定义查询体不缓存
+        self.assertEqual(self.cache.get_ttl({}, {'ex_body_type': 'scroll'}), 0)
+        self.cache.enable = False
+        self.assertEqual(self.cache.get_ttl({'result_cache_ttl': 10}), 0)
+
+        self.query(ttl=0)
+        self.query(ttl=0)
+        self.query(admin_id=None)
+        self.assertEqual(len(self.call_list), 3)
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
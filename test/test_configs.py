@@ -0,0 +1,36 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.configs import Config
+
+__author__ = 'liuzhaoming'
+
+
+class TestConfigValueCache(unittest.TestCase):
+    def setUp(self):
+        self.config = Config()
+        self.config.set_config({'default': {'consts': {'query': {'scroll_time': '1m'}}},
+                                'a1': {'consts': {'query': {'scroll_time': '5m'}}}})
+
+    def test_get_value(self):
+        self.assertEqual(self.config.get_value('/consts/query/scroll_time'), '1m')
+        self.assertEqual(self.config.get_value('consts/query/scroll_time', 'a1'), '5m')
+        self.assertIsNone(self.config.get_value('/consts/query/not_exist'))
+
+    def test_invalidate_on_swap(self):
+        accessor = self.config.get_accessor('/consts/query/scroll_time')
+        self.assertEqual(accessor.get(), '1m')
+        self.config.update_value('consts/query/scroll_time', '2m')
+        self.assertEqual(accessor.get(), '2m')
+        self.assertEqual(self.config.get_value('/consts/query/scroll_time'), '2m')
+        self.config.set_config({'default': {'consts': {}}})
+        self.assertIsNone(self.config.get_value('/consts/query/scroll_time'))
+        self.assertEqual(accessor.get('3m'), '3m')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from django.http import QueryDict
+
+from common.utils import deep_merge, deep_merge_all
+from service.ex_dsl_parser import extend_parser
+
+__author__ = 'liuzhaoming'
+
+
+class TestExtendQdslParser(unittest.TestCase):
+    def test_deep_merge_all(self):
+        dict_list = [{'query': {'bool': {'must': [{'term': {'a': 1}}]}}},
+                     {},
+                     {'query': {'bool': {'must': [{'term': {'b': 2}}]}}, 'size': 10},
+                     {'highlight': {'fields': {}}},
+                     {'query': {'bool': {'must': [{'term': {'c': 3}}], 'should': []}}, 'size': 20}]
+        self.assertEqual(deep_merge_all(dict_list), reduce(deep_merge, dict_list))
+        # 输入的字典不能被修改
+        self.assertEqual(dict_list[0], {'query': {'bool': {'must': [{'term': {'a': 1}}]}}})
+
+    def test_fragment_cache(self):
+        es_config = {'destination_type': 'elasticsearch7'}
+        query_params = QueryDict('ex_q_brand=terms(str:apple,str:xiaomi)&ex_agg_brand=terms(size:10)')
+        extend_parser.fragment_cache.clear()
+        first_qdsl = extend_parser.get_qdsl(query_params, es_config)
+        hits = extend_parser.fragment_cache.hits
+        second_qdsl = extend_parser.get_qdsl(query_params, es_config)
+        self.assertEqual(first_qdsl, second_qdsl)
+        self.assertGreater(extend_parser.fragment_cache.hits, hits)
+        self.assertEqual(extend_parser.get_agg_qdsl(query_params, es_config),
+                         extend_parser.get_agg_qdsl(query_params, es_config))
+
+
+if __name__ == '__main__':
+    unittest.main()
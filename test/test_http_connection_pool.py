@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import errno
+import socket
+import unittest
+
+import urllib3
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.connections import HttpConnectionPool
+from common.exceptions import MsgHandlingFailError
+from river import source
+from river.source import HttpDataSource
+
+__author__ = 'liuzhaoming'
+
+HOST = '127.0.0.1:8080'
+
+
+class FakeResponse(object):
+    def __init__(self, status):
+        self.status = status
+        self.data = '{"root": []}'
+
+
+class FakeHttpPool(object):
+    """
+    按照顺序返回响应状态码或者抛出异常
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.methods = []
+        self.num_connections = 1
+        self.num_requests = 0
+        self.pool = None
+
+    def urlopen(self, method, url, **kwargs):
+        self.methods.append(method)
+        self.num_requests += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+class TestHttpConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.http_pool = HttpConnectionPool()
+
+    def request(self, method, outcomes, retries=2):
+        fake_pool = self.http_pool.http_pool_dict[HOST] = FakeHttpPool(outcomes)
+        try:
+            return self.http_pool.request(HOST, method, '/api', retries=retries, retry_backoff=0)
+        finally:
+            self.assertEqual(fake_pool.outcomes, [])
+
+    def test_retry_statuses(self):
+        self.assertEqual(self.request('POST', [503, 502, 200]), '{"root": []}')
+        self.assertEqual(self.http_pool.stats()['retry_count'], 2)
+        self.assertRaises(urllib3.exceptions.HTTPError, self.request, 'POST', [504, 504, 504])
+        self.assertEqual(self.http_pool.stats()['fail_count'], 1)
+
+    def test_post_not_retried_after_sent(self):
+        # POST读取超时时服务端可能已经执行，不能重试
+        self.assertRaises(urllib3.exceptions.ReadTimeoutError, self.request, 'POST',
+                          [urllib3.exceptions.ReadTimeoutError(None, '/api', 'Read timed out.')])
+        self.assertRaises(urllib3.exceptions.ProtocolError, self.request, 'POST',
+                          [urllib3.exceptions.ProtocolError('Connection aborted.')])
+        self.assertEqual(self.http_pool.stats()['retry_count'], 0)
+        self.assertEqual(self.http_pool.stats()['fail_count'], 2)
+        # 幂等请求读取超时后重试
+        self.assertEqual(self.request('GET', [urllib3.exceptions.ReadTimeoutError(None, '/api', 'Read timed out.'),
+                                              200]), '{"root": []}')
+
+    def test_post_retried_before_sent(self):
+        # urllib3 1.10建立连接失败时抛出包装socket.error的ProtocolError
+        self.assertEqual(self.request('POST', [
+            urllib3.exceptions.ProtocolError('Connection aborted.', socket.error(errno.ECONNREFUSED, 'refused')),
+            urllib3.exceptions.ProtocolError('Connection aborted.', socket.gaierror(-2, 'Name or service not known')),
+            urllib3.exceptions.ConnectTimeoutError('Connect timed out.'),
+            urllib3.exceptions.EmptyPoolError(None, 'Pool reached maximum size'), 200], retries=4), '{"root": []}')
+        self.assertEqual(self.http_pool.stats()['retry_count'], 4)
+        self.assertRaises(urllib3.exceptions.ProtocolError, self.request, 'POST', [
+            urllib3.exceptions.ProtocolError('Connection aborted.', socket.error(errno.ECONNRESET, 'reset'))])
+
+    def test_post_retried_on_refused_connection(self):
+        # 使用安装的urllib3版本连接没有监听的端口，连接被拒绝时请求没有发送，POST也可以重试
+        listen_socket = socket.socket()
+        listen_socket.bind(('127.0.0.1', 0))
+        host = '127.0.0.1:{0}'.format(listen_socket.getsockname()[1])
+        listen_socket.close()
+        self.assertRaises(urllib3.exceptions.HTTPError, self.http_pool.request, host, 'POST', '/api', 'a=1',
+                          connect_timeout=1, read_timeout=1, retries=1, retry_backoff=0)
+        self.assertEqual((self.http_pool.stats()['retry_count'], self.http_pool.stats()['fail_count']), (1, 1))
+
+    def test_pool_stats(self):
+        self.http_pool.get_http_pool('127.0.0.1:9200', maxsize=3)
+        self.assertIs(self.http_pool.get_http_pool('127.0.0.1:9200', maxsize=5),
+                      self.http_pool.http_pool_dict['127.0.0.1:9200'])
+        self.request('GET', [200])
+        stats = self.http_pool.stats()
+        self.assertEqual(stats['pools']['127.0.0.1:9200'],
+                         {'num_connections': 0, 'num_requests': 0, 'idle_connections': 3, 'maxsize': 3})
+        self.assertEqual(stats['pools'][HOST]['num_requests'], 1)
+        self.assertEqual((stats['retry_count'], stats['fail_count']), (0, 0))
+
+
+class FailHttpConnectionPool(object):
+    def request(self, *args, **kwargs):
+        raise urllib3.exceptions.HTTPError('HTTP status 503')
+
+
+class TestHttpDataSource(unittest.TestCase):
+    def setUp(self):
+        self.origin_factory = source.HttpConnectionFactory
+
+    def tearDown(self):
+        source.HttpConnectionFactory = self.origin_factory
+
+    def test_retry_fail_to_msg_handling_error(self):
+        # 重试失败后转换为MsgHandlingFailError，消息进入重做流程
+        source.HttpConnectionFactory = FailHttpConnectionPool()
+        with self.assertRaises(MsgHandlingFailError) as context:
+            HttpDataSource().call_http_method(HOST, '/api', 'product.get', {'skuId': '1'}, 1)
+        self.assertEqual(context.exception.source, MsgHandlingFailError.HTTP_ERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# coding=utf-8
+import logging
+import threading
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.loggers import AppLog, AsyncLogWriter
+
+__author__ = 'liuzhaoming'
+
+
+class TestAppLog(unittest.TestCase):
+    def setUp(self):
+        self.app_log = AppLog('test')
+        self.app_log.max_length = 50
+
+    def test_limit_payload(self):
+        payload = self.app_log.limit_payload({'root': range(1000)})
+        self.assertTrue(payload.startswith("{'root': [0, 1, 2"))
+        self.assertTrue(payload.endswith('chars omitted)'))
+        self.assertEqual(self.app_log.limit_payload('short'), 'short')
+        self.assertEqual(self.app_log.limit_payload(10), 10)
+
+    def test_format_message(self):
+        message = self.app_log.format_message('result is {0}', ('x' * 100,), 2)
+        self.assertIn('result is ' + 'x' * 40, message)
+        self.assertIn('chars omitted', message)
+
+    def test_error_not_sampled(self):
+        self.app_log.ensure_config()
+        self.app_log.int_log_level = logging.NOTSET
+        self.app_log.sample_rate = 0
+        self.assertFalse(self.app_log.is_enabled_for(logging.WARNING, True))
+        self.assertTrue(self.app_log.is_enabled_for(logging.ERROR, True))
+
+
+class TestBaseLogInit(unittest.TestCase):
+    def setUp(self):
+        from common import msg_bus
+
+        self.msg_bus = msg_bus
+        self.origin_app_log = msg_bus.app_log
+
+    def tearDown(self):
+        self.msg_bus.app_log = self.origin_app_log
+
+    def test_init_with_message_bus(self):
+        from common.msg_bus import message_bus, Event
+
+        # 注册日志级别监听器时消息总线使用同一个未初始化的日志记录器打印日志
+        fresh_log = AppLog('test_init')
+        self.msg_bus.app_log = fresh_log
+        fresh_log.info('init {0}', 'fresh log')
+        self.assertTrue(message_bus.event_dispatcher.has_listener(Event.TYPE_UPDATE_LOG_LEVEL,
+                                                                fresh_log.update_log_level))
+        fresh_log.warning('init {0}', 'again')
+
+class BlockingHandler(logging.Handler):
+    """
+    记录写入的日志，released之前阻塞写入非ERROR级别的日志
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.released = threading.Event()
+
+    def handle(self, record):
+        # 在获取handler锁之前阻塞，和写入慢的文件一样不影响其它线程直接写入
+        if record.levelno < logging.ERROR:
+            self.released.wait()
+        return logging.Handler.handle(self, record)
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestAsyncLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.handler = BlockingHandler()
+        self.logger = logging.getLogger('test_async_writer')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.handlers = [self.handler]
+        self.writer = AsyncLogWriter()
+        self.writer.install(['test_async_writer'], 2)
+
+    def tearDown(self):
+        self.handler.released.set()
+        self.logger.handlers = []
+
+    def test_error_bypass_full_queue(self):
+        for index in xrange(5):
+            self.logger.info('info %s', index)
+        self.assertTrue(self.writer.stats()['dropped'] > 0)
+        # 队列已满时错误日志仍然直接写入
+        self.logger.error('error %s', 1)
+        self.assertEqual(self.handler.messages, ['error 1'])
+
+    def test_flush_bounded(self):
+        self.logger.info('info %s', 1)
+        # 写入线程阻塞时最多等待timeout
+        self.assertFalse(self.writer.flush(0.05))
+        self.handler.released.set()
+        self.assertTrue(self.writer.flush(1))
+        self.assertEqual(self.handler.messages, ['info 1'])
+        self.assertTrue(self.writer.flush(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# coding=utf-8
+import time
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.msg_coalescers import MsgCoalescer
+
+__author__ = 'liuzhaoming'
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.hash_dict = {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def hincrby(self, key, field, amount=1):
+        field_dict = self.hash_dict.setdefault(key, {})
+        field_dict[field] = field_dict.get(field, 0) + amount
+
+    def hgetall(self, key):
+        return self.hash_dict.get(key, {})
+
+    def execute(self):
+        pass
+
+
+def build_msg(text, key=None, is_delete=False, river_key='river', identical=False):
+    msg = {'type': 'pyactivemq.TextMessage', 'text': text, 'river_key': river_key, 'adminId': 'a1'}
+    if identical:
+        msg['coalesce_identical'] = True
+    if key is not None:
+        msg['coalesce_key'] = key
+    if is_delete:
+        msg['coalesce_delete'] = True
+    return msg
+
+
+class TestMsgCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = MsgCoalescer(FakeRedis())
+        self.coalescer.enable = True
+        self.coalescer.window = 0.05
+        self.coalescer.max_msgs = 1000
+
+    def test_keep_latest(self):
+        msgs = [build_msg('stock', 'sku1'), build_msg('price', 'sku1'), build_msg('stock', 'sku2'),
+                build_msg('other', 'sku1')]
+        coalesced_msgs, dropped_msgs = self.coalescer.coalesce_msgs(msgs)
+        self.assertEqual([msg['text'] for msg in coalesced_msgs], ['stock', 'other'])
+        self.assertEqual(len(dropped_msgs), 2)
+
+    def test_delete_barrier(self):
+        msgs = [build_msg('u1', 'sku1'), build_msg('u2', 'sku1'), build_msg('d', 'sku1', True),
+                build_msg('u3', 'sku1'), build_msg('u4', 'sku1')]
+        coalesced_msgs, _ = self.coalescer.coalesce_msgs(msgs)
+        self.assertEqual([msg['text'] for msg in coalesced_msgs], ['u2', 'd', 'u4'])
+
+    def test_identical_and_river_key(self):
+        msgs = [build_msg('same', identical=True), build_msg('same', river_key='other', identical=True),
+                build_msg('diff', identical=True), build_msg('same', identical=True)]
+        coalesced_msgs, _ = self.coalescer.coalesce_msgs(msgs)
+        self.assertEqual([(msg['river_key'], msg['text']) for msg in coalesced_msgs],
+                         [('other', 'same'), ('river', 'diff'), ('river', 'same')])
+
+    def test_window(self):
+        self.assertEqual(self.coalescer.coalesce([('a1', 'l1', [build_msg('u1', 'sku1')])], 'vip'), [])
+        self.assertEqual(self.coalescer.coalesce([('a1', 'l2', [build_msg('u2', 'sku1')])], 'vip'), [])
+        time.sleep(0.06)
+        result = self.coalescer.coalesce([], 'vip')
+        self.assertEqual(len(result), 1)
+        admin_id, lease_ids, msgs = result[0]
+        self.assertEqual(lease_ids, ['l1', 'l2'])
+        self.assertEqual([msg['text'] for msg in msgs], ['u2'])
+        self.assertEqual(self.coalescer.stats()['river'],
+                         {'received': 2, 'coalesced': 1, 'dispatched': 1, 'coalesced_ratio': 0.5})
+
+    def test_identical_opt_in(self):
+        # 数据流没有开启sla/coalesce/identical时内容相同的消息不合并
+        msgs = [build_msg('same'), build_msg('same'), build_msg('same', river_key='other', identical=True),
+                build_msg('same', river_key='other', identical=True)]
+        coalesced_msgs, dropped_msgs = self.coalescer.coalesce_msgs(msgs)
+        self.assertEqual(coalesced_msgs, msgs[:2] + msgs[3:])
+        self.assertEqual(dropped_msgs, msgs[2:3])
+
+    def test_disable(self):
+        self.coalescer.enable = False
+        msgs = [build_msg('same'), build_msg('same')]
+        self.assertEqual(self.coalescer.coalesce([('a1', 'l1', msgs)], 'vip'), [('a1', ['l1'], msgs)])
+
+
+if __name__ == '__main__':
+    unittest.main()
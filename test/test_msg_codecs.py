@@ -0,0 +1,53 @@
+# coding=utf-8
+import unittest
+import ujson as json
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.msg_codecs import MsgCodec
+
+__author__ = 'liuzhaoming'
+
+
+def build_msg(text_size=10):
+    return {'type': 'pyactivemq.TextMessage', 'river_key': 'river', 'adminId': u'a1', 'redo': True,
+            'coalesce_key': u'sku1', 'text': json.dumps({'adminId': 'a1', 'sku': 'sku1', 'name': u'商品' * text_size})}
+
+
+class TestMsgCodec(unittest.TestCase):
+    def setUp(self):
+        self.codec = MsgCodec()
+        self.codec.compress_threshold = 1024
+        self.codec.use_codec('msgpack')
+
+    def test_round_trip(self):
+        msg = build_msg()
+        data = self.codec.encode(msg)
+        self.assertEqual(data[0], '\x01')
+        self.assertEqual(self.codec.decode(data), msg)
+
+    def test_compress_large_msg(self):
+        msg = build_msg(1000)
+        data = self.codec.encode(msg)
+        self.assertEqual(data[0], '\x02')
+        self.assertLess(len(data), len(json.dumps(msg)))
+        self.assertEqual(self.codec.decode(data), msg)
+
+    def test_default_json_writer(self):
+        # 默认写入旧版本进程也能解码的JSON格式
+        codec = MsgCodec()
+        msg = build_msg(1000)
+        data = codec.encode(msg)
+        self.assertEqual(json.loads(data), msg)
+        self.assertEqual(self.codec.decode(data), msg)
+        self.assertEqual(codec.decode(self.codec.encode(msg)), msg)
+
+    def test_decode_legacy_json(self):
+        msg = build_msg()
+        self.assertEqual(self.codec.decode(json.dumps(msg)), msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
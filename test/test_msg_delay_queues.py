@@ -0,0 +1,45 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.connections import RedisConnectionFactory
+from common.msg_delay_queues import RedisDelayQueue
+from search_platform.settings import SERVICE_BASE_CONFIG
+
+__author__ = 'liuzhaoming'
+
+
+class TestRedisDelayQueue(unittest.TestCase):
+    def setUp(self):
+        self.redis_conn = RedisConnectionFactory.get_redis_connection(SERVICE_BASE_CONFIG.get('msg_queue'))
+        self.delay_queue = RedisDelayQueue(self.redis_conn, 'sp_test_delay_queue_{0}', 'sp_test_delay_admin_{0}',
+                                           lease_timeout=30)
+
+    def tearDown(self):
+        self.redis_conn.delete('sp_test_delay_admin_vip', *[self.delay_queue.get_queue_key(admin_id) for admin_id in
+                                                            ('a1', 'a2')])
+
+    def test_claim_due_only(self):
+        self.delay_queue.schedule('a1', 'vip', [(100, 'm1'), (200, 'm2'), (300, 'm3')])
+        self.delay_queue.schedule('a2', 'vip', [(500, 'm4')])
+        self.assertEqual(self.delay_queue.claim('vip', 10, cur_time=250), [('a1', ['m1', 'm2'])])
+        # 领取的消息在租约到期前不会被再次领取
+        self.assertEqual(self.delay_queue.claim('vip', 10, cur_time=260), [])
+        self.assertEqual(self.delay_queue.next_due_time('vip'), 280)
+        self.assertEqual(self.delay_queue.claim('vip', 10, cur_time=290), [('a1', ['m1', 'm2'])])
+
+    def test_ack_and_reschedule(self):
+        self.delay_queue.schedule('a1', 'vip', [(100, 'm1'), (100, 'm2')])
+        self.assertEqual(self.delay_queue.claim('vip', 1, cur_time=100), [('a1', ['m1'])])
+        self.assertEqual(self.delay_queue.schedule('a1', 'vip', [(400, 'm1-retry')], ['m1']), 2)
+        self.assertEqual(self.delay_queue.ack('a1', 'vip', ['m2']), 1)
+        self.assertEqual(self.delay_queue.next_due_time('vip'), 400)
+        self.delay_queue.ack('a1', 'vip', ['m1-retry'])
+        self.assertIsNone(self.delay_queue.next_due_time('vip'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.connections import RedisConnectionFactory
+from common.msg_lanes import MsgLanes
+from river import msg_qos
+from search_platform.settings import SERVICE_BASE_CONFIG
+
+__author__ = 'liuzhaoming'
+
+
+class StopHandling(Exception):
+    pass
+
+
+class IdleMsgSla(object):
+    """
+    队列一直为空，等待消息时结束处理循环
+    """
+
+    def process_msg(self, handler, is_vip):
+        return False
+
+    def wait_msg_ready(self, is_vip):
+        raise StopHandling()
+
+
+class FakeLaneTask(object):
+    def __init__(self):
+        self.lane_token_list = []
+
+    def delay(self, lane, owner_token):
+        self.lane_token_list.append((lane, owner_token))
+
+
+class TestMsgLanes(unittest.TestCase):
+    def setUp(self):
+        self.redis_conn = RedisConnectionFactory.get_redis_connection(SERVICE_BASE_CONFIG.get('msg_queue'))
+        self.msg_lanes = MsgLanes({'default': self.redis_conn})
+        self.msg_lanes.lane_count = 8
+        self.msg_lanes.batch_size = 2
+        self.msg_lanes.lane_key = 'sp_test_msg_lane_{0}'
+        self.msg_lanes.owner_key = 'sp_test_msg_lane_owner_{0}'
+
+    def tearDown(self):
+        for lane in xrange(self.msg_lanes.lane_count):
+            self.redis_conn.delete(self.msg_lanes.lane_key.format(lane), self.msg_lanes.owner_key.format(lane))
+
+    @staticmethod
+    def build_msg(doc_key, version):
+        return {'river_key': 'product_river', 'adminId': 'A1', 'coalesce_key': doc_key,
+                'text': '{0}-{1}'.format(doc_key, version)}
+
+    def test_same_doc_same_lane(self):
+        lanes = set(self.msg_lanes.get_lane(self.build_msg('S{0}'.format(index % 50), index)) for index in xrange(500))
+        self.assertTrue(len(lanes) > 4)
+        self.assertEqual(len(set(self.msg_lanes.get_lane(self.build_msg('S1', index)) for index in xrange(10))), 1)
+
+    def test_keyless_msgs_spread(self):
+        # 没有文档key的消息之间没有顺序要求，不能集中到同一个通道
+        lanes = set(self.msg_lanes.get_lane(self.build_msg(None, index)) for index in xrange(100))
+        self.assertTrue(len(lanes) > 4)
+
+    def test_refresh_checks_owner(self):
+        msg = self.build_msg('S3', 1)
+        lane = self.msg_lanes.get_lane(msg)
+        (_, owner_token), = self.msg_lanes.push([msg])
+        self.assertTrue(self.msg_lanes.refresh(lane, owner_token))
+        self.assertFalse(self.msg_lanes.refresh(lane, 'invalid token'))
+
+    def test_single_owner_keeps_order(self):
+        msg = self.build_msg('S1', 1)
+        lane = self.msg_lanes.get_lane(msg)
+        owner_list = self.msg_lanes.push([msg, self.build_msg('S1', 2)])
+        self.assertEqual([owner_lane for owner_lane, _ in owner_list], [lane])
+        # 通道已经有处理任务时写入消息不再启动新的任务
+        self.assertEqual(self.msg_lanes.push([self.build_msg('S1', 3)]), [])
+        self.assertEqual(self.msg_lanes.next_batch(lane, 'invalid token'), (0, []))
+
+        owner_token = owner_list[0][1]
+        texts = []
+        processed_count, msgs = self.msg_lanes.next_batch(lane, owner_token)
+        while processed_count:
+            texts.extend(msg['text'] for msg in msgs)
+            processed_count, msgs = self.msg_lanes.next_batch(lane, owner_token, processed_count)
+        self.assertEqual(texts, ['S1-1', 'S1-2', 'S1-3'])
+
+        # 通道为空时令牌已经释放，再次写入消息启动新的任务
+        self.assertEqual([owner_lane for owner_lane, _ in self.msg_lanes.push([self.build_msg('S1', 4)])], [lane])
+
+    def test_revive_and_stats(self):
+        msg = self.build_msg('S2', 1)
+        lane = self.msg_lanes.get_lane(msg)
+        self.msg_lanes.push([msg])
+        self.assertEqual(self.msg_lanes.revive(force=True), [])
+        self.redis_conn.delete(self.msg_lanes.owner_key.format(lane))
+        self.assertEqual([owner_lane for owner_lane, _ in self.msg_lanes.revive(force=True)], [lane])
+
+        stats = self.msg_lanes.stats()
+        self.assertEqual((stats['total_depth'], stats['busy_lanes']), (1, 1))
+        self.assertEqual(stats['lanes'][0]['lane'], lane)
+        self.assertTrue(stats['lanes'][0]['lag_seconds'] >= 0)
+
+    def test_revive_when_idle(self):
+        msg = self.build_msg('S3', 1)
+        lane = self.msg_lanes.get_lane(msg)
+        self.msg_lanes.push([msg])
+        self.redis_conn.delete(self.msg_lanes.owner_key.format(lane))
+        self.msg_lanes.enable = True
+        self.msg_lanes.revive_interval = 0
+        lane_task = FakeLaneTask()
+        origin_attrs = msg_qos.msg_lanes, msg_qos.msg_sla, msg_qos.process_message_lane
+        msg_qos.msg_lanes, msg_qos.msg_sla, msg_qos.process_message_lane = self.msg_lanes, IdleMsgSla(), lane_task
+        try:
+            # 没有新消息时也要恢复丢失令牌的通道
+            self.assertRaises(StopHandling, msg_qos.MsgQos()._handle_msg, True)
+        finally:
+            msg_qos.msg_lanes, msg_qos.msg_sla, msg_qos.process_message_lane = origin_attrs
+        self.assertEqual([owner_lane for owner_lane, _ in lane_task.lane_token_list], [lane])
+
+
+if __name__ == '__main__':
+    unittest.main()
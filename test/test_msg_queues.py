@@ -0,0 +1,84 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.connections import RedisConnectionFactory
+from common.msg_queues import RedisMsgQueue
+from search_platform.settings import SERVICE_BASE_CONFIG
+
+__author__ = 'liuzhaoming'
+
+
+class TestRedisMsgQueue(unittest.TestCase):
+    def setUp(self):
+        self.redis_conn = RedisConnectionFactory.get_redis_connection(SERVICE_BASE_CONFIG.get('msg_queue'))
+        self.msg_queue = RedisMsgQueue(self.redis_conn, 'sp_test_msg_queue_{0}', 'sp_test_msg_admin_queue',
+                                       'sp_test_msg_lease')
+
+    def tearDown(self):
+        self.redis_conn.delete(self.msg_queue.get_queue_key('A1'), self.msg_queue.get_queue_key('A2'),
+                               self.msg_queue.admin_set_key, self.msg_queue.lease_zset_key,
+                               self.msg_queue.lease_hash_key)
+
+    def get_queue(self, admin_id):
+        return self.redis_conn.lrange(self.msg_queue.get_queue_key(admin_id), 0, -1)
+
+    def test_pop_and_ack(self):
+        self.msg_queue.push([('A1', ['m1', 'm2', 'm3']), ('A2', ['n1'])])
+        self.assertEqual(sorted(self.msg_queue.query_admin_ids()), ['A1', 'A2'])
+        (admin_id, lease_id, msgs), (_, empty_lease_id, empty_msgs) = self.msg_queue.pop([('A1', 2), ('A3', 1)])
+        self.assertEqual((admin_id, msgs), ('A1', ['m1', 'm2']))
+        self.assertEqual((empty_lease_id, empty_msgs), (None, []))
+        self.assertEqual(self.msg_queue.sizes(['A1', 'A2']), [1, 1])
+
+        # 队列为空时从用户集合中删除
+        (_, last_lease_id, last_msgs), = self.msg_queue.pop([('A1', 5)])
+        self.assertEqual(last_msgs, ['m3'])
+        self.assertEqual(self.msg_queue.query_admin_ids(), ['A2'])
+        self.assertEqual(self.redis_conn.zcard(self.msg_queue.lease_zset_key), 2)
+
+        self.msg_queue.ack(lease_id, last_lease_id)
+        self.assertEqual(self.redis_conn.zcard(self.msg_queue.lease_zset_key), 0)
+        self.assertEqual(self.redis_conn.hlen(self.msg_queue.lease_hash_key), 0)
+        # 已经确认的租约不能重新入队
+        self.assertEqual(self.msg_queue.requeue(lease_id), 0)
+        self.assertEqual(self.get_queue('A1'), [])
+
+    def test_requeue_keeps_order(self):
+        self.msg_queue.push([('A1', ['m1', 'm2', 'm3', 'm4'])])
+        (_, first_lease_id, _), = self.msg_queue.pop([('A1', 2)])
+        (_, second_lease_id, _), = self.msg_queue.pop([('A1', 2)])
+        self.assertEqual(self.msg_queue.query_admin_ids(), [])
+        self.msg_queue.push([('A1', ['m5'])])
+
+        # 后出队的租约先放回，消息恢复原有顺序，放回的消息在新消息之前
+        self.assertEqual(self.msg_queue.requeue(second_lease_id, first_lease_id), 2)
+        self.assertEqual(self.get_queue('A1'), ['m1', 'm2', 'm3', 'm4', 'm5'])
+        self.assertEqual(self.msg_queue.query_admin_ids(), ['A1'])
+        self.assertEqual(self.redis_conn.zcard(self.msg_queue.lease_zset_key), 0)
+        self.assertEqual(self.msg_queue.requeue(first_lease_id), 0)
+
+    def test_reclaim_expired_leases(self):
+        self.msg_queue.push([('A1', ['m1', 'm2', 'm3'])])
+        (_, valid_lease_id, _), = self.msg_queue.pop([('A1', 1)])
+        self.msg_queue.lease_timeout = -1
+        (_, expired_lease_id, _), = self.msg_queue.pop([('A1', 2)])
+        self.assertEqual(self.msg_queue.query_admin_ids(), [])
+
+        self.assertEqual(self.msg_queue.reclaim_expired_leases(force=True), 1)
+        self.assertEqual(self.get_queue('A1'), ['m2', 'm3'])
+        self.assertEqual(self.msg_queue.query_admin_ids(), ['A1'])
+        self.assertEqual(self.redis_conn.zrange(self.msg_queue.lease_zset_key, 0, -1), [valid_lease_id])
+        # 回收后的租约确认无效，没有过期的租约不回收
+        self.msg_queue.ack(expired_lease_id)
+        self.assertEqual(self.get_queue('A1'), ['m2', 'm3'])
+        self.assertEqual(self.msg_queue.reclaim_expired_leases(force=True), 0)
+        # 未到回收间隔时不回收
+        self.assertEqual(self.msg_queue.reclaim_expired_leases(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
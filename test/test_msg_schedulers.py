@@ -0,0 +1,49 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.msg_schedulers import LocalTokenBucket, MsgScheduler, simulate_msg_schedule
+
+__author__ = 'liuzhaoming'
+
+
+class TestLocalTokenBucket(unittest.TestCase):
+    def test_acquire_and_refill(self):
+        bucket = LocalTokenBucket()
+        self.assertEqual(bucket.acquire([('a1', 8, 10, 10)], 0), [8])
+        self.assertEqual(bucket.acquire([('a1', 8, 10, 10)], 0), [2])
+        self.assertEqual(bucket.acquire([('a1', 8, 10, 10)], 0.5), [5])
+        bucket.refund([('a1', 3)])
+        self.assertEqual(bucket.acquire([('a1', 8, 10, 10)], 0.5), [3])
+
+
+class TestMsgScheduler(unittest.TestCase):
+    def test_round_budget_rotation(self):
+        scheduler = MsgScheduler(LocalTokenBucket())
+        quota_list = [(admin_id, 10, 1, 1000, 1000) for admin_id in ('a1', 'a2', 'a3')]
+        first_round = scheduler.plan('vip', quota_list, 20, 0)
+        self.assertEqual(first_round, [('a1', 10), ('a2', 10)])
+        scheduler.complete('vip', [(admin_id, size, size) for admin_id, size in first_round])
+        self.assertEqual(scheduler.plan('vip', quota_list, 20, 0), [('a3', 10), ('a1', 10)])
+
+    def test_weight_share(self):
+        result = simulate_msg_schedule({'heavy': {'backlog': 100000, 'quantum': 10, 'weight': 1, 'rate': 100000,
+                                                  'capacity': 100000},
+                                        'light': {'backlog': 100000, 'quantum': 10, 'weight': 0.5, 'rate': 100000,
+                                                  'capacity': 100000}}, rounds=100, round_budget=12)
+        self.assertAlmostEqual(result['heavy']['share'], 2.0 / 3, delta=0.05)
+        self.assertEqual(result['heavy']['served'] + result['light']['served'], 1200)
+
+    def test_rate_limit(self):
+        result = simulate_msg_schedule({'limited': {'backlog': 1000, 'quantum': 50, 'rate': 10, 'capacity': 10},
+                                        'other': {'arrival': 5, 'quantum': 50, 'rate': 1000, 'capacity': 1000}},
+                                       rounds=100, round_interval=0.1)
+        self.assertLessEqual(result['limited']['served'], 10 + 10 * 10)
+        self.assertEqual(result['other']['backlog'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.msg_delay_queues import InMemoryDelayQueue
+from common.msg_queues import InMemoryMsgQueue
+from common.msg_shards import ConsistentHashRing, ShardedMsgQueue, ShardedDelayQueue
+
+__author__ = 'liuzhaoming'
+
+ADMIN_IDS = ['A{0}'.format(index) for index in xrange(1000)]
+
+
+class TestConsistentHashRing(unittest.TestCase):
+    def test_add_node_moves_keys_to_new_node_only(self):
+        ring = ConsistentHashRing(['s1', 's2', 's3'])
+        old_node_dict = dict((admin_id, ring.get_node(admin_id)) for admin_id in ADMIN_IDS)
+        self.assertTrue(all(200 < old_node_dict.values().count(node) < 470 for node in ('s1', 's2', 's3')))
+
+        ring.add_node('s4')
+        moved_admin_ids = [admin_id for admin_id in ADMIN_IDS if ring.get_node(admin_id) != old_node_dict[admin_id]]
+        self.assertTrue(all(ring.get_node(admin_id) == 's4' for admin_id in moved_admin_ids))
+        self.assertTrue(150 < len(moved_admin_ids) < 350)
+
+
+class TestShardedMsgQueue(unittest.TestCase):
+    def setUp(self):
+        self.shard_queue_dict = {'s1': InMemoryMsgQueue(), 's2': InMemoryMsgQueue()}
+        self.queue = ShardedMsgQueue(self.shard_queue_dict)
+
+    def test_push_pop_across_shards(self):
+        self.queue.push([(admin_id, ['m1', 'm2']) for admin_id in ADMIN_IDS[:20]])
+        self.assertTrue(all(shard_queue.queue_dict for shard_queue in self.shard_queue_dict.itervalues()))
+        self.assertEqual(sorted(self.queue.query_admin_ids()), sorted(ADMIN_IDS[:20]))
+
+        pop_result_list = self.queue.pop([(admin_id, 1) for admin_id in ADMIN_IDS[:20]])
+        self.assertEqual([(admin_id, str_msgs) for admin_id, _, str_msgs in pop_result_list],
+                         [(admin_id, ['m1']) for admin_id in ADMIN_IDS[:20]])
+        self.assertEqual(self.queue.requeue(*[lease_id for _, lease_id, _ in pop_result_list[:5]]), 5)
+        self.queue.ack(*[lease_id for _, lease_id, _ in pop_result_list[5:]])
+        self.assertEqual(self.queue.sizes(ADMIN_IDS[:6]), [2] * 5 + [1])
+        self.assertFalse(any(shard_queue.lease_dict for shard_queue in self.shard_queue_dict.itervalues()))
+
+    def test_add_shard_keeps_order(self):
+        self.queue.push([(admin_id, ['old1', 'old2']) for admin_id in ADMIN_IDS[:100]])
+        self.shard_queue_dict['s3'] = InMemoryMsgQueue()
+        new_queue = ShardedMsgQueue(self.shard_queue_dict)
+        moved_admin_id = next(admin_id for admin_id in ADMIN_IDS[:100] if new_queue.get_shard(admin_id) == 's3')
+        new_queue.push([(moved_admin_id, ['new1'])])
+
+        popped_msgs = []
+        for _ in xrange(3):
+            new_queue.query_admin_ids()
+            for _, lease_id, str_msgs in new_queue.pop([(moved_admin_id, 2)]):
+                popped_msgs.extend(str_msgs)
+                new_queue.ack(lease_id)
+        self.assertEqual(popped_msgs, ['old1', 'old2', 'new1'])
+        self.assertEqual(new_queue.shard_stats()['s3']['admins'], 0)
+
+
+class TestShardedDelayQueue(unittest.TestCase):
+    def test_claim_moves_stray_msgs_to_owner(self):
+        shard_queue_dict = {'s1': InMemoryDelayQueue(30), 's2': InMemoryDelayQueue(30)}
+        old_delay_queue = ShardedDelayQueue(shard_queue_dict)
+        shard_queue_dict['s3'] = InMemoryDelayQueue(30)
+        delay_queue = ShardedDelayQueue(shard_queue_dict)
+        moved_admin_id = next(admin_id for admin_id in ADMIN_IDS if delay_queue.ring.get_node(admin_id) == 's3')
+        old_delay_queue.schedule(moved_admin_id, 'vip', [(100, 'm1')])
+
+        self.assertEqual(delay_queue.claim('vip', 10, cur_time=200), [(moved_admin_id, ['m1'])])
+        self.assertEqual(shard_queue_dict['s3'].size(moved_admin_id), 1)
+        self.assertEqual(delay_queue.size(moved_admin_id), 1)
+        self.assertEqual(delay_queue.next_due_time('vip'), 230)
+        delay_queue.ack(moved_admin_id, 'vip', ['m1'])
+        self.assertEqual(delay_queue.size(moved_admin_id), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import unittest
+from itertools import product
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.pingyin_utils import PinyinTools
+
+__author__ = 'liuzhaoming'
+
+
+def old_combine_element(input_list, start=0, separator=' '):
+    """
+    原有的递归实现，一次生成所有组合
+    """
+    if start == len(input_list) - 1:
+        return input_list[start]
+    return [separator.join(element) for element in
+            product(input_list[start], old_combine_element(input_list, start + 1, separator))]
+
+
+class TestPinyinTools(unittest.TestCase):
+    def setUp(self):
+        self.pinyin_tools = PinyinTools()
+        self.pinyin_tools.max_combination = 512
+
+    def test_combine_same_as_old_below_cap(self):
+        for input_list in ([('zhong', 'chong')], [('shui',), ('guo',)],
+                           [('zhong', 'chong'), ('xing', 'hang', 'heng'), ('le', 'yue'), ('a',)],
+                           [('s', 'sh'), ('g',), ('x', 'h')]):
+            for separator in (' ', ''):
+                self.assertEqual(list(self.pinyin_tools.combine_element(input_list, separator)),
+                                 list(old_combine_element(input_list, 0, separator)))
+
+    def test_combine_truncated_above_cap(self):
+        input_list = [('a{0}'.format(index), 'b{0}'.format(index), 'c{0}'.format(index)) for index in xrange(6)]
+        self.assertEqual(len(old_combine_element(input_list)), 729)
+        self.pinyin_tools.max_combination = 100
+        result = list(self.pinyin_tools.combine_element(input_list))
+        # 超过上限时按照笛卡尔积顺序截断，结果是原有结果的前max_combination个
+        self.assertEqual(result, old_combine_element(input_list)[:100])
+        self.assertEqual(result, list(self.pinyin_tools.combine_element(input_list)))
+
+    def test_pingyin_combination(self):
+        self.assertEqual(sorted(self.pinyin_tools.get_pingyin_combination(u'水果')),
+                         sorted(['shui guo', 'shuiguo', 's g', 'sg', 'sh g', 'shg']))
+        combination = sorted(self.pinyin_tools.get_pingyin_combination(u'水果'))
+        self.assertEqual(map(sorted, self.pinyin_tools.get_pingyin_combination_list([u'水果', u'', u'水果'])),
+                         [combination, [], combination])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# coding=utf-8
+import threading
+import time
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from river.prefetchers import PagePrefetcher
+
+__author__ = 'liuzhaoming'
+
+
+class FakePageSource(object):
+    """
+    模拟分页数据源，total条数据，每页size条，记录同时拉取的最大线程数
+    """
+
+    def __init__(self, total, size, fail_page=None):
+        self.total = total
+        self.size = size
+        self.fail_page = fail_page
+        self.fetched_pages = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def fetch_page(self, page_from):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.fetched_pages.append(page_from)
+        # 页码越小耗时越长，验证并行拉取时仍然按照页码顺序返回
+        time.sleep(0.01 * (5 - page_from % 5))
+        with self.lock:
+            self.running -= 1
+        if page_from == self.fail_page:
+            raise ValueError('fetch fail')
+        data = range(page_from * self.size, min((page_from + 1) * self.size, self.total))
+        return (data or None), len(data) == self.size
+
+
+class TestPagePrefetcher(unittest.TestCase):
+    def test_sequential(self):
+        page_source = FakePageSource(23, 5)
+        pages = list(PagePrefetcher(page_source.fetch_page, 1))
+        self.assertEqual([page_from for page_from, _ in pages], [1, 2, 3, 4])
+        self.assertEqual(pages[-1][1], [20, 21, 22])
+        self.assertEqual(page_source.max_running, 1)
+
+    def test_parallel_keep_order(self):
+        page_source = FakePageSource(50, 5)
+        pages = list(PagePrefetcher(page_source.fetch_page, 1, page_count=10, max_buffer_pages=3, workers=3))
+        self.assertEqual([page_from for page_from, _ in pages], range(1, 10))
+        self.assertEqual(sum((data for _, data in pages), []), range(5, 50))
+        self.assertLessEqual(page_source.max_running, 3)
+        self.assertGreater(page_source.max_running, 1)
+
+    def test_total_too_small(self):
+        page_source = FakePageSource(32, 5)
+        pages = list(PagePrefetcher(page_source.fetch_page, 1, page_count=4, workers=2))
+        self.assertEqual([page_from for page_from, _ in pages], [1, 2, 3, 4, 5, 6])
+
+    def test_error_after_previous_pages(self):
+        page_source = FakePageSource(50, 5, fail_page=3)
+        pages = []
+        with self.assertRaises(ValueError):
+            for page in PagePrefetcher(page_source.fetch_page, 1, page_count=10, workers=3):
+                pages.append(page[0])
+        self.assertEqual(pages, [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
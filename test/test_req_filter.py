@@ -0,0 +1,35 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from service.req_filter import get_literal_prefix, request_filter
+
+__author__ = 'liuzhaoming'
+
+
+class TestRequestFilter(unittest.TestCase):
+    def test_get_literal_prefix(self):
+        self.assertEqual(get_literal_prefix('^/marketings/items/(?!(exclude))'), (True, '/marketings/items/'))
+        self.assertEqual(get_literal_prefix('/products/(?!(gonghuo|store))[\\d\\D]+'), (False, '/products/'))
+        self.assertEqual(get_literal_prefix('^/boss/tickets$'), (True, '/boss/tickets'))
+        self.assertEqual(get_literal_prefix('^/uc/employees?/'), (True, '/uc/employee'))
+        self.assertEqual(get_literal_prefix('^/a/b|^/c/d'), (False, ''))
+
+    def test_get_url_literal_prefix(self):
+        filter_config = {'union_operator': 'and',
+                         'conditions': [{'operator': 'is', 'type': 'regex', 'field': 'url', 'expression': '/spus/'},
+                                        {'operator': 'is', 'type': 'regex', 'field': 'url',
+                                         'expression': '^/scene/spus/'}]}
+        self.assertEqual(request_filter.get_url_literal_prefix(filter_config), (True, '/scene/spus/'))
+        filter_config['union_operator'] = 'or'
+        self.assertEqual(request_filter.get_url_literal_prefix(filter_config), (False, ''))
+        self.assertTrue(request_filter.is_url_only(filter_config))
+        filter_config['conditions'].append({'operator': 'is', 'type': 'regex', 'field': 'param'})
+        self.assertFalse(request_filter.is_url_only(filter_config))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.utils import freeze
+from service.req_handler import RequestHandler
+
+__author__ = 'liuzhaoming'
+
+
+class TestEsConfigCache(unittest.TestCase):
+    @staticmethod
+    def get_es_config(handler, field_values):
+        return handler._RequestHandler__get_es_config(handler.handler_config['destination'], field_values)
+
+    def test_deterministic_router_cached(self):
+        handler = RequestHandler({'destination': {'index': 'idx_{adminId}', 'type': 'Product', 'id': '{id}',
+                                                  'setting': {'analyzer': 'ik'}}})
+        es_config = self.get_es_config(handler, {'adminId': 'A1'})
+        self.assertEqual(es_config['index'], 'idx_a1')
+        self.assertIs(self.get_es_config(handler, {'adminId': 'A1'}), es_config)
+        self.assertEqual(self.get_es_config(handler, {'adminId': 'A2'})['index'], 'idx_a2')
+        # 缓存的配置在请求之间共享，嵌套的配置也不能修改
+        self.assertRaises(TypeError, es_config['setting'].__setitem__, 'analyzer', 'standard')
+
+    def test_random_router_not_pinned(self):
+        handler = RequestHandler({'destination': {'router': {'type': 'random_router', 'target': [
+            {'index': 'a_{adminId}', 'type': 'Product'}, {'index': 'b_{adminId}', 'type': 'Product'}]}}})
+        indexes = set(self.get_es_config(handler, {'adminId': 'A1'})['index'] for _ in xrange(100))
+        self.assertEqual(indexes, {'a_a1', 'b_a1'})
+
+    def test_config_digest_precomputed(self):
+        destination_config = {'router': {'type': 'random_router', 'target': [
+            {'index': 'a_{adminId}', 'type': 'Product', 'setting': {'analyzer': 'ik'}},
+            {'index': 'a_{adminId}', 'type': 'Product', 'setting': {'analyzer': 'standard'}}]}}
+        handler = RequestHandler({'destination': destination_config})
+        digests = set(self.get_es_config(handler, {'adminId': 'A1'})['config_digest'] for _ in xrange(100))
+        # 不同路由目标的配置不同，查询结果缓存的摘要也不同；处理器的原始配置不变
+        self.assertEqual(len(digests), 2)
+        self.assertNotIn('config_digest', destination_config['router']['target'][0])
+
+        handler = RequestHandler({'destination': {'index': 'idx_{adminId}', 'type': 'Product'}})
+        self.assertEqual(self.get_es_config(handler, {'adminId': 'A1'})['config_digest'],
+                         self.get_es_config(handler, {'adminId': 'A2'})['config_digest'])
+        self.assertNotIn('config_digest', handler.handler_config['destination'])
+
+    def test_freeze(self):
+        frozen = freeze({'a': [{'b': 1}], 'c': {'d': 2}})
+        self.assertEqual(frozen, {'a': ({'b': 1},), 'c': {'d': 2}})
+        self.assertRaises(TypeError, frozen['a'][0].__setitem__, 'b', 2)
+        self.assertRaises(TypeError, frozen['c'].pop, 'd')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# coding=utf-8
+import unittest
+
+import elasticsearch7
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from service import search_scenes
+from service.search_scenes import SpuSearchBySku
+
+__author__ = 'liuzhaoming'
+
+ES_CFG = {'destination_type': 'elasticsearch7', 'index': 'sku_index', 'host': 'http://127.0.0.1:9200'}
+
+
+class FakeEs7Connection(object):
+    """
+    模拟ES7连接，每个SPU有3个SKU，按照SPU顺序返回
+    """
+
+    def __init__(self, spu_count=10, cardinality=None, collapse_error=False):
+        self.sku_hits = [{'_source': {'spuId': 'P{0}'.format(spu), 'skuId': 'P{0}-{1}'.format(spu, sku)}} for spu in
+                         xrange(spu_count) for sku in xrange(3)]
+        self.cardinality = spu_count if cardinality is None else cardinality
+        self.collapse_error = collapse_error
+        self.search_bodies = []
+        self.scroll_count = 0
+        self.scroll_size = 0
+        self.scroll_pos = 0
+
+    def search(self, index=None, body=None, scroll=None, **params):
+        self.search_bodies.append(body)
+        aggs = {'spu_total': {'value': self.cardinality}}
+        if 'spu_total_filter' in body['aggs']:
+            aggs = {'spu_total_filter': aggs}
+        if 'collapse' in body:
+            if self.collapse_error:
+                raise elasticsearch7.TransportError(400, 'illegal_argument_exception: cannot collapse on field')
+            spu_ids = sorted(set(hit['_source']['spuId'] for hit in self.sku_hits), key=lambda spu: int(spu[1:]))
+            hits = [{'_source': {'spuId': spu_id}} for spu_id in spu_ids[body['from']:body['from'] + body['size']]]
+            return {'hits': {'hits': hits}, 'aggregations': aggs}
+        self.scroll_size = body['size']
+        self.scroll_pos = 0
+        return dict(self.__next_page(), aggregations=aggs)
+
+    def scroll(self, scroll_id=None, scroll=None):
+        self.scroll_count += 1
+        return self.__next_page()
+
+    def __next_page(self):
+        hits = self.sku_hits[self.scroll_pos:self.scroll_pos + self.scroll_size]
+        self.scroll_pos += self.scroll_size
+        return {'_scroll_id': 'scroll_1', 'hits': {'hits': hits}}
+
+
+class FakeConnectionFactory(object):
+    def __init__(self, es_connection):
+        self.es_connection = es_connection
+
+    def get_es_connection(self, **kwargs):
+        return self.es_connection
+
+
+class FakeEs7Adapter(object):
+    def __init__(self, es_connection):
+        self.es_connection = es_connection
+        self.deleted_scroll_ids = []
+        self.multi_search_bodies = []
+
+    def delete_scroll(self, scroll_ids, **es_cfg):
+        self.deleted_scroll_ids.append(scroll_ids)
+
+    def multi_search(self, body, host, index=None, doc_type=None):
+        self.multi_search_bodies.append(body)
+        spu_ids = body[1]['query']['bool']['must'][0]['terms']['spuId']
+        sku_hits = [hit for hit in self.es_connection.sku_hits if hit['_source']['spuId'] in spu_ids]
+        spu_hits = [{'_source': {'spuId': spu_id}} for spu_id in spu_ids]
+        return {'responses': [{'hits': {'hits': spu_hits}}, {'hits': {'hits': sku_hits}}]}
+
+
+class TestSpuSearchBySkuStreaming(unittest.TestCase):
+    def setUp(self):
+        self.origin_factory = search_scenes.Es7ConnectionFactory
+        self.origin_adapter = search_scenes.es7_adapter
+        self.scene = SpuSearchBySku()
+
+    def tearDown(self):
+        search_scenes.Es7ConnectionFactory = self.origin_factory
+        search_scenes.es7_adapter = self.origin_adapter
+
+    def use_connection(self, es_connection):
+        search_scenes.Es7ConnectionFactory = FakeConnectionFactory(es_connection)
+        search_scenes.es7_adapter = FakeEs7Adapter(es_connection)
+        return es_connection
+
+    def get_page_by_scroll(self, from_pos, page_size):
+        return self.scene._SpuSearchBySku__get_page_spu_ids_by_scroll({'query': {'match_all': {}}}, ES_CFG, from_pos,
+                                                                      page_size, {}, 4)
+
+    def test_scroll_stops_after_page(self):
+        es_connection = self.use_connection(FakeEs7Connection(cardinality=10))
+        self.assertEqual(self.get_page_by_scroll(2, 3), (['P2', 'P3', 'P4'], 10))
+        # 5个SPU共15个SKU，每页4个，只需要读取4页
+        self.assertEqual(es_connection.scroll_count, 3)
+        self.assertEqual(search_scenes.es7_adapter.deleted_scroll_ids, ['scroll_1'])
+
+    def test_scroll_exhausted_total_is_exact(self):
+        # cardinality为近似值，扫描完所有数据时使用精确的SPU数目
+        self.use_connection(FakeEs7Connection(cardinality=11))
+        self.assertEqual(self.get_page_by_scroll(8, 5), (['P8', 'P9'], 10))
+
+    def test_collapse_fallback_on_400(self):
+        es_connection = self.use_connection(FakeEs7Connection(collapse_error=True))
+        self.assertEqual(self.scene._SpuSearchBySku__get_page_spu_ids_by_collapse({}, ES_CFG, 0, 3, {}), (None, 0))
+
+        self.scene.parse_sku_search_result = lambda *args: None
+        result, _ = self.scene.get_spu_by_sku_streaming({'from': 3, 'size': 2}, ES_CFG, {}, {'adminId': 'A1'},
+                                                        spu_aggs_cfg={'scroll_size': 4})
+        self.assertEqual([spu['spuId'] for spu in result['root']], ['P3', 'P4'])
+        # 不支持collapse的索引不再尝试collapse
+        self.assertFalse(any('collapse' in body for body in es_connection.search_bodies[1:]))
+
+    def test_collapse_page_keeps_post_filter(self):
+        es_connection = self.use_connection(FakeEs7Connection())
+        self.scene.parse_sku_search_result = lambda *args: None
+        post_filter = {'term': {'brand': 'apple'}}
+        result, _ = self.scene.get_spu_by_sku_streaming({'from': 2, 'size': 2, 'post_filter': post_filter}, ES_CFG,
+                                                        {}, {'adminId': 'A1'})
+        self.assertEqual(result['total'], 10)
+        self.assertEqual([spu['spuId'] for spu in result['root']], ['P2', 'P3'])
+        self.assertEqual(es_connection.search_bodies[0]['aggs']['spu_total_filter']['filter'], post_filter)
+        self.assertEqual(search_scenes.es7_adapter.multi_search_bodies[0][3]['post_filter'], post_filter)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# coding=utf-8
+import copy
+import math
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from django.http import QueryDict
+
+from algorithm.section_partitions import equal_section_partitions
+from service import models
+from service.models import Aggregation, EsAggManager, EsSearchManager
+
+__author__ = 'liuzhaoming'
+
+ES_CONFIG = {'destination_type': 'elasticsearch', 'host': 'http://127.0.0.1:9200'}
+PARSE_FIELDS = {'adminId': 'A1'}
+
+
+class FakeEsConnection(object):
+    """
+    模拟ES，根据价格列表计算extended_stats和range聚合
+    """
+
+    def __init__(self, prices):
+        self.prices = prices
+        self.search_bodies = []
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        self.search_bodies.append(copy.deepcopy(body))
+        aggregations = {}
+        for agg_name, agg_dsl in (body.get('aggs') or {}).iteritems():
+            if 'extended_stats' in agg_dsl:
+                avg = float(sum(self.prices)) / len(self.prices)
+                aggregations[agg_name] = {'avg': avg, 'std_deviation': math.sqrt(
+                    sum((price - avg) ** 2 for price in self.prices) / len(self.prices))}
+            elif 'range' in agg_dsl:
+                aggregations[agg_name] = {'buckets': [dict(item, doc_count=len(filter(
+                    lambda price: item.get('from', float('-inf')) <= price < item.get('to', float('inf')),
+                    self.prices))) for item in agg_dsl['range']['ranges']]}
+        return {'hits': {'total': len(self.prices), 'hits': []}, 'aggregations': aggregations}
+
+
+class FakeConnectionPool(object):
+    def __init__(self, es_connection):
+        self.es_connection = es_connection
+
+    def get_es_connection(self, **kwargs):
+        return self.es_connection
+
+
+class FakeQdslParser(object):
+    def get_agg_qdl(self, es_config, index_name, doc_type, args, parse_fields=None, es_connection=None):
+        return {'query': {'match_all': {}}, 'aggs': {'salePrice_stats': {'extended_stats': {'field': 'salePrice'}}}}
+
+    def get_search_qdl(self, es_config, index_name, doc_type, args, parse_fields=None, es_connection=None):
+        return dict(self.get_agg_qdl(es_config, index_name, doc_type, args, parse_fields), size=10)
+
+
+class TestSectionRangeAggs(unittest.TestCase):
+    def setUp(self):
+        self.origin_qdsl_parser = models.qdsl_parser
+        models.qdsl_parser = FakeQdslParser()
+        self.es_connection = FakeEsConnection([index * 7 % 1000 for index in xrange(500)])
+        connection_pools = {'elasticsearch': FakeConnectionPool(self.es_connection)}
+        self.agg_manager = EsAggManager()
+        self.agg_manager.connection_pools = connection_pools
+        self.search_manager = EsSearchManager()
+        self.search_manager.connection_pools = connection_pools
+        Aggregation.objects.connection_pools = connection_pools
+        self.args = QueryDict('ex_section_salePrice=section(size:4)')
+        equal_section_partitions.child_size_cache_enable = True
+        equal_section_partitions.child_size_cache.clear()
+
+    def tearDown(self):
+        models.qdsl_parser = self.origin_qdsl_parser
+        del Aggregation.objects.connection_pools
+        equal_section_partitions.child_size_cache.clear()
+
+    def get_agg(self):
+        self.es_connection.search_bodies = []
+        return self.agg_manager.get(ES_CONFIG, 'sku_index', 'None', self.args, PARSE_FIELDS)
+
+    def test_single_request_equals_two_requests(self):
+        two_request_result = self.get_agg()
+        self.assertEqual(len(self.es_connection.search_bodies), 2)
+        self.assertEqual(len(two_request_result['salePrice_section']), 4)
+
+        # 子区间已经缓存，range聚合放到原始查询中一次完成
+        self.assertEqual(self.get_agg(), two_request_result)
+        self.assertEqual(len(self.es_connection.search_bodies), 1)
+        self.assertIn('salePrice_range', self.es_connection.search_bodies[0]['aggs'])
+
+        self.es_connection.search_bodies = []
+        search_result = self.search_manager.get(ES_CONFIG, 'sku_index', 'None', self.args, PARSE_FIELDS)
+        self.assertEqual(len(self.es_connection.search_bodies), 1)
+        self.assertEqual(search_result['aggregations']['salePrice_section'], two_request_result['salePrice_section'])
+
+    def test_stale_child_size(self):
+        self.get_agg()
+        # 价格分布变化后缓存的子区间和本次统计结果不一致，不能使用原始查询中的range聚合
+        self.es_connection.prices = [price * 10 for price in self.es_connection.prices]
+        stale_result = self.get_agg()
+        self.assertEqual(len(self.es_connection.search_bodies), 2)
+        self.assertNotEqual(self.es_connection.search_bodies[0]['aggs']['salePrice_range'],
+                            self.es_connection.search_bodies[1]['aggs']['salePrice_range'])
+
+        equal_section_partitions.child_size_cache.clear()
+        self.assertEqual(self.get_agg(), stale_result)
+        # 缓存已经更新为本次统计结果
+        self.assertEqual(self.get_agg(), stale_result)
+        self.assertEqual(len(self.es_connection.search_bodies), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# coding=utf-8
+import unittest
+
+from common.utils import init_django_env
+
+init_django_env()
+
+from common.timings import LatencyHistogram, RequestTiming
+
+__author__ = 'liuzhaoming'
+
+
+class TestRequestTiming(unittest.TestCase):
+    def test_histogram_percentile(self):
+        histogram = LatencyHistogram()
+        for cost_ms in xrange(1, 101):
+            histogram.add(cost_ms)
+        stats = histogram.stats()
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(stats['max'], 100)
+        # 桶上界相对误差不超过20%
+        self.assertTrue(50 <= stats['p50'] <= 60)
+        self.assertTrue(95 <= stats['p99'] <= 100)
+
+    def test_span_aggregate_by_handler(self):
+        request_timing = RequestTiming()
+        request_timing.start()
+        with request_timing.span('route'):
+            pass
+        request_timing.set_handler('product_query')
+        request_timing.record('es_took', 5)
+        request_timing.finish()
+        stats = request_timing.stats()
+        self.assertEqual(set(stats['product_query'].keys()), {'route', 'es_took', 'total'})
+        self.assertEqual(stats['product_query']['es_took']['p95'], 5)
+
+    def test_span_without_timer(self):
+        request_timing = RequestTiming()
+        with request_timing.span('route'):
+            pass
+        self.assertIsNone(request_timing.finish())
+        self.assertEqual(request_timing.stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()